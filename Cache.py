@@ -0,0 +1,229 @@
+"""
+Two-tier cache: a small per-instance LRU in front of memcache.
+
+Values that are read on nearly every request (the default template values,
+the footer, the featured plaque, ...) are kept in instance memory for a few
+seconds so that most requests don't make a memcache RPC for them at all.
+
+Invalidation is generation based. Every key is stored under the current
+cache generation, a number kept in memcache. flush_all() bumps the
+generation, which orphans every existing entry in both tiers at once; the
+old memcache entries just age out. Instances re-read the generation at most
+every GENERATION_CHECK_SECONDS, so no instance serves stale data for longer
+than that.
+
+Values held in the local tier are shared between the threads of an instance
+(app.yaml sets threadsafe: true), so callers must not mutate what they get
+back.
+
+get_or_compute() adds request coalescing on a miss: one request takes a
+short memcache lease and recomputes the value, while concurrent requests
+serve the last-known-good copy (kept under a separate key that outlives
+generations) or wait briefly for the new value.
+"""
+
+from collections import OrderedDict
+import logging
+import threading
+import time
+
+from google.appengine.api import memcache
+
+LOCAL_CACHE_MAX_ITEMS = 200
+LOCAL_TTL_SECONDS = 30
+GENERATION_CHECK_SECONDS = 5
+GENERATION_KEY = 'cache_generation'
+LEASE_SECONDS = 10
+LEASE_WAIT_SECONDS = 1.0
+LEASE_POLL_SECONDS = 0.05
+
+class LruCache(object):
+    """
+    A bounded, threadsafe LRU dict whose entries expire after a TTL.
+    """
+    def __init__(self, max_items=LOCAL_CACHE_MAX_ITEMS):
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value for key, or None if it is missing or expired."""
+        now = time.time()
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < now:
+                return None
+            self._items[key] = item # re-insert as most recently used
+            return value
+
+    def set(self, key, value, ttl=LOCAL_TTL_SECONDS):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (time.time() + ttl, value)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+_local = LruCache()
+_generation_lock = threading.Lock()
+_generation_state = {'value': None, 'checked_at': 0}
+
+def _new_generation():
+    """
+    Start a generation from the clock, so that a generation key lost to a
+    memcache flush or eviction never comes back with an old value.
+    """
+    return int(time.time() * 1000)
+
+def _generation():
+    now = time.time()
+    with _generation_lock:
+        value = _generation_state['value']
+        if value is not None and \
+           now - _generation_state['checked_at'] < GENERATION_CHECK_SECONDS:
+            return value
+
+    generation = memcache.get(GENERATION_KEY)
+    if generation is None:
+        generation = _new_generation()
+        if not memcache.add(GENERATION_KEY, generation):
+            generation = memcache.get(GENERATION_KEY) or generation
+
+    with _generation_lock:
+        if generation != _generation_state['value']:
+            logging.debug("cache generation is now %s" % generation)
+            _local.clear()
+        _generation_state['value'] = generation
+        _generation_state['checked_at'] = now
+    return generation
+
+def _memcache_name(generation, name):
+    return '%s:%s' % (generation, name)
+
+def get(name):
+    """Get one value, from instance memory if possible. None on a miss."""
+    return get_multi([name]).get(name)
+
+def get_multi(names):
+    """
+    Get several values, making at most one memcache RPC for the ones that
+    aren't in instance memory. Returns a dict of the names that were found.
+    """
+    generation = _generation()
+    found = {}
+    missing = []
+    for name in names:
+        value = _local.get(_memcache_name(generation, name))
+        if value is None:
+            missing.append(name)
+        else:
+            found[name] = value
+
+    if missing:
+        memcache_names = dict(
+            (_memcache_name(generation, name), name) for name in missing)
+        memcache_out = memcache.get_multi(memcache_names.keys())
+        for memcache_name, value in memcache_out.items():
+            _local.set(memcache_name, value)
+            found[memcache_names[memcache_name]] = value
+    return found
+
+def put(name, value, ttl=0, local_ttl=LOCAL_TTL_SECONDS):
+    """
+    Set one value in both tiers, for ttl seconds in memcache (0 for no
+    expiry). Returns True if memcache took it.
+    """
+    return not put_multi({name: value}, ttl=ttl, local_ttl=local_ttl)
+
+def put_multi(mapping, ttl=0, local_ttl=LOCAL_TTL_SECONDS):
+    """
+    Set several values in both tiers. Like memcache.set_multi, return the
+    list of names that memcache did not store.
+    """
+    generation = _generation()
+    memcache_mapping = {}
+    for name, value in mapping.items():
+        memcache_name = _memcache_name(generation, name)
+        _local.set(memcache_name, value, ttl=local_ttl)
+        memcache_mapping[memcache_name] = value
+
+    not_set = memcache.set_multi(memcache_mapping, time=ttl)
+    return [name for name in mapping
+            if _memcache_name(generation, name) in not_set]
+
+def delete(name):
+    generation = _generation()
+    memcache_name = _memcache_name(generation, name)
+    _local.delete(memcache_name)
+    return memcache.delete(memcache_name)
+
+def flush_all():
+    """
+    Invalidate everything in both tiers, on every instance, by moving to a
+    new generation.
+    """
+    generation = memcache.incr(GENERATION_KEY,
+                               initial_value=_new_generation())
+    if generation is None:
+        logging.error("cache generation bump failed, flushing memcache")
+        memcache.flush_all()
+    _local.clear()
+    with _generation_lock:
+        _generation_state['value'] = generation
+        _generation_state['checked_at'] = time.time()
+
+def _wait_for(name):
+    """Poll for a value that another request is computing."""
+    waited = 0
+    while waited < LEASE_WAIT_SECONDS:
+        time.sleep(LEASE_POLL_SECONDS)
+        waited += LEASE_POLL_SECONDS
+        value = get(name)
+        if value is not None:
+            return value
+    return None
+
+def get_or_compute(name, compute, ttl=0, local_ttl=LOCAL_TTL_SECONDS):
+    """
+    Get a value, calling compute() to make it on a miss. Only one request at
+    a time recomputes a given name; the others get the stale copy, or wait
+    for the recomputed value, and only compute it themselves as a last
+    resort. compute() may return None, in which case nothing is cached.
+    """
+    value = get(name)
+    if value is not None:
+        return value
+
+    lease_name = 'lease:%s' % _memcache_name(_generation(), name)
+    stale_name = 'stale:%s' % name
+    if memcache.add(lease_name, 1, time=LEASE_SECONDS):
+        try:
+            value = compute()
+            if value is not None:
+                put(name, value, ttl=ttl, local_ttl=local_ttl)
+                memcache.set(stale_name, value)
+        finally:
+            memcache.delete(lease_name)
+        return value
+
+    value = memcache.get(stale_name)
+    if value is not None:
+        logging.debug("serving stale value for %s" % name)
+        return value
+
+    value = _wait_for(name)
+    if value is not None:
+        return value
+
+    logging.debug("gave up waiting for %s, computing it" % name)
+    return compute()
@@ -0,0 +1,196 @@
+"""
+Geohashes, for finding plaques by location with ordinary datastore queries.
+
+A geohash names a cell of a grid over the earth; each extra character splits
+the cell into 32, and every prefix of a point's geohash names a larger cell
+containing it. Each plaque stores the prefixes of its geohash from
+MIN_PRECISION to MAX_PRECISION characters long, so an equality filter on
+one prefix finds the plaques in that cell.
+
+A search around a point looks in the point's cell and its eight neighbours
+at the finest precision whose cells are at least as big as the search
+radius; everything within the radius is in those nine cells, and the exact
+distances are then checked with the haversine formula.
+
+Approximate cell sizes at the equator (height x width):
+
+    precision 1: 5000km x 5000km
+    precision 2:  625km x 1250km
+    precision 3:  156km x  156km
+    precision 4:   20km x   39km
+    precision 5:  4.9km x  4.9km
+    precision 6:  610m  x  1.2km
+    precision 7:  153m  x  153m
+    precision 8:   19m  x   38m
+"""
+
+import math
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+MIN_PRECISION = 1
+MAX_PRECISION = 8
+MAX_BBOX_CELLS = 16
+EARTH_RADIUS_METERS = 6371000.0
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS_METERS / 180.0
+
+def haversine_meters(lat1, lng1, lat2, lng2):
+    """Great-circle distance between two points, in meters."""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = math.radians(lat2 - lat1)
+    dlambda = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + \
+        math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(min(1.0, math.sqrt(a)))
+
+def _wrap_lng(lng):
+    return (lng + 180.0) % 360.0 - 180.0
+
+def encode(lat, lng, precision=MAX_PRECISION):
+    """The geohash of a point."""
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    num_bits = 0
+    is_lng = True
+    while len(chars) < precision:
+        if is_lng:
+            value, value_range = lng, lng_range
+        else:
+            value, value_range = lat, lat_range
+        mid = (value_range[0] + value_range[1]) / 2
+        if value >= mid:
+            bits = bits * 2 + 1
+            value_range[0] = mid
+        else:
+            bits = bits * 2
+            value_range[1] = mid
+        is_lng = not is_lng
+
+        num_bits += 1
+        if num_bits == 5:
+            chars.append(BASE32[bits])
+            bits = 0
+            num_bits = 0
+    return ''.join(chars)
+
+def decode_bbox(geohash):
+    """The (south, west, north, east) bounds of a geohash cell."""
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    is_lng = True
+    for char in geohash:
+        bits = BASE32.index(char)
+        for shift in range(4, -1, -1):
+            value_range = lng_range if is_lng else lat_range
+            mid = (value_range[0] + value_range[1]) / 2
+            if (bits >> shift) & 1:
+                value_range[0] = mid
+            else:
+                value_range[1] = mid
+            is_lng = not is_lng
+    return lat_range[0], lng_range[0], lat_range[1], lng_range[1]
+
+def cell_size_degrees(precision):
+    """The (height, width) of the cells at a precision, in degrees."""
+    num_bits = 5 * precision
+    lng_bits = (num_bits + 1) // 2
+    lat_bits = num_bits // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lng_bits
+
+def prefixes(lat, lng):
+    """The geohash prefixes that are stored for a point."""
+    geohash = encode(lat, lng, MAX_PRECISION)
+    return [geohash[:n] for n in range(MIN_PRECISION, MAX_PRECISION + 1)]
+
+def neighbours(geohash):
+    """The (up to) eight cells around a cell, at the same precision."""
+    south, west, north, east = decode_bbox(geohash)
+    height = north - south
+    width = east - west
+    lat = (south + north) / 2
+    lng = (west + east) / 2
+
+    cells = []
+    for dlat in (-height, 0, height):
+        for dlng in (-width, 0, width):
+            if dlat == 0 and dlng == 0:
+                continue
+            if not -90 < lat + dlat < 90:
+                continue
+            cells.append(encode(lat + dlat, _wrap_lng(lng + dlng),
+                                len(geohash)))
+    return cells
+
+def covered_radius_meters(lat, precision):
+    """
+    How far from a point its cell and that cell's neighbours are guaranteed
+    to reach: one cell height or width, whichever is smaller there.
+    """
+    height, width = cell_size_degrees(precision)
+    return METERS_PER_DEGREE * min(height,
+                                   width * math.cos(math.radians(lat)))
+
+def cells_around(lat, lng, precision):
+    """A point's cell and its neighbours."""
+    center = encode(lat, lng, precision)
+    return sorted(set([center] + neighbours(center)))
+
+def precision_for_radius(lat, radius_meters):
+    """
+    The finest precision whose cells around a point at this latitude cover
+    radius_meters, or None if even MIN_PRECISION doesn't.
+    """
+    for precision in range(MAX_PRECISION, MIN_PRECISION - 1, -1):
+        if covered_radius_meters(lat, precision) >= radius_meters:
+            return precision
+    return None
+
+def cells_for_radius(lat, lng, radius_meters):
+    """
+    Cells that together contain every point within radius_meters of (lat,
+    lng), or None if the radius is too big for any precision.
+    """
+    precision = precision_for_radius(lat, radius_meters)
+    if precision is None:
+        return None
+    return cells_around(lat, lng, precision)
+
+def _bbox_steps(low, high, step):
+    values = []
+    value = low
+    while value < high:
+        values.append(value)
+        value += step
+    values.append(high)
+    return values
+
+def cells_for_bbox(south, west, north, east):
+    """
+    At most MAX_BBOX_CELLS cells that together contain the bounding box, at
+    the finest precision that allows. A box with west > east crosses the
+    antimeridian.
+    """
+    if east < west:
+        east += 360.0
+    for precision in range(MAX_PRECISION, MIN_PRECISION - 1, -1):
+        height, width = cell_size_degrees(precision)
+        num_rows = math.ceil((north - south) / height) + 1
+        num_cols = math.ceil((east - west) / width) + 1
+        if num_rows * num_cols <= MAX_BBOX_CELLS or \
+           precision == MIN_PRECISION:
+            break
+
+    cells = set()
+    for lat in _bbox_steps(south, north, height):
+        for lng in _bbox_steps(west, east, width):
+            cells.add(encode(lat, _wrap_lng(lng), precision))
+    return sorted(cells)
+
+def in_bbox(lat, lng, south, west, north, east):
+    if not south <= lat <= north:
+        return False
+    if west <= east:
+        return west <= lng <= east
+    return lng >= west or lng <= east
@@ -0,0 +1,212 @@
+"""
+Addresses to locations, for submissions and imports that give an address
+rather than a lat and lng.
+
+Every answer the geocoder gives is kept, under the normalized address, in
+memcache and in a GeocodedAddress entity, so each distinct address is only
+geocoded once. An address the geocoder couldn't find is remembered too,
+and asked about again after NOT_FOUND_RETRY_DAYS.
+
+Lookups go through a Geocoder. The default is GoogleGeocoder; StubGeocoder
+makes up a location from the address without any requests, for offline
+development. GEOCODER picks one, as Search.SEARCH_BACKEND does for search.
+The geocoder is asked with async urlfetch calls, GEOCODE_CONCURRENCY at a
+time, each with a deadline, and a batch stops asking once it has taken
+BATCH_BUDGET_SECONDS, so a submission never hangs on the geocoder. An
+address that timed out or failed is not remembered, so it's tried again
+next time.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import re
+import time
+import urllib
+
+from google.appengine.api import memcache
+from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
+
+from Models import GeocodedAddress
+
+GEOCODER = 'google' # or 'stub'
+GOOGLE_GEOCODE_URL = 'https://maps.googleapis.com/maps/api/geocode/json'
+GOOGLE_API_KEY = None
+DEADLINE_SECONDS = 5
+BATCH_BUDGET_SECONDS = 20
+GEOCODE_CONCURRENCY = 10
+NOT_FOUND_RETRY_DAYS = 30
+MEMCACHE_SECONDS = 24 * 3600
+NOT_FOUND = () # cached for an address the geocoder couldn't find
+
+def normalize_address(address):
+    """Lowercase, with the whitespace and commas tidied up."""
+    address = re.sub(r'\s+', ' ', address.strip().lower())
+    address = re.sub(r'\s*,[\s,]*', ', ', address)
+    return address.strip(', ')
+
+def _memcache_name(address):
+    return 'geocode_%s' % GeocodedAddress.id_for(address)
+
+class Geocoder(object):
+    name = None
+
+    def geocode_many(self, addresses, deadline):
+        """
+        A dict of address -> (lat, lng), or NOT_FOUND, for the addresses the
+        geocoder answered for. Any that failed, or weren't asked about
+        before the deadline (a time.time()), are left out.
+        """
+        raise NotImplementedError
+
+class GoogleGeocoder(Geocoder):
+    name = 'google'
+
+    def _url(self, address):
+        params = {'address': address.encode('utf-8')}
+        if GOOGLE_API_KEY:
+            params['key'] = GOOGLE_API_KEY
+        return '%s?%s' % (GOOGLE_GEOCODE_URL, urllib.urlencode(params))
+
+    def _result(self, address, rpc):
+        try:
+            resp = rpc.get_result()
+        except urlfetch.Error as err:
+            logging.warning("geocoding '%s' failed: %s" % (address, err))
+            return None
+        if resp.status_code != 200:
+            logging.warning("geocoding '%s' got a %s" % (address,
+                                                         resp.status_code))
+            return None
+        try:
+            geo_json = json.loads(resp.content)
+        except ValueError:
+            logging.warning("geocoding '%s' didn't get JSON" % address)
+            return None
+        if geo_json.get('status') == 'ZERO_RESULTS':
+            return NOT_FOUND
+        if geo_json.get('status') != 'OK' or not geo_json.get('results'):
+            logging.warning("geocoding '%s' got status %s" % (
+                address, geo_json.get('status')))
+            return None
+        loc_json = geo_json['results'][0]['geometry']['location']
+        return loc_json['lat'], loc_json['lng']
+
+    def geocode_many(self, addresses, deadline):
+        located = {}
+        for i in range(0, len(addresses), GEOCODE_CONCURRENCY):
+            if time.time() >= deadline:
+                logging.warning("geocoding stopped at the deadline with %s "
+                                "addresses left" % (len(addresses) - i))
+                break
+            rpcs = []
+            for address in addresses[i:i + GEOCODE_CONCURRENCY]:
+                rpc = urlfetch.create_rpc(deadline=DEADLINE_SECONDS)
+                urlfetch.make_fetch_call(rpc, self._url(address))
+                rpcs.append((address, rpc))
+            for address, rpc in rpcs:
+                result = self._result(address, rpc)
+                if result is not None:
+                    located[address] = result
+        return located
+
+class StubGeocoder(Geocoder):
+    """
+    Geocodes without asking anyone: the addresses in KNOWN are where they
+    say, and any other address gets a made-up location derived from a hash
+    of it, the same every time.
+    """
+    name = 'stub'
+    KNOWN = {}
+
+    def geocode_many(self, addresses, deadline):
+        located = {}
+        for address in addresses:
+            if address in self.KNOWN:
+                located[address] = self.KNOWN[address]
+                continue
+            digest = hashlib.sha1(address.encode('utf-8')).hexdigest()
+            lat = int(digest[:8], 16) / float(0xffffffff) * 170.0 - 85.0
+            lng = int(digest[8:16], 16) / float(0xffffffff) * 360.0 - 180.0
+            located[address] = (round(lat, 6), round(lng, 6))
+        return located
+
+def get_geocoder(name=None):
+    if (name or GEOCODER) == 'stub':
+        return StubGeocoder()
+    else:
+        return GoogleGeocoder()
+
+def _cached(addresses):
+    """The cached answers for some normalized addresses, from either tier."""
+    memcache_names = dict((_memcache_name(a), a) for a in addresses)
+    found = dict((memcache_names[name], value) for name, value in
+                 memcache.get_multi(memcache_names.keys()).items())
+
+    missing = [a for a in addresses if a not in found]
+    retry_before = datetime.datetime.now() - \
+                   datetime.timedelta(days=NOT_FOUND_RETRY_DAYS)
+    keys = [ndb.Key(GeocodedAddress, GeocodedAddress.id_for(a))
+            for a in missing]
+    refill = {}
+    for address, entity in zip(missing, ndb.get_multi(keys)):
+        if entity is None:
+            continue
+        if entity.location is None:
+            if entity.created_on < retry_before:
+                continue
+            value = NOT_FOUND
+        else:
+            value = (entity.location.lat, entity.location.lon)
+        found[address] = value
+        refill[_memcache_name(address)] = value
+    if refill:
+        memcache.set_multi(refill, time=MEMCACHE_SECONDS)
+    return found
+
+def _remember(located, provider):
+    entities = []
+    for address, value in located.items():
+        location = ndb.GeoPt(*value) if value != NOT_FOUND else None
+        entities.append(GeocodedAddress(id=GeocodedAddress.id_for(address),
+                                        address=address, location=location,
+                                        provider=provider))
+    ndb.put_multi(entities)
+    memcache.set_multi(dict((_memcache_name(a), v)
+                            for a, v in located.items()),
+                       time=MEMCACHE_SECONDS)
+
+@ndb.non_transactional # the cache isn't part of the caller's write
+def geocode_many(addresses, budget_seconds=BATCH_BUDGET_SECONDS):
+    """
+    Geocode some addresses, from the cache where possible. Returns a dict
+    of each address as given -> ndb.GeoPt, or None if it couldn't be found
+    or the geocoder didn't answer in time.
+    """
+    deadline = time.time() + budget_seconds
+    normalized = dict((a, normalize_address(a)) for a in addresses)
+    to_find = sorted(set(n for n in normalized.values() if n))
+
+    found = _cached(to_find)
+    missing = [a for a in to_find if a not in found]
+    if missing:
+        geocoder = get_geocoder()
+        located = geocoder.geocode_many(missing, deadline)
+        if located:
+            _remember(located, geocoder.name)
+        found.update(located)
+        logging.info("geocoded %s addresses: %s cached, %s asked, %s "
+                     "answered" % (len(to_find), len(to_find) - len(missing),
+                                   len(missing), len(located)))
+
+    locations = {}
+    for address, norm in normalized.items():
+        value = found.get(norm)
+        locations[address] = ndb.GeoPt(*value) if value else None
+    return locations
+
+def geocode(address):
+    """One address's ndb.GeoPt, or None."""
+    return geocode_many([address], budget_seconds=DEADLINE_SECONDS)[address]
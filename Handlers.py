@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 
 from collections import defaultdict
+import base64
+import calendar
 import datetime
+import email.utils
+import hashlib
 import jinja2
 import json
 import logging
@@ -10,6 +14,8 @@ import mimetypes
 import os
 import random
 import re
+import StringIO
+import time
 import urllib
 import webapp2
 
@@ -18,17 +24,31 @@ from google.appengine.api import images
 from google.appengine.api import mail
 from google.appengine.api import memcache
 from google.appengine.api import search
+from google.appengine.api import taskqueue
 from google.appengine.api import users
 from google.appengine.ext import blobstore
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 from google.appengine.ext.ndb.google_imports import ProtocolBuffer
 from google.appengine.ext.db import BadValueError
 
 import lib.cloudstorage as gcs
 
+import Cache as cache
+import Geocode
+import ImageFetch
+import Importer
+import Suggest
+
 from Models import Comment, Plaque, FeaturedPlaque, FETCH_LIMIT_PLAQUES
+from Models import ApiKey, Counter, ModerationJob, StateBackfill
+from Models import PrerenderState
+from Models import NUM_APPROVED_COUNTER, NUM_PENDING_COUNTER
+from Search import DEF_SEARCH_LIMIT, SORT_RELEVANCE
+from Search import build_local_index, geo_search_plaques, search_plaques
+from Search import check_index, index_plaques, unindex_plaques
+from Search import reindex_status, run_reindex_shard, start_reindex
 
-PLAQUE_SEARCH_INDEX_NAME = 'plaque_index'
 ADMIN_EMAIL = 'kester+readtheplaque@gmail.com'
 NOTIFICATION_SENDER_EMAIL = 'kester@gmail.com'
 ADD_STATE_SUCCESS = 'success'
@@ -45,8 +65,33 @@ GCS_BUCKET = '/read-the-plaque.appspot.com'
 
 DEF_PLAQUESET_NAME = 'public'
 DEF_NUM_PER_PAGE = 20
+MAX_NUM_PER_PAGE = 100
 DEF_NUM_PENDING = 5
 DEF_MAP_ICON_SIZE_PIX = 16
+DEF_NUM_RSS_ENTRIES = 10
+MAX_NUM_RSS_ENTRIES = 100
+RSS_MAX_AGE_SECONDS = 300
+MAX_NUM_GEO_RESULTS = 200
+DEF_NUM_NEARBY = 20
+MAX_NUM_NEARBY = 100
+GEOHASH_BATCH_SIZE = 200
+STATE_BACKFILL_TASK = 'state-backfill-1'
+NEARBY_BATCH_SIZE = 50
+NEARBY_REFRESH_NUM = 50
+NEARBY_UPDATE_DELAY_SECONDS = 5
+SUGGEST_MAX_AGE_SECONDS = 60
+MODERATION_TASK_URL = '/tasks/moderate'
+MODERATION_BATCH_SIZE = 100 # a transaction can write at most 500 entities
+MODERATION_TASK_SECONDS = 60
+TASKS_PER_QUEUE_ADD = 100
+MODERATION_PREFETCH = 3 # pending plaques to load ahead of the current one
+GCS_WRITE_CHUNK_BYTES = 1024 * 1024
+
+# Prerendered copies of the most-read pages are kept in GCS, so that a cache
+# miss on them costs one GCS read rather than datastore queries and a render.
+PRERENDER_GCS_DIR = GCS_BUCKET + '/prerendered'
+PRERENDER_NUM_PAGES = 3
+PRERENDER_BATCH_SECONDS = 10
 
 # Load templates from the /templates dir
 JINJA_ENVIRONMENT = jinja2.Environment(
@@ -56,6 +101,19 @@ JINJA_ENVIRONMENT = jinja2.Environment(
     extensions=['jinja2.ext.autoescape'],
     autoescape=False) # turn off autoescape to allow html descriptions
 
+def rfc822_date(dt):
+    """Format a naive UTC datetime as an RFC 822 date, for RSS pubDate."""
+    return email.utils.formatdate(calendar.timegm(dt.utctimetuple()),
+                                  usegmt=True)
+
+def format_distance(meters):
+    if meters < 1000:
+        return '%d m' % meters
+    return '%.1f km' % (meters / 1000.0)
+
+JINJA_ENVIRONMENT.filters['rfc822'] = rfc822_date
+JINJA_ENVIRONMENT.filters['distance'] = format_distance
+
 class SubmitError(Exception):
     pass
 
@@ -65,19 +123,17 @@ class SubmitError(Exception):
 
 def get_default_template_values(**kwargs):
     memcache_name = 'default_template_values_%s' % users.is_current_user_admin()
-    template_values = memcache.get(memcache_name)
+    template_values = cache.get(memcache_name)
     if template_values is None:
-        num_pending = Plaque.num_pending(num=DEF_NUM_PENDING)
         footer_items = get_footer_items()
         loginout_output = loginout()
 
         template_values = {
-            'num_pending': num_pending,
             'footer_items': footer_items,
             'loginout': loginout_output,
             'icon_size': DEF_MAP_ICON_SIZE_PIX,
         }
-        memcache_status = memcache.set(memcache_name, template_values)
+        memcache_status = cache.put(memcache_name, template_values)
         if not memcache_status:
             logging.debug(
                 "memcaching.set to %s for default_template_values failed" %
@@ -87,6 +143,13 @@ def get_default_template_values(**kwargs):
             "memcache.get from %s worked for default_template_values" %
             memcache_name)
 
+    # The cached dict may be shared with other requests on this instance, so
+    # add the per-page values to a copy.
+    template_values = dict(template_values)
+    if template_values['loginout']['is_admin']:
+        # Only admins see the pending count, and it changes with every
+        # submission, so it's read fresh from its counter.
+        template_values['num_pending'] = Plaque.num_pending()
     for k, v in kwargs.items():
         template_values[k] = v
     return template_values
@@ -150,7 +213,7 @@ def get_random_time():
     Get a random time during the operation of the site.
     """
     memcache_names = ['first', 'last']
-    memcache_out = memcache.get_multi(memcache_names)
+    memcache_out = cache.get_multi(memcache_names)
     memcache_worked = len(memcache_out.keys()) == len(memcache_names)
     if memcache_worked:
             first = memcache_out[memcache_names[0]]
@@ -168,7 +231,7 @@ def get_random_time():
         else:
             last = None
 
-        memcache_status = memcache.set_multi({
+        memcache_status = cache.put_multi({
             memcache_names[0]: first,
             memcache_names[1]: last
         })
@@ -226,20 +289,14 @@ def get_footer_items():
     Just 5 tags for the footer.
     Memcache the output of this so it doesn't get calculated every time.
     """
-    footer_items = memcache.get('get_footer_items')
-    if footer_items is None:
+    def compute():
         random_plaques = [get_random_plaque() for _ in range(5)]
         tags = random_tags()
-        footer_items = {'tags': tags,
-                        'new_plaques': random_plaques,
-                        'new_comments': last_five_approved(Comment)}
-
-        memcache_status = memcache.set('get_footer_items', footer_items)
-        if not memcache_status:
-            logging.debug("memcaching for get_footer_items failed")
-    else:
-        logging.debug("memcache.get worked for get_footer_items")
+        return {'tags': tags,
+                'new_plaques': random_plaques,
+                'new_comments': last_five_approved(Comment)}
 
+    footer_items = cache.get_or_compute('get_footer_items', compute)
     return footer_items
 
 def loginout():
@@ -256,11 +313,17 @@ def loginout():
     return loginout
 
 def get_featured():
-    featured = FeaturedPlaque.query().order(-Plaque.created_on).get()
-    if featured is not None:
-        plaque = Plaque.query().filter(Plaque.key == featured.plaque).get()
+    plaque = cache.get('featured_plaque')
+    if plaque is None:
+        featured = FeaturedPlaque.query().order(-Plaque.created_on).get()
+        if featured is not None:
+            plaque = Plaque.query().filter(Plaque.key == featured.plaque).get()
+        if plaque is not None:
+            memcache_status = cache.put('featured_plaque', plaque)
+            if not memcache_status:
+                logging.debug("memcaching for get_featured failed")
     else:
-        plaque = None
+        logging.debug("memcache.get worked for get_featured")
     return plaque
 
 def set_featured(plaque):
@@ -288,13 +351,207 @@ def handle_500(request, response, exception):
     response.write(template.render({'code': 500, 'error_text': exception}))
     response.set_status(500)
 
+def warm_caches():
+    """
+    Do the work that the first request on a new instance would otherwise pay
+    for: compile every template and fill the caches for the shared parts of
+    the pages. Return a list of (stage name, seconds) tuples.
+    """
+    def compile_templates():
+        for template_name in JINJA_ENVIRONMENT.list_templates():
+            JINJA_ENVIRONMENT.get_template(template_name)
+
+    stages = [
+        ('templates', compile_templates),
+        ('random_time', get_random_time),
+        ('footer_items', get_footer_items),
+        ('default_template_values', get_default_template_values),
+        ('featured', get_featured),
+        ('page_plaques', lambda: Plaque.page_plaques(DEF_NUM_PER_PAGE)),
+        ('suggest_index', lambda: Suggest.suggest('a')),
+    ]
+
+    timings = []
+    for name, stage in stages:
+        start = time.time()
+        try:
+            stage()
+        except Exception as err:
+            logging.error("warmup stage %s failed: %s" % (name, err))
+        timings.append((name, time.time() - start))
+    return timings
+
+def prerender_filename(generation, path):
+    """The GCS filename for a prerendered copy of the page at path."""
+    if path == '/':
+        path = '/index'
+    return '%s/%s%s' % (PRERENDER_GCS_DIR, generation, path)
+
+def write_prerendered(generation, path, text, content_type='text/html'):
+    """Write a page to GCS, in a generation of prerendered pages."""
+    op = {b'x-goog-acl': b'public-read'}
+    with gcs.open(prerender_filename(generation, path), 'w',
+                  content_type=content_type, options=op) as fh:
+        fh.write(text.encode('utf-8'))
+
+def read_prerendered(path):
+    """
+    Read a prerendered page from GCS. Return None if the live generation
+    doesn't have it, or if the plaques have changed since it was written.
+    """
+    state = PrerenderState.current()
+    if not state.is_fresh:
+        return None
+    try:
+        with gcs.open(prerender_filename(state.generation, path)) as fh:
+            text = fh.read().decode('utf-8')
+    except gcs.NotFoundError:
+        return None
+    logging.debug("serving prerendered %s" % path)
+    return text
+
+def delete_prerendered(generation):
+    """Delete every page of a generation of prerendered pages."""
+    prefix = '%s/%s/' % (PRERENDER_GCS_DIR, generation)
+    for stat in gcs.listbucket(prefix):
+        try:
+            gcs.delete(stat.filename)
+        except gcs.NotFoundError:
+            pass
+
+@ndb.transactional
+def _prerender_changed(now):
+    state = PrerenderState.current()
+    state.changed_at = now
+    state.put()
+
+@ndb.transactional
+def _publish_prerendered(generation, started):
+    """
+    Make a generation of prerendered pages live, unless the plaques have
+    changed since it was started. Returns whether it did, and the
+    generation it replaced.
+    """
+    state = PrerenderState.current()
+    if state.changed_at is not None and state.changed_at >= started:
+        return False, None
+    old_generation = state.generation
+    state.generation = generation
+    state.published_at = started
+    state.put()
+    return True, old_generation
+
+@ndb.non_transactional
+def queue_prerender():
+    """
+    Stop serving the prerendered pages, and write a new generation of them
+    soon. Changes within the same PRERENDER_BATCH_SECONDS share one task.
+    """
+    now = time.time()
+    _prerender_changed(now)
+    batch = int(now // PRERENDER_BATCH_SECONDS)
+    countdown = (batch + 1) * PRERENDER_BATCH_SECONDS - now
+    try:
+        taskqueue.add(url='/tasks/prerender',
+                      name='prerender-%s' % batch,
+                      countdown=countdown)
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        pass
+
+def plaques_changed():
+    """
+    Call this whenever the set of published plaques, or anything shown
+    alongside them, changes.
+    """
+    cache.flush_all()
+    queue_prerender()
+
+def plaque_pages_changed(plaques):
+    """
+    Stop serving the cached and prerendered pages of just these plaques,
+    for a change that only shows on their own pages.
+    """
+    state = PrerenderState.current()
+    for plaque in plaques:
+        for name in [plaque.title_url, plaque.key.urlsafe(),
+                     plaque.old_site_id]:
+            if name is not None:
+                cache.delete('view_one_%s' % name)
+        if state.generation is not None:
+            try:
+                gcs.delete(prerender_filename(state.generation,
+                                              plaque.title_page_url))
+            except gcs.NotFoundError:
+                pass
+
+def after_commit(func, *args):
+    """
+    Call func(*args) once the current transaction commits, or straight away
+    outside a transaction. For the caches, the search index and the like,
+    which mustn't see a change before it's in the datastore.
+    """
+    ndb.get_context().call_on_commit(lambda: func(*args))
+
+def update_search_index(plaques):
+    """
+    Re-put the plaques' search documents after their state changes. Errors
+    are logged rather than raised: the nightly /tasks/checksearchindex job
+    repairs anything missed.
+    """
+    try:
+        index_plaques(plaques)
+    except search.Error as err:
+        logging.error("search index update failed: %s" % err)
+
+def _nearby_task(plaque):
+    return taskqueue.Task(url='/tasks/updatenearby',
+                          params={'plaque_key': plaque.key.urlsafe(),
+                                  'lat': plaque.location.lat,
+                                  'lng': plaque.location.lon},
+                          countdown=NEARBY_UPDATE_DELAY_SECONDS)
+
+def queue_nearby_update(plaque):
+    """
+    Refresh the nearby lists around a plaque that has been published,
+    edited, unpublished or deleted. Inside a transaction the task is only
+    queued if the transaction commits.
+    """
+    taskqueue.Queue().add(_nearby_task(plaque),
+                          transactional=ndb.in_transaction())
+
+def update_state_counters(was_approved, is_approved, num=1):
+    """
+    Move num plaques between the pending and approved counters. None means
+    the plaques don't exist: before they're submitted or after they're
+    deleted. Inside a transaction this needs xg=True, and the counts only
+    change if it commits.
+    """
+    if was_approved == is_approved or num == 0:
+        return
+    names = {True: NUM_APPROVED_COUNTER, False: NUM_PENDING_COUNTER}
+    if was_approved is not None:
+        Counter.incr(names[was_approved], -num)
+    if is_approved is not None:
+        Counter.incr(names[is_approved], num)
+
+def queue_nearby_updates(plaques):
+    """queue_nearby_update() for many plaques, in a few queue RPCs."""
+    tasks = [_nearby_task(plaque) for plaque in plaques]
+    queue = taskqueue.Queue()
+    for i in range(0, len(tasks), TASKS_PER_QUEUE_ADD):
+        queue.add(tasks[i:i + TASKS_PER_QUEUE_ADD])
+
 class ViewPlaquesPage(webapp2.RequestHandler):
     def head(self, start_curs_str=None):
         self.get()
         self.response.clear()
 
+    @ndb.toplevel
     def get(self, cursor_urlsafe=None):
-        template_text = self._get(cursor_urlsafe, is_random=False, is_featured=True)
+        per_page = self.request.get('per_page', DEF_NUM_PER_PAGE)
+        template_text = self._get(cursor_urlsafe, per_page=per_page,
+                                  is_random=False, is_featured=True)
         self.response.write(template_text)
 
     def _get(self, cursor_urlsafe=None, per_page=DEF_NUM_PER_PAGE, is_random=False, is_featured=True):
@@ -308,6 +565,8 @@ class ViewPlaquesPage(webapp2.RequestHandler):
             per_page = DEF_NUM_PER_PAGE
         if per_page < 1:
             per_page = 1
+        if per_page > MAX_NUM_PER_PAGE:
+            per_page = MAX_NUM_PER_PAGE
 
         # If the requested page is not random, get the memcache.
         #
@@ -315,32 +574,43 @@ class ViewPlaquesPage(webapp2.RequestHandler):
         user = users.get_current_user()
         name = "anon" if user is None else user.nickname()
         logging.debug("User %s is admin: %s" % (name, is_admin))
-        memcache_name = 'view_plaques_page_featured_%s_%s_%s' % (
-            per_page, cursor_urlsafe, is_admin)
-        if is_random:
-            template_text = None
+        memcache_name = 'view_plaques_page_featured_%s_%s' % (
+            per_page, cursor_urlsafe)
+
+        def render():
+            is_prerendered = not is_admin and is_featured and \
+                             per_page == DEF_NUM_PER_PAGE
+            if is_prerendered:
+                template_text = read_prerendered(
+                    self.prerender_path(cursor_urlsafe))
+                if template_text is not None:
+                    return template_text
+            return self._render(per_page, cursor_urlsafe, is_random,
+                                is_featured)
+
+        # Admin pages show pending plaques and controls, and go stale as
+        # soon as anything is moderated, so they aren't cached.
+        if is_random or is_admin:
+            template_text = self._render(per_page, cursor_urlsafe, is_random,
+                                         is_featured)
         else:
-            template_text = memcache.get(memcache_name)
-            logging.debug("memcaching worked for ViewPlaquesPage %s" %
-                memcache_name)
-
-        if template_text is None:
-            template_values = self._get_template_values(
-                per_page, cursor_urlsafe, is_random, is_featured)
-            template = JINJA_ENVIRONMENT.get_template('all.html')
-            template_text = template.render(template_values)
-            if not is_random:
-                memcache_status = memcache.set(memcache_name, template_text)
-                if not memcache_status:
-                    logging.debug("memcache.set failed for ViewPlaquesPage %s" %
-                        memcache_name)
-                else:
-                    logging.debug(
-                        "memcache.set worked for ViewPlaquesPage %s" %
-                        memcache_name)
+            template_text = cache.get_or_compute(memcache_name, render)
 
         return template_text
 
+    @classmethod
+    def prerender_path(cls, cursor_urlsafe=None):
+        if cursor_urlsafe:
+            return '/page/%s' % cursor_urlsafe
+        else:
+            return '/'
+
+    def _render(self, per_page, cursor_urlsafe, is_random, is_featured):
+        template_values = self._get_template_values(
+            per_page, cursor_urlsafe, is_random, is_featured)
+        template = JINJA_ENVIRONMENT.get_template('all.html')
+        return template.render(template_values)
+
     def _get_template_values(self, per_page, cursor_urlsafe, is_random, is_featured):
         if is_random:
             plaques = []
@@ -392,70 +662,83 @@ class ViewOnePlaqueParent(webapp2.RequestHandler):
         plaque, but if the inputs are completely messed up, serve a random
         plaque.
         """
-        is_admin = users.is_current_user_admin()
-        memcache_name = 'view_one_%s_%s' % (plaque_key, is_admin)
+        if users.is_current_user_admin():
+            # Not cached: see ViewPlaquesPage._get.
+            return self._render_from_key(comment_key, plaque_key)
+
+        memcache_name = 'view_one_%s' % plaque_key
         logging.info(
             "memcache name in ViewOnePlaqueParent._get_from_key is %s" %
             memcache_name)
-        page_text = memcache.get(memcache_name)
-        if page_text is None:
-            plaque = None
-            logging.info("plaque_key=%s" % plaque_key)
-            if comment_key is not None:
-                logging.debug("Using comment key")
-                comment = ndb.Key(urlsafe=comment_key).get()
-                plaque = Plaque.query().filter(Plaque.approved == True
-                                      ).filter(Plaque.comments == comment.key
-                                      ).get()
-            elif plaque_key is not None:
-                try:
-                    logging.debug("Trying old_site_id")
-                    old_site_id = int(plaque_key)
-                    plaque = Plaque.query(
-                        ).filter(Plaque.approved == True
-                        ).filter(Plaque.old_site_id == old_site_id
-                        ).get()
-                except ValueError as err:
-                    # Get by title, allowing only admins to see unapproved ones:
-                    logging.debug("Using plaque.title_url: '%s'" % plaque_key)
-                    query = Plaque.query().filter(Plaque.title_url == plaque_key)
-                    if not users.is_current_user_admin():
-                        query = query.filter(Plaque.approved == True)
-                    logging.debug("query is %s " % query)
-                    plaque = query.get()
-                    if plaque is None:
-                        try:
-                            logging.debug("Using plaque_key: '%s'" % plaque_key)
-                            plaque = ndb.Key(urlsafe=plaque_key).get()
-                            logging.debug("Using plaque_key, "
-                                          "plaque retrieved was: '%s'" % plaque)
-                        except:
-                            pass
-
-            if plaque is None:
-                logging.debug("Neither comment_key nor plaque_key is specified. "
-                              "Serve the first plaque, so that memcache will "
-                              "always serve the same thing.")
-                plaque = earliest_approved(Plaque)
-                self.redirect(plaque.title_page_url)
-                return
-
-            template = JINJA_ENVIRONMENT.get_template('one.html')
-            template_values = get_default_template_values(
-                                  plaques=[plaque],
-                                  map_markers_str=get_map_markers_str([plaque]),
-                                  icon_size=32,
-                              )
+        def render():
+            if comment_key is None and plaque_key:
+                page_text = read_prerendered('/plaque/%s' % plaque_key)
+                if page_text is not None:
+                    return page_text
+            return self._render_from_key(comment_key, plaque_key)
+
+        page_text = cache.get_or_compute(memcache_name, render)
+        return page_text
 
-            page_text = template.render(template_values)
-            memcache_status = memcache.set(memcache_name, page_text)
-            if not memcache_status:
-                logging.debug("memcaching for _get_from_key failed for %s" %
-                              memcache_name)
-        else:
-            logging.debug("memcache.get worked for _get_from_key for %s" %
-                          memcache_name)
+    def _render_from_key(self, comment_key=None, plaque_key=None):
+        """
+        Look up the plaque and render its page. Returns None, having
+        redirected to the earliest plaque, if there is no such plaque.
+        """
+        plaque = None
+        logging.info("plaque_key=%s" % plaque_key)
+        if comment_key is not None:
+            logging.debug("Using comment key")
+            comment = ndb.Key(urlsafe=comment_key).get()
+            plaque = Plaque.query().filter(Plaque.approved == True
+                                  ).filter(Plaque.comments == comment.key
+                                  ).get()
+        elif plaque_key is not None:
+            try:
+                logging.debug("Trying old_site_id")
+                old_site_id = int(plaque_key)
+                plaque = Plaque.query(
+                    ).filter(Plaque.approved == True
+                    ).filter(Plaque.old_site_id == old_site_id
+                    ).get()
+            except ValueError as err:
+                # Get by title, allowing only admins to see unapproved ones:
+                logging.debug("Using plaque.title_url: '%s'" % plaque_key)
+                query = Plaque.query().filter(Plaque.title_url == plaque_key)
+                if not users.is_current_user_admin():
+                    query = query.filter(Plaque.approved == True)
+                logging.debug("query is %s " % query)
+                plaque = query.get()
+                if plaque is None:
+                    try:
+                        logging.debug("Using plaque_key: '%s'" % plaque_key)
+                        plaque = ndb.Key(urlsafe=plaque_key).get()
+                        logging.debug("Using plaque_key, "
+                                      "plaque retrieved was: '%s'" % plaque)
+                    except:
+                        pass
+
+        if plaque is None:
+            logging.debug("Neither comment_key nor plaque_key is specified. "
+                          "Serve the first plaque, so that memcache will "
+                          "always serve the same thing.")
+            plaque = earliest_approved(Plaque)
+            self.redirect(plaque.title_page_url)
+            return None
+
+        return self._render_plaque(plaque)
+
+    def _render_plaque(self, plaque, queue=None):
+        template = JINJA_ENVIRONMENT.get_template('one.html')
+        template_values = get_default_template_values(
+                              plaques=[plaque],
+                              nearby=plaque.nearby or [],
+                              map_markers_str=get_map_markers_str([plaque]),
+                              icon_size=32,
+                              queue=queue,
+                          )
 
+        page_text = template.render(template_values)
         return page_text
 
 class AdminLogin(webapp2.RequestHandler):
@@ -510,7 +793,7 @@ class JsonOnePlaque(ViewOnePlaqueParent):
 
         plaque = ndb.Key(urlsafe=plaque_key).get()
         set_featured(plaque)
-        memcache.flush_all()
+        plaques_changed()
         self.response.write(json.dumps(plaque.to_dict(summary=summary)))
 
 class JsonAllPlaques(webapp2.RequestHandler):
@@ -615,9 +898,8 @@ class ViewTag(webapp2.RequestHandler):
         View plaque with a given tag on a grid.
         """
         memcache_name = 'plaque_json_%s' % tag
-        page_text = memcache.get(memcache_name)
 
-        if page_text is None:
+        def render():
             query = Plaque.query()
             if not view_all:
                 query = query.filter(Plaque.approved == True)
@@ -633,15 +915,14 @@ class ViewTag(webapp2.RequestHandler):
                                   plaques=plaques,
                                   map_markers_str=map_markers_str,
                               )
-            page_text = template.render(template_values)
-            memcache_status = memcache.set(memcache_name, page_text)
-            if not memcache_status:
-                logging.debug("ViewTag memcache.set for %s failed" %
-                    memcache_name)
-        else:
-            logging.debug("ViewTag memcache.get worked for %s" %
-                memcache_name)
+            return template.render(template_values)
 
+        # Like ViewPlaquesPage, admin pages and the view_all pages that
+        # include pending plaques aren't cached.
+        if view_all or users.is_current_user_admin():
+            page_text = render()
+        else:
+            page_text = cache.get_or_compute(memcache_name, render)
         self.response.write(page_text)
 
 class About(webapp2.RequestHandler):
@@ -674,6 +955,71 @@ class About(webapp2.RequestHandler):
 #        #email_admin(plaque, comment)
 #        self.redirect(plaque.title_url)
 
+def upload_image(img_name, img_fh, plaque, content_type=None):
+    """
+    Upload pic into GCS, a chunk at a time
+
+    The blobstore.create_gs_key and images.get_serving_url calls are
+    outside of the with block; I think this is correct. The
+    blobstore.create_gs_key call was erroring out on production when it was
+    inside the with block.
+
+    If gcs_fn is specified, overwrite that gcs filename. This is used
+    for updating the picture.
+    """
+
+#       Turn this off while Tony Bonomolo is editing:
+#
+#        # Kill old image and URL, if they exist. Tolerate failure in case
+#        # this is a redo:
+#        if plaque.pic is not None:
+#            try:
+#                gcs.delete(plaque.pic)
+#            except:
+#                pass
+#        if plaque.img_url is not None:
+#            try:
+#                images.delete_serving_url(plaque.img_url)
+#            except:
+#                pass
+
+    # Make GCS filename
+    date_slash_time = datetime.datetime.now().strftime("%Y%m%d/%H%M%S")
+    gcs_filename = '%s/%s/%s' % (GCS_BUCKET, date_slash_time, img_name)
+    plaque.pic = gcs_filename
+
+    # Write image to GCS
+    try:
+        ct, op = gcs_extras(img_name)
+        with gcs.open(gcs_filename, 'w', content_type=content_type or ct,
+                      options=op) as fh:
+            for chunk in iter(lambda: img_fh.read(GCS_WRITE_CHUNK_BYTES),
+                              b''):
+                fh.write(chunk)
+    except AttributeError:
+        submit_err = SubmitError("The image for the plaque was not "
+                                 "specified-- please click the back button "
+                                 "and resubmit.")
+        logging.error(submit_err)
+        raise submit_err
+
+    # Make serving_url for image:
+    blobstore_gs_key = blobstore.create_gs_key('/gs' + gcs_filename)
+    plaque.img_url = images.get_serving_url(blobstore_gs_key)
+
+def gcs_extras(img_name):
+    """Hide this here to clarify what upload_image is doing."""
+    ct = 'image/jpeg'
+    try:
+        if ct is None:
+            guess_type = mimetypes.guess_type(img_name)
+            if len(guess_type) > 0:
+                ct = guess_type[0]
+    except:
+        pass
+    op = {b'x-goog-acl': b'public-read'}
+    return ct, op
+
 class AddPlaque(webapp2.RequestHandler):
     """
     Add a plaque entity. Transactional in the _post method.
@@ -711,7 +1057,7 @@ class AddPlaque(webapp2.RequestHandler):
         template = JINJA_ENVIRONMENT.get_template('add.html')
         self.response.write(template.render(template_values))
 
-    @ndb.transactional
+    @ndb.transactional(xg=True) # for the counters
     def post(self, is_edit=False):
         """
         We set the same parent key on the 'Plaque' to ensure each Plauqe is in
@@ -733,13 +1079,17 @@ class AddPlaque(webapp2.RequestHandler):
             plaque = self._create_or_update_plaque(is_edit, plaqueset_key)
             logging.info("Plaque %s is added with is_edit %s." %
                 (plaque.title, is_edit))
+            if plaque.approved:
+                after_commit(plaques_changed)
+                after_commit(Suggest.plaque_approved, plaque)
+            if plaque.approved or is_edit:
+                queue_nearby_update(plaque)
 
             # Make the plaque searchable:
             #
             logging.info('making search document')
             try:
-                plaque_search_index = search.Index(PLAQUE_SEARCH_INDEX_NAME)
-                plaque_search_index.put(plaque.to_search_document())
+                index_plaques([plaque])
             except search.Error as err:
                 logging.error(err)
                 raise err
@@ -787,12 +1137,21 @@ class AddPlaque(webapp2.RequestHandler):
         """
         if not is_edit:
             plaque = Plaque(parent=plaqueset_key)
+            was_approved = None
         else:
             plaque_key = self.request.get('plaque_key')
             plaque = ndb.Key(urlsafe=plaque_key).get()
-
-        location, created_by, title, description, img_name, img_fh, tags = \
-            self._get_form_args()
+            was_approved = plaque.approved
+            if was_approved:
+                # Take the old title and tags out of the suggestions; post()
+                # puts the new ones in if it's still approved.
+                old_plaque = Plaque(title=plaque.title,
+                                    title_url=plaque.title_url,
+                                    tags=list(plaque.tags))
+                after_commit(Suggest.plaque_removed, old_plaque)
+
+        location, created_by, title, description, img_name, img_fh, tags, \
+            img_source_url = self._get_form_args()
 
         plaque.location = location
         plaque.title = title
@@ -803,10 +1162,13 @@ class AddPlaque(webapp2.RequestHandler):
         plaque.updated_on = datetime.datetime.now()
 
         # Upload the image for a new plaque, or update the image for an
-        # editted plaque, if specified.
+        # editted plaque, if specified. An image given by URL is fetched
+        # afterwards, by a task (see ImageFetch.py).
         is_upload_pic = (is_edit and img_name is not None) or (not is_edit)
-        if is_upload_pic:
-            self._upload_image(img_name, img_fh, plaque)
+        if img_source_url is not None:
+            ImageFetch.queue_image(plaque, img_source_url)
+        elif is_upload_pic:
+            upload_image(img_name, img_fh, plaque)
 
         # Write to the updated_* fields if this is an edit:
         #
@@ -828,6 +1190,9 @@ class AddPlaque(webapp2.RequestHandler):
                 logging.info('Eating bad ValueError for '
                              'old_site_id in AddPlaque')
         plaque.put()
+        update_state_counters(was_approved, plaque.approved)
+        if img_source_url is not None:
+            ImageFetch.queue_fetches([plaque.key], transactional=True)
         return plaque
 
     def _get_form_args(self):
@@ -838,15 +1203,12 @@ class AddPlaque(webapp2.RequestHandler):
 
         if lat is None or lng is None or lat == '' or lng == '':
             geo_search_term = self.request.get('searchfield')
-            geo_url = 'http://maps.googleapis.com/maps/api/geocode/'
-            url = geo_url + 'json?address=' + geo_search_term
-            geo_fh = urllib.urlopen(url)
-            geo_json = json.load(geo_fh)
-
-            if geo_json['results']:
-                loc_json = geo_json['results'][0]['geometry']['location']
-                lat = loc_json['lat']
-                lng = loc_json['lng']
+            location = Geocode.geocode(geo_search_term)
+            if location is None:
+                raise SubmitError("The location '%s' couldn't be found. "
+                                  "Please click the back button and mark "
+                                  "it on the map." % geo_search_term)
+            lat, lng = location.lat, location.lon
 
         try:
             location = ndb.GeoPt(lat, lng)
@@ -870,16 +1232,18 @@ class AddPlaque(webapp2.RequestHandler):
 
         # Prefer the file to the URL, if both are given.
         #
+        img_name = None
+        img_fh = None
+        img_source_url = None
         if img_file != '' and img_file is not None:
             img_name = img_file.filename
             img_fh = img_file.file
-        elif img_url != '':
-            img_name = os.path.basename(img_url)
-            img_fh = urllib.urlopen(img_url)
-        else:
-            img_name = None
-            img_fh = None
-            #don't do anything (for edits where the image isn't being updated)
+        elif img_url:
+            if not Importer.URL_RE.match(img_url):
+                raise SubmitError("The image URL '%s' isn't an http or "
+                                  "https URL." % img_url)
+            img_source_url = img_url
+        #else don't do anything (for edits where the image isn't being updated)
 
         # Get and tokenize tags
         tags_str = self.request.get('tags')
@@ -887,70 +1251,8 @@ class AddPlaque(webapp2.RequestHandler):
         tags = [re.sub(r'\s+', ' ', t.strip().lower()) for t in tags_split]
         tags = [t for t in tags if t] # Remove empties
 
-        return location, created_by, title, description, img_name, img_fh, tags
-
-    def _upload_image(self, img_name, img_fh, plaque):
-        """
-        Upload pic into GCS
-
-        The blobstore.create_gs_key and images.get_serving_url calls are
-        outside of the with block; I think this is correct. The
-        blobstore.create_gs_key call was erroring out on production when it was
-        inside the with block.
-
-        If gcs_fn is specified, overwrite that gcs filename. This is used
-        for updating the picture.
-        """
-
-#       Turn this off while Tony Bonomolo is editing:
-#
-#        # Kill old image and URL, if they exist. Tolerate failure in case
-#        # this is a redo:
-#        if plaque.pic is not None:
-#            try:
-#                gcs.delete(plaque.pic)
-#            except:
-#                pass
-#        if plaque.img_url is not None:
-#            try:
-#                images.delete_serving_url(plaque.img_url)
-#            except:
-#                pass
-
-        # Make GCS filename
-        date_slash_time = datetime.datetime.now().strftime("%Y%m%d/%H%M%S")
-        gcs_filename = '%s/%s/%s' % (GCS_BUCKET, date_slash_time, img_name)
-        plaque.pic = gcs_filename
-
-        # Write image to GCS
-        try:
-            ct, op = self._gcs_extras(img_name)
-            with gcs.open(gcs_filename, 'w', content_type=ct, options=op) as fh:
-                img_contents = img_fh.read()
-                fh.write(img_contents)
-        except AttributeError:
-            submit_err = SubmitError("The image for the plaque was not "
-                                     "specified-- please click the back button "
-                                     "and resubmit.")
-            logging.error(submit_err)
-            raise submit_err
-
-        # Make serving_url for image:
-        blobstore_gs_key = blobstore.create_gs_key('/gs' + gcs_filename)
-        plaque.img_url = images.get_serving_url(blobstore_gs_key)
-
-    def _gcs_extras(self, img_name):
-        """Hide this here to clarify what _upload_image is doing."""
-        ct = 'image/jpeg'
-        try:
-            if ct is None:
-                guess_type = mimetypes.guess_type(img_name)
-                if len(guess_type) > 0:
-                    ct = guess_type[0]
-        except:
-            pass
-        op = {b'x-goog-acl': b'public-read'}
-        return ct, op
+        return location, created_by, title, description, img_name, img_fh, \
+               tags, img_source_url
 
 class EditPlaque(AddPlaque):
     """
@@ -983,6 +1285,27 @@ class EditPlaque(AddPlaque):
             super(EditPlaque, self).post(is_edit=True)
 
 
+def plaques_from_results(results):
+    """
+    The plaques for a page of search results, in order. They are made from
+    the documents' summaries; only documents indexed before summaries were
+    added need a datastore read.
+    """
+    summaries = results.get('summaries', {})
+    missing = [ndb.Key(urlsafe=doc_id) for doc_id in results['doc_ids']
+               if doc_id not in summaries]
+    fetched = dict((p.key.urlsafe(), p) for p in ndb.get_multi(missing)
+                   if p is not None)
+
+    plaques = []
+    for doc_id in results['doc_ids']:
+        if doc_id in summaries:
+            plaques.append(
+                Plaque.from_search_summary(doc_id, summaries[doc_id]))
+        elif doc_id in fetched:
+            plaques.append(fetched[doc_id])
+    return plaques
+
 class SearchPlaques(webapp2.RequestHandler):
     """Run a search in the title and description."""
     def post(self):
@@ -991,21 +1314,42 @@ class SearchPlaques(webapp2.RequestHandler):
 
     def get(self, search_term=None):
         logging.debug('search term is "%s"' % search_term)
-        if search_term is None:
-            plaques = []
-        else:
-            search_term = '"%s"' % search_term.replace('"', '')
-            plaque_search_index = search.Index(PLAQUE_SEARCH_INDEX_NAME)
-            results = plaque_search_index.search(search_term)
-            logging.debug('search results are "%s"' % results)
-            plaques = [ndb.Key(urlsafe=r.doc_id).get() for r in results]
-            plaques = [p for p in plaques if p is not None]
+        cursor_websafe = self.request.get('cursor') or None
+        sort = self.request.get('sort', SORT_RELEVANCE)
+        try:
+            limit = int(self.request.get('limit', DEF_SEARCH_LIMIT))
+        except ValueError:
+            limit = DEF_SEARCH_LIMIT
+
+        plaques = []
+        snippets = {}
+        next_page_url = None
+        if search_term is not None:
+            try:
+                results = search_plaques(search_term, cursor_websafe,
+                                         limit=limit, sort=sort)
+            except search.Error as err:
+                logging.error(err)
+                results = None
+
+            if results is not None:
+                plaques = plaques_from_results(results)
+                snippets = results['snippets']
+                if results['next_cursor']:
+                    next_page_url = '/search/%s?%s' % (
+                        urllib.quote(search_term.encode('utf-8')),
+                        urllib.urlencode({'cursor': results['next_cursor'],
+                                          'sort': sort,
+                                          'limit': limit}))
 
         template = JINJA_ENVIRONMENT.get_template('all.html')
         map_markers_str = get_map_markers_str(plaques)
         template_values = get_default_template_values(
                               plaques=plaques,
                               map_markers_str=map_markers_str,
+                              snippets=snippets,
+                              more=next_page_url is not None,
+                              next_page_url=next_page_url,
                           )
         self.response.write(template.render(template_values))
 
@@ -1024,15 +1368,27 @@ class SearchPlaquesGeo(webapp2.RequestHandler):
         self.response.write(template.render(template_values))
 
     def _serve_response(self, lat, lng, search_radius_meters):
-        plaque_search_index = search.Index(PLAQUE_SEARCH_INDEX_NAME)
+        try:
+            lat = float(lat)
+            lng = float(lng)
+            search_radius_meters = float(search_radius_meters)
+        except ValueError:
+            raise SubmitError(
+                    "The search area wasn't specified correctly ((%s, %s) < %s)"
+                    ". Please try again." % (lat, lng, search_radius_meters))
 
-        query_string = 'distance(location, geopoint(%s, %s)) < %s' % (
-                        lat, lng, search_radius_meters)
-        query = search.Query(query_string)
-        results = plaque_search_index.search(query)
-        plaques = [ndb.Key(urlsafe=r.doc_id).get() for r in results]
-        geo_plaques_approved = [p for p in plaques
-            if p is not None and p.approved]
+        # ?engine=searchapi runs the old Search API query, to compare.
+        if self.request.get('engine') == 'searchapi':
+            doc_ids = geo_search_plaques(lat, lng, search_radius_meters)
+            plaques = ndb.get_multi([ndb.Key(urlsafe=d) for d in doc_ids])
+            geo_plaques_approved = [p for p in plaques if p is not None]
+        else:
+            try:
+                hits = Plaque.within_radius(lat, lng, search_radius_meters,
+                                            num=MAX_NUM_GEO_RESULTS)
+            except ValueError as err:
+                raise SubmitError("%s. Please try a smaller area." % err)
+            geo_plaques_approved = [plaque for plaque, distance in hits]
 
         map_markers_str = get_map_markers_str(geo_plaques_approved)
 
@@ -1070,13 +1426,67 @@ class SearchPlaquesGeo(webapp2.RequestHandler):
             raise err
         self.get(lat, lng, search_radius_meters, redir=True)
 
+class NearbyPlaques(webapp2.RequestHandler):
+    """The plaques nearest to a point, nearest first."""
+    def get(self, lat, lng, num=None):
+        try:
+            lat = float(lat)
+            lng = float(lng)
+            num = int(num) if num else DEF_NUM_NEARBY
+        except ValueError:
+            raise SubmitError("The location (%s, %s) wasn't understood. "
+                              "Please try again." % (lat, lng))
+        num = max(1, min(num, MAX_NUM_NEARBY))
+
+        hits = Plaque.nearest(lat, lng, num)
+        plaques = [plaque for plaque, distance in hits]
+
+        template = JINJA_ENVIRONMENT.get_template('all.html')
+        template_values = get_default_template_values(
+                              plaques=plaques,
+                              map_markers_str=get_map_markers_str(plaques),
+                              mapcenter={'lat': lat, 'lng': lng},
+                          )
+        self.response.write(template.render(template_values))
+
+class JsonBboxPlaques(webapp2.RequestHandler):
+    """Summary JSON for the approved plaques inside a bounding box."""
+    def get(self, south, west, north, east):
+        try:
+            south, west, north, east = [float(x) for x in
+                                         (south, west, north, east)]
+        except ValueError:
+            self.abort(400)
+
+        plaques = Plaque.within_bbox(south, west, north, east,
+                                     num=MAX_NUM_GEO_RESULTS)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps([p.to_dict(summary=True)
+                                        for p in plaques]))
+
+class SuggestPlaques(webapp2.RequestHandler):
+    """Search-as-you-type: JSON titles and tags completing ?q=."""
+    def get(self):
+        try:
+            num = int(self.request.get('n', Suggest.DEF_NUM_SUGGESTIONS))
+        except ValueError:
+            num = Suggest.DEF_NUM_SUGGESTIONS
+        suggestions = Suggest.suggest(self.request.get('q'), num)
+
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.headers['Cache-Control'] = 'public, max-age=%s' % (
+            SUGGEST_MAX_AGE_SECONDS)
+        self.response.write(json.dumps(suggestions))
+
 class FlushMemcache(webapp2.RequestHandler):
     def get(self):
         memcache.flush_all()
+        plaques_changed()
         self.redirect('/')
 
     def post(self):
         memcache.flush_all()
+        plaques_changed()
         self.redirect('/')
 
 class Counts(webapp2.RequestHandler):
@@ -1117,7 +1527,7 @@ class DeleteOnePlaque(webapp2.RequestHandler):
     def get(self):
         raise NotImplementedError("no get in DeleteOnePlaque")
 
-    @ndb.transactional
+    @ndb.transactional(xg=True) # for the counters
     def post(self):
         """Remove one plaque and its associated Comments and GCS image."""
         user = users.get_current_user()
@@ -1133,20 +1543,22 @@ class DeleteOnePlaque(webapp2.RequestHandler):
 
         for comment in plaque.comments:
             comment.delete()
+        if plaque.pic:
+            try:
+                gcs.delete(plaque.pic)
+            except gcs.NotFoundError:
+                logging.warning("no image %s to delete" % plaque.pic)
+
         try:
-            gcs.delete(plaque.pic)
-
-            # Delete search index for this document
-            plaque_search_index = search.Index(PLAQUE_SEARCH_INDEX_NAME)
-            results = plaque_search_index.search(search_term)
-            for result in results:
-                plaques = [ndb.Key(urlsafe=r.doc_id).get() for r in results]
-                plaque_search_index.delete(result.doc_id)
-        except:
-            pass
+            unindex_plaques([plaque.key.urlsafe()])
+        except search.Error as err:
+            logging.error("search document delete failed: %s" % err)
 
         plaque.key.delete()
-        #memcache.flush_all()
+        update_state_counters(plaque.approved, None)
+        after_commit(plaques_changed)
+        queue_nearby_update(plaque)
+        after_commit(Suggest.plaque_removed, plaque)
         email_admin('%s Deleted plaque %s' % (name, plaque.title_url),
                     '%s Deleted plaque %s' % (name, plaque.title_url))
         self.redirect('/nextpending')
@@ -1178,10 +1590,50 @@ class DeleteOnePlaque(webapp2.RequestHandler):
 #        self.response.write(msg)
 
 class ViewNextPending(ViewOnePlaqueParent):
+    """
+    The moderation queue: the next pending plaque after ?cursor=. The
+    following MODERATION_PREFETCH plaques are loaded along with it, which
+    leaves them in ndb's cache, and the page has the browser prerender the
+    next one and fetch their images while the reviewer reads this one.
+    """
     def get(self):
-        plaque = Plaque.pending_list(1)[0]
-        page_text = self._get_from_key(plaque_key=plaque.key.urlsafe())
-        self.response.write(page_text)
+        cursor_urlsafe = self.request.get('cursor')
+        cursor = Cursor(urlsafe=cursor_urlsafe) if cursor_urlsafe else None
+        queue = Plaque.pending_queue(1 + MODERATION_PREFETCH, cursor)
+        if not queue:
+            # Past the end of the queue: start again from the top, where
+            # plaques submitted since may be waiting.
+            self.redirect('/nextpending' if cursor else '/pending')
+            return
+
+        # Skip any that have been deleted or approved since the query's
+        # index was written.
+        last_cursor = queue[-1][1]
+        queue = [(plaque, after) for plaque, (_, after) in
+                 zip(ndb.get_multi([key for key, _ in queue]), queue)
+                 if plaque is not None and not plaque.approved]
+        if not queue:
+            self.redirect('/nextpending?cursor=%s' % last_cursor.urlsafe())
+            return
+
+        plaque = queue[0][0]
+        next_cursor = queue[0][1].urlsafe()
+        queue_values = {
+            'cursor': next_cursor,
+            'next_url': '/nextpending?cursor=%s' % next_cursor,
+            'has_next': len(queue) > 1,
+            'prefetch_images': [p.img_url_display for p, _ in queue[1:]
+                                if p.img_url],
+        }
+        self.response.headers['Cache-Control'] = 'private, no-cache'
+        self.response.write(self._render_plaque(plaque, queue=queue_values))
+
+class PendingCount(webapp2.RequestHandler):
+    """The number of pending plaques as JSON, for the admin badge to poll."""
+    def get(self):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.headers['Cache-Control'] = 'private, no-cache'
+        self.response.write(json.dumps({'num_pending': Plaque.num_pending()}))
 
 class ViewPending(webapp2.RequestHandler):
     def get(self, num=DEF_NUM_PENDING):
@@ -1205,72 +1657,228 @@ class ViewPending(webapp2.RequestHandler):
 
 class DeleteOneSearchIndex(webapp2.RequestHandler):
     def get(self, doc_id):
-        plaque_search_index = search.Index(PLAQUE_SEARCH_INDEX_NAME)
         try:
-            plaque_search_index.delete(doc_id)
+            unindex_plaques([doc_id])
         except search.Error:
             msg = "Error removing doc id %s" % doc_id
             logging.exception(msg)
             self.response.write(msg)
 
-class AddSearchIndexAll(webapp2.RequestHandler):
+class ReindexSearch(webapp2.RequestHandler):
+    """
+    Start rebuilding the search index as a new version, in the background,
+    and show how far the latest rebuild has got.
+    """
     def get(self):
-        plaques = Plaque.query().fetch()
-        plaque_search_index = search.Index(PLAQUE_SEARCH_INDEX_NAME)
-        igood = 0
-        ibad = 0
-        for plaque in plaques:
-            try:
-                plaque_search_index.put(plaque.to_search_document())
-                igood += 1
-            except search.Error as err:
-                ibad += 1
-                logging.error(err)
-            logging.debug('in process: wrote %s good docs, %s failed' % (
-                          igood, ibad))
-        self.response.write('wrote %s good docs, %s failed' % (igood, ibad))
+        if self.request.get('start'):
+            index_name = start_reindex()
+            if index_name is None:
+                self.response.write("A reindex is already running.\n\n")
+            else:
+                self.response.write("Started building %s.\n\n" % index_name)
+
+        config, shards = reindex_status()
+        lines = ["live index: %s (previous: %s, swapped on %s)" % (
+                     config.active_name, config.previous_name,
+                     config.swapped_on),
+                 "building: %s (started on %s)" % (
+                     config.building_name, config.started_on)]
+        for shard in shards:
+            lines.append("%s: %s docs, %s failed, %s" % (
+                shard.key.id(), shard.num_docs, shard.num_failed,
+                "done" if shard.done else "running"))
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write("\n".join(lines))
+
+class CheckSearchIndex(webapp2.RequestHandler):
+    """
+    Task: compare the search index with the datastore and fix any
+    differences. Add ?fix=0 to only report them.
+    """
+    def get(self):
+        counts = check_index(fix=self.request.get('fix') != '0')
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write("\n".join(
+            "%s: %s" % item for item in sorted(counts.items())))
 
-class RedoIndex(webapp2.RequestHandler):
+class RecountPlaques(webapp2.RequestHandler):
+    """
+    Task: count the approved and pending plaques with queries and reset
+    their counters, correcting any drift.
+    """
     def get(self):
-        plaque_search_index = search.Index(PLAQUE_SEARCH_INDEX_NAME)
-        ideleted = 0
-        # Delete all the search documents
-        while True:
-            # Get a list of documents populating only the doc_id field and
-            # extract the ids.
-            document_ids = [
-                document.doc_id for document
-                    in plaque_search_index.get_range(ids_only=True)]
-            ideleted += len(document_ids)
-            if not document_ids:
-                break
-            # Delete the documents for the given ids from the Index.
-            plaque_search_index.delete(document_ids)
-        logging.debug('deleted %s search index docs' % ideleted)
+        num_approved = Plaque.count_approved()
+        num_pending = Plaque.count_pending()
+        Counter.reset(NUM_APPROVED_COUNTER, num_approved)
+        Counter.reset(NUM_PENDING_COUNTER, num_pending)
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write("approved: %s\npending: %s" % (
+            num_approved, num_pending))
+
+class ImportPlaques(webapp2.RequestHandler):
+    """
+    POST /api/import: a batch of plaques as NDJSON (see Importer.py), with
+    an API key in an "Authorization: Bearer <key>" header. Returns each
+    line's status as JSON.
+    """
+    def post(self):
+        auth = self.request.headers.get('Authorization', '')
+        key_string = auth[len('Bearer '):] if auth.startswith('Bearer ') \
+                     else None
+        api_key = ApiKey.check(key_string)
+        if api_key is None:
+            self.abort(401, detail="A valid API key is needed")
 
-        # Write all new search docs and put them in the index
-        plaques = Plaque.query().fetch()
-        docs = []
-        igood = 0
-        ibad = 0
+        try:
+            results, updated = Importer.import_batch(
+                self.request.body.splitlines(), get_plaqueset_key(),
+                api_key.name)
+        except Importer.InvalidItem as err:
+            self.abort(400, detail=str(err))
+
+        if updated:
+            update_search_index(updated)
+            approved = [p for p in updated if p.approved]
+            if approved:
+                queue_nearby_updates(approved)
+                Suggest.queue_rebuild()
+                plaques_changed()
+
+        counts = defaultdict(int)
+        for result in results:
+            counts[result['status']] += 1
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({'counts': counts,
+                                        'results': results}))
+
+class SourceManifest(webapp2.RequestHandler):
+    """
+    GET /api/sources/<source>?cursor=: what has been imported from a
+    source, as a page of {source_id: content_hash} in JSON, so a scraper
+    only needs to send what's new or changed. Needs the same API key as
+    /api/import.
+    """
+    def get(self, source):
+        auth = self.request.headers.get('Authorization', '')
+        key_string = auth[len('Bearer '):] if auth.startswith('Bearer ') \
+                     else None
+        if ApiKey.check(key_string) is None:
+            self.abort(401, detail="A valid API key is needed")
+
+        manifest, cursor = Importer.source_manifest(
+            source, self.request.get('cursor') or None)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({'records': manifest,
+                                        'cursor': cursor}))
+
+class NewApiKey(webapp2.RequestHandler):
+    """Make an import API key, /api/newkey?name=<who it's for>."""
+    def get(self):
+        key_string = base64.urlsafe_b64encode(os.urandom(24))
+        ApiKey(id=ApiKey.id_for(key_string),
+               name=self.request.get('name') or None,
+               created_by=users.get_current_user()).put()
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write(key_string)
+
+@ndb.transactional(xg=True)
+def _save_image_fetches(updates):
+    """
+    Apply the outcome of fetching some plaques' images, unless a plaque has
+    been given a different image since. Returns the plaques saved.
+    """
+    plaques = ndb.get_multi(updates.keys())
+    saved = []
+    for plaque in plaques:
+        if plaque is None:
+            continue
+        img_source_url, values = updates[plaque.key]
+        if plaque.img_fetch_status != 'queued' or \
+           plaque.img_source_url != img_source_url:
+            continue
+        plaque.populate(**values)
+        saved.append(plaque)
+    ndb.put_multi(saved)
+    return saved
+
+class FetchImages(webapp2.RequestHandler):
+    """
+    Task: fetch a batch of plaques' images into GCS, all at once. See
+    ImageFetch.py.
+    """
+    def post(self):
+        keys = [ndb.Key(urlsafe=k) for k in self.request.get_all('plaque_key')]
+        plaques = [p for p in ndb.get_multi(keys)
+                   if p is not None and p.img_fetch_status == 'queued']
+        if not plaques:
+            return
+        fetched = ImageFetch.fetch_many(
+            sorted(set(p.img_source_url for p in plaques)))
+
+        # The images are written to GCS here, outside the transaction.
+        updates = {}
+        retries = defaultdict(list) # attempts -> plaque keys
+        old_pics = {}
         for plaque in plaques:
-            try:
-                docs.append(plaque.to_search_document())
-                igood += 1
-            except search.Error as err:
-                ibad += 1
-                logging.error(err)
-            #if ip % 100 == 0:
-                #logging.debug('in process: wrote %s good docs, %s failed' % (
-                              #igood, ibad))
-        iput = 0
-        for i in range(0, len(docs), 100):
-            iput += 100
-            plaque_search_index.put(docs[i:i+100])
-
-        self.response.write(
-            'deleted %s docs, created %s, failed to create %s, put %s' % (
-            ideleted, igood, ibad, iput))
+            result = fetched[plaque.img_source_url]
+            if isinstance(result, ImageFetch.FetchError):
+                attempts = plaque.img_fetch_attempts + 1
+                error = unicode(result)
+                values = {'img_fetch_attempts': attempts,
+                          'img_fetch_error': error[:500]}
+                if result.transient and attempts < ImageFetch.MAX_ATTEMPTS:
+                    logging.warning("image fetch attempt %s failed: %s" % (
+                                    attempts, error))
+                    retries[attempts].append(plaque.key)
+                else:
+                    logging.error("image fetch failed: %s" % error)
+                    values['img_fetch_status'] = 'failed'
+                updates[plaque.key] = (plaque.img_source_url, values)
+                continue
+
+            old_pics[plaque.key] = plaque.pic
+            # The batch is uploaded within a second or so, and names like
+            # image.jpg are common, so the plaque's id keeps them apart.
+            img_name = '%s-%s' % (plaque.key.id(), result.name)
+            upload_image(img_name, StringIO.StringIO(result.content),
+                         plaque, result.content_type)
+            updates[plaque.key] = (plaque.img_source_url, {
+                'pic': plaque.pic,
+                'img_url': plaque.img_url,
+                'img_fetch_status': 'done',
+                'img_fetch_error': None,
+            })
+
+        saved = dict((p.key, p) for p in _save_image_fetches(updates))
+        for attempts, retry_keys in retries.items():
+            ImageFetch.queue_fetches(
+                [k for k in retry_keys if k in saved],
+                countdown=ImageFetch.retry_countdown(attempts))
+
+        done = [p for p in plaques if p.key in old_pics]
+        for plaque in done:
+            # The plaque's new image, if it was saved, or else its old one.
+            unused_pic = old_pics[plaque.key] if plaque.key in saved \
+                         else plaque.pic
+            if unused_pic:
+                try:
+                    gcs.delete(unused_pic)
+                except gcs.NotFoundError:
+                    logging.warning("no image %s to delete" % unused_pic)
+
+        done = [saved[p.key] for p in done if p.key in saved]
+        if done:
+            update_search_index(done)
+            approved = [p for p in done if p.approved]
+            if approved:
+                # The nearby lists show the plaques' images.
+                queue_nearby_updates(approved)
+                plaques_changed()
+
+class ReindexShardTask(webapp2.RequestHandler):
+    """Task: carry on with one shard of a reindex."""
+    def post(self):
+        run_reindex_shard(self.request.get('shard'))
 
 class AddTitleUrlAll(webapp2.RequestHandler):
     def get(self):
@@ -1278,54 +1886,495 @@ class AddTitleUrlAll(webapp2.RequestHandler):
         for plaque in plaques:
             plaque.set_title_url()
             plaque.put()
-        memcache.flush_all()
+        plaques_changed()
         self.redirect('/')
 
 class ApproveAllPending(webapp2.RequestHandler):
-    """Approve all pending plaques"""
+    """Approve all pending plaques, with a bulk moderation job."""
     def get(self):
         #raise NotImplementedError("Turned off")
-        plaques = Plaque.pending_list(num=500)
-        for plaque in plaques:
+        job = start_moderation_job('approve', filter='pending')
+        self.redirect('/moderate/%s' % job.key.id())
+
+def start_moderation_job(action, plaque_keys=None, filter=None):
+    """
+    Start a bulk moderation job on a list of urlsafe plaque keys or on the
+    plaques matching a filter (see ModerationJob).
+    """
+    if action not in ModerationJob.ACTIONS:
+        raise SubmitError("Unknown moderation action '%s'" % action)
+    if not plaque_keys and filter not in ('pending', 'approved') and \
+       not (filter or '').startswith('tag:'):
+        raise SubmitError("Give plaque keys or a filter of pending, "
+                          "approved or tag:<tag>")
+
+    job = ModerationJob(action=action,
+                        plaque_keys=[ndb.Key(urlsafe=k)
+                                     for k in plaque_keys or []],
+                        filter=None if plaque_keys else filter,
+                        created_by=users.get_current_user())
+    job.put()
+    taskqueue.add(url=MODERATION_TASK_URL, params={'job_id': job.key.id()})
+    return job
+
+def _moderation_batch_keys(job):
+    """The keys of a job's next batch, and whether there are more after it."""
+    if job.filter is None:
+        end = job.position + MODERATION_BATCH_SIZE
+        return job.plaque_keys[job.position:end], end < len(job.plaque_keys)
+
+    # An ancestor query, so that it's consistent with the batches already
+    # written, walked in key order so that changing the plaques doesn't
+    # move the place it has got to.
+    query = Plaque.query(ancestor=get_plaqueset_key())
+    if job.filter == 'pending':
+        query = query.filter(Plaque.approved == False)
+    elif job.filter == 'approved':
+        query = query.filter(Plaque.approved == True)
+    else:
+        query = query.filter(Plaque.tags == job.filter[len('tag:'):])
+    if job.last_key is not None:
+        query = query.filter(Plaque.key > job.last_key)
+    keys = query.order(Plaque.key).fetch(MODERATION_BATCH_SIZE + 1,
+                                         keys_only=True)
+    return keys[:MODERATION_BATCH_SIZE], len(keys) > MODERATION_BATCH_SIZE
+
+@ndb.transactional
+def _moderate_batch(action, keys):
+    """
+    Apply an action to one batch of plaques in one transaction, and return
+    the ones it changed.
+    """
+    plaques = [p for p in ndb.get_multi(keys) if p is not None]
+    if action == 'approve':
+        changed = [p for p in plaques if not p.approved]
+        for plaque in changed:
             plaque.approved = True
-            plaque.put()
-        memcache.flush_all()
-        self.redirect('/')
+        ndb.put_multi(changed)
+    elif action == 'disapprove':
+        changed = [p for p in plaques if p.approved]
+        for plaque in changed:
+            plaque.approved = False
+        ndb.put_multi(changed)
+    else:
+        changed = plaques
+        comment_keys = [k for p in plaques for k in p.comments]
+        ndb.delete_multi([p.key for p in plaques] + comment_keys)
+    return changed
+
+def _delete_images(plaques):
+    for plaque in plaques:
+        if plaque.pic:
+            try:
+                gcs.delete(plaque.pic)
+            except gcs.NotFoundError:
+                logging.warning("no image %s to delete" % plaque.pic)
+
+def _after_moderation(action, plaques, timed):
+    """Bring everything that depends on the plaques up to date, in bulk."""
+    num_approved = len([p for p in plaques if p.approved])
+    num_pending = len(plaques) - num_approved
+    if action == 'approve':
+        timed('search', update_search_index, plaques)
+        timed('suggest', Suggest.plaques_approved, plaques)
+        counts = [(False, True, len(plaques))]
+    elif action == 'disapprove':
+        timed('search', update_search_index, plaques)
+        timed('suggest', Suggest.plaques_removed, plaques)
+        counts = [(True, False, len(plaques))]
+    else:
+        timed('images', _delete_images, plaques)
+        try:
+            timed('search', unindex_plaques,
+                  [p.key.urlsafe() for p in plaques])
+        except search.Error as err:
+            logging.error("search document delete failed: %s" % err)
+        timed('suggest', Suggest.plaques_removed,
+              [p for p in plaques if p.approved])
+        counts = [(True, None, num_approved), (False, None, num_pending)]
+
+    def update_counters():
+        for was_approved, is_approved, num in counts:
+            update_state_counters(was_approved, is_approved, num)
+    timed('counters', update_counters)
+    timed('nearby', queue_nearby_updates, plaques)
+    timed('caches', plaques_changed)
+
+def run_moderation_job(job_id):
+    """
+    Work through a job's batches for up to MODERATION_TASK_SECONDS,
+    checkpointing after each one, then queue this again to carry on.
+    """
+    job = ModerationJob.get_by_id(job_id)
+    if job is None or job.done:
+        return
+
+    timings = job.timings or {}
+    def timed(stage, func, *args):
+        start = time.time()
+        result = func(*args)
+        timings[stage] = timings.get(stage, 0) + time.time() - start
+        return result
+
+    start = time.time()
+    while not job.done and time.time() - start < MODERATION_TASK_SECONDS:
+        keys, more = timed('fetch', _moderation_batch_keys, job)
+        changed = []
+        if keys:
+            changed = timed('write', _moderate_batch, job.action, keys)
+        if changed:
+            _after_moderation(job.action, changed, timed)
+
+        job.position += len(keys)
+        if keys:
+            job.last_key = keys[-1]
+        job.num_done += len(changed)
+        job.num_skipped += len(keys) - len(changed)
+        job.num_batches += 1
+        job.done = not more
+        job.timings = timings
+        job.put()
+        logging.info("moderation job %s: %s" % (job_id, job.to_dict()))
+
+    if not job.done:
+        taskqueue.add(url=MODERATION_TASK_URL, params={'job_id': job_id})
+
+class BulkModerate(webapp2.RequestHandler):
+    """
+    POST /moderate with action (approve, disapprove or delete) and either
+    plaque_key (repeated) or filter (pending, approved or tag:<tag>) starts
+    a bulk moderation job. GET /moderate/<job_id> reports its progress.
+    Both return the job as JSON.
+    """
+    def get(self, job_id=None):
+        try:
+            job = ModerationJob.get_by_id(int(job_id))
+        except (TypeError, ValueError):
+            job = None
+        if job is None:
+            self.abort(404)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(job.to_dict()))
+
+    def post(self, job_id=None):
+        action = self.request.get('action')
+        if action == 'delete':
+            user = users.get_current_user()
+            name = "anon" if user is None else user.nickname()
+            if name != 'kester':
+                email_admin('Delete warning!',
+                            '%s tried to bulk delete' % name)
+                raise NotImplementedError("delete is turned off for now")
+
+        job = start_moderation_job(action,
+                                   self.request.get_all('plaque_key'),
+                                   self.request.get('filter') or None)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(job.to_dict()))
+
+class ModerationTask(webapp2.RequestHandler):
+    """Task: carry on with a bulk moderation job."""
+    def post(self):
+        run_moderation_job(int(self.request.get('job_id')))
 
 class ApprovePending(webapp2.RequestHandler):
     """Approve a plaque"""
-    @ndb.transactional
+    @ndb.transactional(xg=True) # for the counters
     def post(self):
         #memcache.flush_all()
         plaque_key = self.request.get('plaque_key')
         plaque = ndb.Key(urlsafe=plaque_key).get()
         #logging.info("Approving plaque {0.title}".format(plaque))
+        update_state_counters(plaque.approved, True)
         plaque.approved = True
         plaque.created_on = datetime.datetime.now()
         plaque.put()
-        self.redirect('/nextpending')
+        after_commit(update_search_index, [plaque])
+        after_commit(plaques_changed)
+        queue_nearby_update(plaque)
+        after_commit(Suggest.plaque_approved, plaque)
+
+        # Carry on through the moderation queue from where the reviewer was.
+        queue_cursor = self.request.get('queue_cursor')
+        if queue_cursor:
+            self.redirect('/nextpending?cursor=%s' % queue_cursor)
+        else:
+            self.redirect('/nextpending')
 
 class DisapprovePlaque(webapp2.RequestHandler):
     """Disapprove a plaque"""
-    @ndb.transactional
+    @ndb.transactional(xg=True) # for the counters
     def post(self):
         #memcache.flush_all()
         plaque_key = self.request.get('plaque_key')
         plaque = ndb.Key(urlsafe=plaque_key).get()
         #logging.info("disapproving plaque {0.title}".format(plaque))
+        update_state_counters(plaque.approved, False)
         plaque.approved = False
         plaque.put()
+        after_commit(update_search_index, [plaque])
+        after_commit(plaques_changed)
+        queue_nearby_update(plaque)
+        after_commit(Suggest.plaque_removed, plaque)
         self.redirect('/')
 
 class RssFeed(webapp2.RequestHandler):
-    def get(self, num_entries=10):
-        plaques = Plaque.query(
-                      ).filter(Plaque.approved == True
-                      ).order(-Plaque.created_on
-                      ).fetch(limit=num_entries)
+    """
+    The RSS feed, plus older entries through /rss/<cursor> archive pages.
+
+    Each feed page is built once per cache generation (i.e. once per
+    approval) and kept in the cache with its ETag and Last-Modified, so a
+    poll costs a cache read, or a 304 if the reader already has it.
+    """
+    @ndb.toplevel
+    def get(self, cursor_urlsafe=None):
+        try:
+            num_entries = int(self.request.get('n', DEF_NUM_RSS_ENTRIES))
+        except ValueError:
+            num_entries = DEF_NUM_RSS_ENTRIES
+        num_entries = max(1, min(num_entries, MAX_NUM_RSS_ENTRIES))
+
+        memcache_name = 'rss_%s_%s' % (num_entries, cursor_urlsafe)
+        feed = cache.get_or_compute(
+            memcache_name, lambda: self._build(num_entries, cursor_urlsafe))
+
+        self.response.headers['Content-Type'] = 'application/rss+xml'
+        self.response.headers['Cache-Control'] = 'public, max-age=%s' % (
+            RSS_MAX_AGE_SECONDS)
+        self.response.headers['ETag'] = feed['etag']
+        if feed['last_modified'] is not None:
+            self.response.headers['Last-Modified'] = email.utils.formatdate(
+                feed['last_modified'], usegmt=True)
+
+        if self._is_not_modified(feed):
+            self.response.set_status(304)
+            return
+        self.response.write(feed['text'])
+
+    def _is_not_modified(self, feed):
+        if_none_match = self.request.headers.get('If-None-Match')
+        if if_none_match is not None:
+            etags = [e.strip() for e in if_none_match.split(',')]
+            return feed['etag'] in etags or '*' in etags
+
+        if_modified_since = self.request.headers.get('If-Modified-Since')
+        if if_modified_since and feed['last_modified'] is not None:
+            parsed = email.utils.parsedate_tz(if_modified_since)
+            if parsed is not None:
+                return feed['last_modified'] <= email.utils.mktime_tz(parsed)
+        return False
+
+    def _build(self, num_entries=DEF_NUM_RSS_ENTRIES, cursor_urlsafe=None):
+        """Render one page of the feed and work out its validators."""
+        plaques, next_cursor, more = Plaque.page_plaques(
+            num_entries, start_cursor_urlsafe=cursor_urlsafe)
+        if more and next_cursor is not None:
+            next_page_url = '/rss/%s?n=%s' % (next_cursor.urlsafe(),
+                                              num_entries)
+        else:
+            next_page_url = None
+
         template = JINJA_ENVIRONMENT.get_template('feed.xml')
-        template_values = {'plaques': plaques}
-        self.response.write(template.render(template_values))
+        template_values = {'plaques': plaques,
+                           'next_page_url': next_page_url}
+        text = template.render(template_values)
+
+        if plaques:
+            newest = max(p.created_on for p in plaques)
+            last_modified = calendar.timegm(newest.utctimetuple())
+        else:
+            last_modified = None
+
+        return {
+            'text': text,
+            'etag': '"%s"' % hashlib.md5(text.encode('utf-8')).hexdigest(),
+            'last_modified': last_modified,
+        }
+
+class Prerender(webapp2.RequestHandler):
+    """
+    Task: write the first few pages of plaques, and the pages of the plaques
+    on them and of the featured plaque, to GCS. (The RSS feed is cached by
+    RssFeed itself.)
+    """
+    @ndb.toplevel
+    def post(self):
+        started = time.time()
+        generation = int(started * 1000)
+
+        # Render with throwaway responses, so that nothing the page handlers
+        # do to their response (e.g. a redirect) fails the task.
+        page_handler = ViewPlaquesPage(self.request, webapp2.Response())
+        one_handler = ViewOnePlaque(self.request, webapp2.Response())
+
+        num_written = 0
+        one_plaques = []
+        cursor_urlsafe = None
+        for _ in range(PRERENDER_NUM_PAGES):
+            text = page_handler._render(DEF_NUM_PER_PAGE, cursor_urlsafe,
+                                        is_random=False, is_featured=True)
+            write_prerendered(generation,
+                              ViewPlaquesPage.prerender_path(cursor_urlsafe),
+                              text)
+            num_written += 1
+
+            plaques, next_cursor, more = Plaque.page_plaques(
+                DEF_NUM_PER_PAGE, start_cursor_urlsafe=cursor_urlsafe)
+            one_plaques.extend(plaques)
+            if not more or next_cursor is None:
+                break
+            cursor_urlsafe = next_cursor.urlsafe()
+
+        featured = get_featured()
+        if featured is not None:
+            one_plaques.append(featured)
+        for plaque in one_plaques:
+            if not plaque.approved:
+                continue
+            text = one_handler._render_from_key(plaque_key=plaque.title_url)
+            if text is not None:
+                write_prerendered(generation, plaque.title_page_url, text)
+                num_written += 1
+
+        # Pages of plaques that have gone, and of cursors that pagination
+        # has moved past, are only in older generations, which are never
+        # read again. If the plaques have changed since this task started,
+        # the next task's generation replaces this one instead.
+        published, old_generation = _publish_prerendered(generation, started)
+        if published and old_generation is not None:
+            delete_prerendered(old_generation)
+        elif not published:
+            delete_prerendered(generation)
+
+        logging.info("Prerendered %s pages in %.3fs%s" % (
+            num_written, time.time() - started,
+            "" if published else ", but the plaques have changed since"))
+
+class BuildSuggestIndex(webapp2.RequestHandler):
+    """Task: rebuild the /suggest prefix indexes from the datastore."""
+    def get(self):
+        start = time.time()
+        title_index, tag_index = Suggest.build_suggest_index()
+        self.response.write("indexed %s titles and %s tags in %.3fs" % (
+            len(title_index), len(tag_index), time.time() - start))
+
+    def post(self):
+        self.get()
+
+class BuildLocalSearchIndex(webapp2.RequestHandler):
+    """Task: rebuild the local search index from the datastore."""
+    def get(self):
+        start = time.time()
+        index = build_local_index()
+        self.response.write("indexed %s plaques in %.3fs" % (
+            len(index), time.time() - start))
+
+class Warmup(webapp2.RequestHandler):
+    """Prime a new instance before it gets user traffic (/_ah/warmup)."""
+    @ndb.toplevel
+    def get(self):
+        timings = warm_caches()
+        total = sum(seconds for name, seconds in timings)
+        lines = ["%s: %.3fs" % (name, seconds) for name, seconds in timings]
+        lines.append("total: %.3fs" % total)
+        logging.info("Warmup timings: %s" % ", ".join(lines))
+
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write("\n".join(lines))
+
+@ndb.transactional
+def _resave_plaques(keys):
+    """
+    Put some plaques again, as they are in the transaction, so that
+    Plaque._pre_put_hook sets their geohash and state.
+    """
+    plaques = [p for p in ndb.get_multi(keys) if p is not None]
+    ndb.put_multi(plaques)
+    return len(plaques)
+
+class SetGeohash(webapp2.RequestHandler):
+    """
+    Task: store the geohash prefixes and moderation state on every plaque,
+    a batch at a time, queueing itself again for the next batch. Once it
+    has been through them all, the moderation queries use the state.
+    """
+    def get(self):
+        """Cron: start the task, if it has never finished."""
+        if StateBackfill.is_done():
+            return
+        try:
+            taskqueue.add(url='/tasks/setgeohash', name=STATE_BACKFILL_TASK)
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+    def post(self):
+        cursor_urlsafe = self.request.get('cursor')
+        cursor = Cursor(urlsafe=cursor_urlsafe) if cursor_urlsafe else None
+        keys, next_cursor, more = Plaque.query().fetch_page(
+            GEOHASH_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+
+        num_updated = _resave_plaques(keys)
+        logging.info("SetGeohash: updated %s plaques" % num_updated)
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/setgeohash',
+                          params={'cursor': next_cursor.urlsafe()})
+        else:
+            StateBackfill.mark_done()
+            plaques_changed()
+            taskqueue.add(url='/tasks/setnearby')
+
+class SetNearby(webapp2.RequestHandler):
+    """
+    Task: compute every plaque's nearby list, a batch at a time. Queued by
+    SetGeohash once every plaque has its geohash.
+    """
+    def post(self):
+        cursor_urlsafe = self.request.get('cursor')
+        cursor = Cursor(urlsafe=cursor_urlsafe) if cursor_urlsafe else None
+        plaques, next_cursor, more = Plaque.query().fetch_page(
+            NEARBY_BATCH_SIZE, start_cursor=cursor)
+
+        updated = Plaque.update_nearby(plaques)
+        logging.info("SetNearby: updated %s plaques" % len(updated))
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/setnearby',
+                          params={'cursor': next_cursor.urlsafe()})
+        else:
+            plaques_changed()
+
+class UpdateNearby(webapp2.RequestHandler):
+    """
+    Task: after a plaque at (lat, lng) changes, recompute the nearby lists
+    that it is on, or should now be on, and its own.
+    """
+    def post(self):
+        plaque_key = ndb.Key(urlsafe=self.request.get('plaque_key'))
+        lat = float(self.request.get('lat'))
+        lng = float(self.request.get('lng'))
+
+        to_update = {}
+        plaque = plaque_key.get()
+        if plaque is not None:
+            to_update[plaque_key] = plaque
+
+        # Lists it is on, which may need it removed or its summary updated:
+        for other in Plaque.query().filter(Plaque.nearby_keys == plaque_key):
+            to_update[other.key] = other
+
+        # Lists it may now belong on:
+        for other, distance in Plaque.nearest(lat, lng, NEARBY_REFRESH_NUM):
+            if distance <= other.nearby_radius_meters:
+                to_update[other.key] = other
+
+        updated = Plaque.update_nearby(to_update.values())
+        logging.info("UpdateNearby: updated %s plaques near %s" % (
+            len(updated), plaque_key.urlsafe()))
+        # The plaque's own change has already flushed the caches if it was
+        # published; the nearby lists only show on the plaques' own pages.
+        plaque_pages_changed(updated)
 
 class SetUpdatedOn(webapp2.RequestHandler):
     def get(self):
@@ -1344,6 +2393,6 @@ class SetFeatured(webapp2.RequestHandler):
             plaque = ndb.Key(urlsafe=plaque_key).get()
             logging.info("setting plaque {0.title} to featured".format(plaque))
             set_featured(plaque)
-            memcache.flush_all()
+            plaques_changed()
             self.redirect('/')
 
@@ -0,0 +1,131 @@
+"""
+Fetching plaques' images from other sites, for submissions that give
+plaque_image_url and for imports.
+
+The plaque is saved first, with the image's URL in img_source_url and
+img_fetch_status 'queued' (see queue_image()), and a task fetches the image
+into GCS afterwards, so a slow remote host never holds up a request or an
+entity-group transaction. Each task fetches a batch of plaques' images in
+parallel, with async urlfetch calls that each have a deadline and a size
+cap. Transient failures (timeouts, 429s and 5xx responses) are tried again
+by a later task, with exponential backoff, up to MAX_ATTEMPTS times; any
+other failure marks the plaque 'failed', with the reason in
+img_fetch_error.
+"""
+
+import os
+import urlparse
+
+from google.appengine.api import taskqueue
+from google.appengine.api import urlfetch
+
+FETCH_TASK_URL = '/tasks/fetchimages'
+FETCH_BATCH_SIZE = 10 # images fetched in parallel by one task
+FETCH_DEADLINE_SECONDS = 30
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+MAX_ATTEMPTS = 5
+BACKOFF_SECONDS = 60 # doubled for each failed attempt
+TASKS_PER_QUEUE_ADD = 100
+TRANSIENT_STATUSES = [408, 429, 500, 502, 503, 504]
+# Some hosts don't say that their images are images.
+OTHER_CONTENT_TYPES = ['application/octet-stream', 'binary/octet-stream']
+
+class FetchError(Exception):
+    def __init__(self, message, transient=False):
+        super(FetchError, self).__init__(message)
+        self.transient = transient
+
+class FetchedImage(object):
+    def __init__(self, url, content, content_type):
+        self.url = url
+        self.content = content
+        self.content_type = content_type
+
+    @property
+    def name(self):
+        return os.path.basename(urlparse.urlparse(self.url).path) or \
+               'image.jpg'
+
+def queue_image(plaque, url):
+    """Mark a plaque's image as to be fetched from url."""
+    plaque.img_source_url = url
+    plaque.img_fetch_status = 'queued'
+    plaque.img_fetch_attempts = 0
+    plaque.img_fetch_error = None
+
+def queue_fetches(plaque_keys, countdown=0, transactional=False):
+    """
+    Queue the tasks to fetch some plaques' images. With transactional,
+    they're only queued if the caller's transaction commits; a transaction
+    can add at most five tasks.
+    """
+    tasks = []
+    for i in range(0, len(plaque_keys), FETCH_BATCH_SIZE):
+        batch = plaque_keys[i:i + FETCH_BATCH_SIZE]
+        tasks.append(taskqueue.Task(
+            url=FETCH_TASK_URL, countdown=countdown,
+            params={'plaque_key': [k.urlsafe() for k in batch]}))
+    queue = taskqueue.Queue()
+    for i in range(0, len(tasks), TASKS_PER_QUEUE_ADD):
+        queue.add(tasks[i:i + TASKS_PER_QUEUE_ADD],
+                  transactional=transactional)
+
+def retry_countdown(attempts):
+    return BACKOFF_SECONDS * 2 ** (attempts - 1)
+
+def _check(url, resp):
+    if resp.status_code in TRANSIENT_STATUSES:
+        raise FetchError("%s from %s" % (resp.status_code, url),
+                         transient=True)
+    if resp.status_code != 200:
+        raise FetchError("%s from %s" % (resp.status_code, url))
+
+    content_length = resp.headers.get('content-length', '')
+    if (content_length.isdigit() and int(content_length) > MAX_IMAGE_BYTES) \
+       or len(resp.content) > MAX_IMAGE_BYTES:
+        raise FetchError("%s is larger than %s bytes" % (url,
+                                                         MAX_IMAGE_BYTES))
+
+    content_type = resp.headers.get('content-type', '')
+    content_type = content_type.split(';')[0].strip().lower()
+    if not content_type.startswith('image/') and \
+       content_type not in OTHER_CONTENT_TYPES:
+        raise FetchError("%s is %s, not an image" % (url,
+                                                     content_type or
+                                                     "an unknown type"))
+    if not content_type.startswith('image/'):
+        content_type = None
+    return FetchedImage(url, resp.content, content_type)
+
+def fetch_many(urls):
+    """
+    Fetch some images, all at once. Returns a dict of each URL -> a
+    FetchedImage, or the FetchError it failed with.
+    """
+    rpcs = []
+    for url in urls:
+        rpc = urlfetch.create_rpc(deadline=FETCH_DEADLINE_SECONDS)
+        try:
+            urlfetch.make_fetch_call(rpc, url, follow_redirects=True)
+        except urlfetch.Error as err:
+            # e.g. InvalidURLError, raised before anything is sent
+            rpc = FetchError("%s: %s" % (url, err))
+        rpcs.append((url, rpc))
+
+    fetched = {}
+    for url, rpc in rpcs:
+        if isinstance(rpc, FetchError):
+            fetched[url] = rpc
+            continue
+        try:
+            fetched[url] = _check(url, rpc.get_result())
+        except FetchError as err:
+            fetched[url] = err
+        except urlfetch.ResponseTooLargeError:
+            fetched[url] = FetchError("%s is too large to fetch" % url)
+        except (urlfetch.DeadlineExceededError,
+                urlfetch.DownloadError) as err:
+            fetched[url] = FetchError("%s: %s" % (url, err), transient=True)
+        except urlfetch.Error as err:
+            fetched[url] = FetchError("%s: %s" % (url, err))
+    return fetched
@@ -0,0 +1,379 @@
+"""
+Bulk import and incremental sync of plaques from scrapers, for /api/import.
+
+A batch is NDJSON, one plaque per line:
+
+    {"source": "geograph", "source_url": "http://www.geograph.org.uk/...",
+     "title": "...", "description": "...", "lat": 51.5, "lng": -0.12,
+     "tags": ["london", "geograph"], "img_url": "http://..."}
+
+tags may also be a comma-separated string. source (the scraper's name),
+source_id (the item's id in the source, by default its source_url) and
+old_site_id are optional. An item can give an address instead of lat and
+lng; the batch's addresses are geocoded together (see Geocode.py).
+
+(source, source_id) is the idempotency key: a SourceRecord, keyed by a
+hash of it, remembers which plaque each item became and a content_hash()
+of the item as it was last synced. Importing an item again does nothing if
+its hash is the same, and updates its plaque in place if not; scrapers can
+get every record's hash from source_manifest() and only send the items
+that are new or have changed. A batch's plaques are written together with
+their records in one put_multi, in one transaction. New plaques are pending
+like any other submission. Images are fetched afterwards, in batches, for
+new plaques and for plaques whose img_url has changed (see ImageFetch.py).
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import re
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+from google.appengine.ext.db import BadValueError
+
+import Geocode
+import ImageFetch
+from Models import Counter, Plaque, SourceRecord, NUM_PENDING_COUNTER
+
+MAX_BATCH_ITEMS = 200 # two entities each; a commit can write at most 500
+MAX_TITLE_LENGTH = 1500
+IMAGE_REQUEUE_SECONDS = 3600
+MANIFEST_PAGE_SIZE = 1000
+URL_RE = re.compile(r'^https?://\S+$', re.IGNORECASE)
+KEY_FIELDS = ['source', 'source_id', 'source_url']
+
+class InvalidItem(ValueError):
+    pass
+
+def content_hash(item):
+    """
+    A hash of an item as sent, less the fields that identify it.
+    scripts/import_client.py computes the same thing before sending.
+    """
+    content = dict((k, v) for k, v in item.items() if k not in KEY_FIELDS)
+    text = json.dumps(content, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(text).hexdigest()
+
+def _url(item, name):
+    value = item.get(name)
+    if not isinstance(value, basestring) or not URL_RE.match(value):
+        raise InvalidItem("%s must be an http or https URL" % name)
+    return value
+
+def _tags(value):
+    """Tags from a list or a comma-separated string, tidied as /add does."""
+    if value is None:
+        value = []
+    elif isinstance(value, basestring):
+        value = value.split(',')
+    if not isinstance(value, list) or \
+       not all(isinstance(t, basestring) for t in value):
+        raise InvalidItem("tags must be a list or a comma-separated string")
+    tags = [re.sub(r'\s+', ' ', t.strip().lower()) for t in value]
+    return [t for t in tags if t] # Remove empties
+
+def parse_item(line):
+    """One validated plaque from a line of NDJSON. Raises InvalidItem."""
+    try:
+        item = json.loads(line)
+    except ValueError:
+        raise InvalidItem("not valid JSON")
+    if not isinstance(item, dict):
+        raise InvalidItem("not a JSON object")
+
+    title = item.get('title')
+    if not isinstance(title, basestring) or not title.strip():
+        raise InvalidItem("title is missing")
+    description = item.get('description', '')
+    if not isinstance(description, basestring):
+        raise InvalidItem("description must be a string")
+
+    address = item.get('address')
+    if 'lat' not in item and 'lng' not in item and address is not None:
+        if not isinstance(address, basestring) or not address.strip():
+            raise InvalidItem("address must be a string")
+        location = None # geocoded later, with the rest of the batch
+    else:
+        try:
+            location = ndb.GeoPt(float(item['lat']), float(item['lng']))
+        except (KeyError, TypeError, ValueError, BadValueError):
+            raise InvalidItem("lat and lng must be numbers in range")
+
+    old_site_id = item.get('old_site_id')
+    if old_site_id is not None:
+        try:
+            old_site_id = int(old_site_id)
+        except (TypeError, ValueError):
+            raise InvalidItem("old_site_id must be an integer")
+
+    source_url = _url(item, 'source_url')
+    source_id = item.get('source_id', source_url)
+    source = item.get('source', '')
+    if not isinstance(source_id, basestring) or not source_id or \
+       not isinstance(source, basestring):
+        raise InvalidItem("source and source_id must be strings")
+
+    return {
+        'source': source,
+        'source_id': source_id,
+        'source_url': source_url,
+        'content_hash': content_hash(item),
+        'img_url': _url(item, 'img_url'),
+        'title': title.strip()[:MAX_TITLE_LENGTH],
+        'description': description,
+        'location': location,
+        'address': address,
+        'tags': _tags(item.get('tags')),
+        'old_site_id': old_site_id,
+    }
+
+def _set_title_urls(plaques, ancestor_key):
+    """
+    Plaque.set_title_url for a batch: the plain title_urls are all checked
+    at once, in parallel, and only the ones that are taken, by another
+    plaque or earlier in the batch, fall back to the one-at-a-time search
+    for a free suffix.
+    """
+    bases = [Plaque.title_url_base(p.title) for p in plaques]
+    counts = {}
+    for base in set(bases):
+        query = Plaque.query(ancestor=ancestor_key
+                     ).filter(Plaque.title_url == base)
+        counts[base] = query.count_async(limit=1)
+
+    taken = set()
+    for plaque, base in zip(plaques, bases):
+        if counts[base].get_result() == 0 and base not in taken:
+            plaque.title_url = base
+        else:
+            plaque.set_title_url(ancestor_key, taken=taken)
+        taken.add(plaque.title_url)
+
+def _set_content(plaque, item):
+    plaque.title = item['title']
+    plaque.description = item['description']
+    plaque.location = item['location']
+    plaque.tags = item['tags']
+    if item['old_site_id'] is not None:
+        plaque.old_site_id = item['old_site_id']
+    plaque.updated_on = datetime.datetime.now()
+
+def _set_record(record, item, plaque, api_key_name):
+    """Returns whether the plaque's image needs fetching."""
+    record.source = item['source']
+    record.source_id = item['source_id']
+    record.source_url = item['source_url']
+    record.content_hash = item['content_hash']
+    record.plaque = plaque.key
+    record.api_key_name = api_key_name
+    record.synced_on = datetime.datetime.now()
+    if record.img_url == item['img_url']:
+        return False
+    record.img_url = item['img_url']
+    ImageFetch.queue_image(plaque, item['img_url'])
+    return True
+
+@ndb.transactional(xg=True) # the plaques' group and the pending counter
+def _put(new_plaques, new_records, changed, api_key_name):
+    """
+    Put the new plaques and their records, and apply the changed items to
+    their plaques and records as they are inside the transaction, so that
+    an approval or edit made since the batch was read isn't overwritten.
+    A new item whose record another batch has created since is left alone,
+    so that the two don't both create a plaque for it.
+
+    Returns the records that new items turned out to have (None for the
+    ones created), each changed item's updated plaque, or None if it has
+    been deleted, and the keys of the changed plaques whose images need
+    fetching.
+    """
+    existing = ndb.get_multi([r.key for r in new_records])
+    created = [(p, r) for p, r, e in zip(new_plaques, new_records, existing)
+               if e is None]
+
+    records = ndb.get_multi([r.key for _, _, r in changed])
+    plaques = ndb.get_multi([r.plaque for r in records if r is not None])
+    plaques = iter(plaques)
+    updated = []
+    to_fetch = []
+    for (result, item, _), record in zip(changed, records):
+        plaque = next(plaques) if record is not None else None
+        updated.append(plaque)
+        if plaque is None:
+            continue
+        _set_content(plaque, item)
+        if _set_record(record, item, plaque, api_key_name):
+            to_fetch.append(plaque.key)
+
+    ndb.put_multi([p for p, _ in created] + [r for _, r in created] +
+                  [p for p in updated if p is not None] +
+                  [r for r in records if r is not None])
+    if created:
+        Counter.incr(NUM_PENDING_COUNTER, len(created))
+    return existing, updated, to_fetch
+
+def _write(new, changed, ancestor_key, api_key_name):
+    """
+    Create the new plaques and update the changed ones, with their records.
+    Returns the keys of the plaques whose images need fetching and the
+    updated plaques.
+    """
+    plaques = []
+    records = []
+    to_fetch = []
+    if new:
+        first, _ = Plaque.allocate_ids(size=len(new), parent=ancestor_key)
+        for i, (result, item, record_key) in enumerate(new):
+            plaque = Plaque(id=first + i, parent=ancestor_key, approved=False)
+            _set_content(plaque, item)
+            plaques.append(plaque)
+            record = SourceRecord(key=record_key)
+            if _set_record(record, item, plaque, api_key_name):
+                to_fetch.append(plaque.key)
+            records.append(record)
+        _set_title_urls(plaques, ancestor_key)
+
+    if not new and not changed:
+        return [], []
+    # Changed plaques keep their title_url, as edited ones do.
+    existing, changed_plaques, changed_to_fetch = _put(plaques, records,
+                                                       changed, api_key_name)
+    not_created = set(plaque.key for plaque, record in zip(plaques, existing)
+                      if record is not None)
+    to_fetch = [key for key in to_fetch if key not in not_created]
+    to_fetch.extend(changed_to_fetch)
+
+    for (result, item, record_key), plaque, record in zip(new, plaques,
+                                                          existing):
+        if record is not None:
+            result.update(status='duplicate',
+                          plaque_key=record.plaque.urlsafe(),
+                          error="another batch created it first")
+            continue
+        result.update(status='created', plaque_key=plaque.key.urlsafe(),
+                      title_url=plaque.title_url)
+    updated = []
+    for (result, item, record), plaque in zip(changed, changed_plaques):
+        if plaque is None:
+            result.update(status='invalid', error="its plaque was deleted")
+            continue
+        result.update(status='updated')
+        updated.append(plaque)
+    return to_fetch, updated
+
+def _geocode(to_write):
+    """
+    Fill in the locations of the items that gave an address, all at once.
+    Returns the items that could be geocoded.
+    """
+    addresses = [item['address'] for _, item, _ in to_write
+                 if item['location'] is None]
+    if not addresses:
+        return to_write
+    locations = Geocode.geocode_many(addresses)
+    located = []
+    for result, item, record in to_write:
+        if item['location'] is None:
+            item['location'] = locations[item['address']]
+            if item['location'] is None:
+                result.update(status='invalid',
+                              error="the address couldn't be geocoded")
+                continue
+        located.append((result, item, record))
+    return located
+
+def import_batch(lines, ancestor_key, api_key_name=None):
+    """
+    Import or sync the plaques in some lines of NDJSON. Returns one result
+    per non-blank line, and the existing plaques that were updated (for
+    the caller to reindex and so on).
+
+    Each result is a dict with the line number and a status: created,
+    updated, unchanged, duplicate (of an earlier line, or of a plaque that
+    another batch created meanwhile) or invalid, plus the plaque's key or
+    the error.
+    """
+    results = []
+    items = []
+    line_nums = {}
+    for line_num, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        result = {'line': line_num}
+        results.append(result)
+        try:
+            item = parse_item(line)
+        except InvalidItem as err:
+            result.update(status='invalid', error=str(err))
+            continue
+
+        item_key = (item['source'], item['source_id'])
+        result.update(source_url=item['source_url'],
+                      source_id=item['source_id'],
+                      content_hash=item['content_hash'])
+        if item_key in line_nums:
+            result.update(status='duplicate',
+                          error="same source_id as line %s" %
+                                line_nums[item_key])
+            continue
+        line_nums[item_key] = line_num
+        items.append((result, item))
+
+    if len(items) > MAX_BATCH_ITEMS:
+        raise InvalidItem("at most %s plaques per batch" % MAX_BATCH_ITEMS)
+
+    record_keys = [ndb.Key(SourceRecord,
+                           SourceRecord.id_for(item['source'],
+                                               item['source_id']),
+                           parent=ancestor_key)
+                   for _, item in items]
+    new = []
+    changed = []
+    unchanged = []
+    for (result, item), record_key, record in zip(
+            items, record_keys, ndb.get_multi(record_keys)):
+        if record is None:
+            new.append((result, item, record_key))
+            continue
+        result['plaque_key'] = record.plaque.urlsafe()
+        if record.content_hash != item['content_hash']:
+            changed.append((result, item, record))
+            continue
+        result['status'] = 'unchanged'
+        unchanged.append((result, record))
+
+    # An image whose task went missing gets another try on a rerun.
+    stalled = []
+    requeue_before = datetime.datetime.now() - \
+                     datetime.timedelta(seconds=IMAGE_REQUEUE_SECONDS)
+    unchanged_plaques = ndb.get_multi([r.plaque for _, r in unchanged])
+    for (result, record), plaque in zip(unchanged, unchanged_plaques):
+        if plaque is None:
+            continue
+        result['image_status'] = plaque.img_fetch_status
+        if plaque.img_fetch_status == 'queued' and \
+           plaque.updated_on < requeue_before:
+            stalled.append(plaque.key)
+
+    to_fetch, updated = _write(_geocode(new), _geocode(changed),
+                               ancestor_key, api_key_name)
+    ImageFetch.queue_fetches(to_fetch + stalled)
+    logging.info("import of %s lines: %s new, %s updated, %s image "
+                 "fetches requeued" % (len(results), len(new), len(updated),
+                                       len(stalled)))
+    return results, updated
+
+def source_manifest(source, cursor_urlsafe=None):
+    """
+    A page of a source's {source_id: content_hash}, and the cursor for the
+    next page, or None at the end.
+    """
+    cursor = Cursor(urlsafe=cursor_urlsafe) if cursor_urlsafe else None
+    query = SourceRecord.query().filter(SourceRecord.source == source)
+    records, next_cursor, more = query.fetch_page(
+        MANIFEST_PAGE_SIZE, start_cursor=cursor,
+        projection=[SourceRecord.source_id, SourceRecord.content_hash])
+    manifest = dict((r.source_id, r.content_hash) for r in records)
+    return manifest, next_cursor.urlsafe() if more and next_cursor else None
@@ -0,0 +1,442 @@
+"""
+An in-process inverted index over the plaques.
+
+This has no App Engine dependencies, so that it can be used as a fallback
+when the Search API is unavailable, in offline runs, and in benchmarks.
+
+Each indexed plaque gets a document number in the order it was added. The
+postings for a token are the document numbers that contain it (in
+ascending order, so adding a document is an append) and the token's
+frequency in each. Queries AND their terms together; the last term also
+matches as a prefix, so partial words work while typing. Results are
+scored with BM25 or ordered by recency.
+
+Removing a document only marks it deleted; its postings are skipped at
+query time and dropped the next time the index is rebuilt.
+"""
+
+from array import array
+import bisect
+import heapq
+import math
+import re
+
+from Geo import haversine_meters
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+TITLE_WEIGHT = 3 # title tokens count as this many occurrences
+MAX_DESCRIPTION_TOKENS = 200
+MAX_PREFIX_EXPANSIONS = 50
+SORT_RELEVANCE = 'relevance'
+SORT_RECENT = 'recent'
+
+_TAG_RE = re.compile(r'<[^>]*>')
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+def tokenize(text):
+    """Lowercase word tokens of text, with any HTML tags removed."""
+    if not text:
+        return []
+    return _TOKEN_RE.findall(_TAG_RE.sub(' ', text).lower())
+
+class InvertedIndex(object):
+    def __init__(self):
+        self.doc_ids = []       # doc number -> doc_id (plaque key urlsafe)
+        self.created_on = []    # doc number -> seconds since the epoch
+        self.lats = array('d')
+        self.lngs = array('d')
+        self.lengths = array('i')
+        self.postings = {}      # token -> (array of doc numbers, array of tf)
+        self.doc_nums = {}      # doc_id -> live doc number
+        self.deleted = set()    # doc numbers that have been removed
+        self.total_length = 0
+        self._sorted_tokens = None
+
+    def __len__(self):
+        return len(self.doc_nums)
+
+    def add(self, doc_id, title='', tags=(), description='', lat=0.0,
+            lng=0.0, created_on=0):
+        """Add (or replace) one document."""
+        if doc_id in self.doc_nums:
+            self.remove(doc_id)
+
+        counts = {}
+        for token in tokenize(title):
+            counts[token] = counts.get(token, 0) + TITLE_WEIGHT
+        for token in tokenize(' '.join(tags)):
+            counts[token] = counts.get(token, 0) + TITLE_WEIGHT
+        for token in tokenize(description)[:MAX_DESCRIPTION_TOKENS]:
+            counts[token] = counts.get(token, 0) + 1
+
+        doc_num = len(self.doc_ids)
+        self.doc_ids.append(doc_id)
+        self.created_on.append(created_on)
+        self.lats.append(lat)
+        self.lngs.append(lng)
+        length = sum(counts.values())
+        self.lengths.append(length)
+        self.total_length += length
+        self.doc_nums[doc_id] = doc_num
+
+        for token, count in counts.items():
+            posting = self.postings.get(token)
+            if posting is None:
+                posting = (array('i'), array('i'))
+                self.postings[token] = posting
+                self._sorted_tokens = None
+            posting[0].append(doc_num)
+            posting[1].append(count)
+
+    def remove(self, doc_id):
+        doc_num = self.doc_nums.pop(doc_id, None)
+        if doc_num is not None:
+            self.deleted.add(doc_num)
+            self.total_length -= self.lengths[doc_num]
+
+    def _tokens_with_prefix(self, prefix):
+        if self._sorted_tokens is None:
+            self._sorted_tokens = sorted(self.postings)
+        tokens = []
+        i = bisect.bisect_left(self._sorted_tokens, prefix)
+        while i < len(self._sorted_tokens) and \
+              self._sorted_tokens[i].startswith(prefix) and \
+              len(tokens) < MAX_PREFIX_EXPANSIONS:
+            tokens.append(self._sorted_tokens[i])
+            i += 1
+        return tokens
+
+    def _term_scores(self, tokens):
+        """
+        BM25 scores, by doc number, of the live documents containing any of
+        tokens (one query term and its prefix expansions).
+        """
+        num_docs = max(len(self.doc_nums), 1)
+        avg_length = float(self.total_length) / num_docs or 1.0
+        scores = {}
+        for token in tokens:
+            doc_nums, tfs = self.postings[token]
+            # Removed documents' postings don't count towards df, or df
+            # could outgrow num_docs and make idf negative.
+            live = [(doc_num, tf) for doc_num, tf in zip(doc_nums, tfs)
+                    if doc_num not in self.deleted]
+            df = len(live)
+            idf = math.log(1.0 + (num_docs - df + 0.5) / (df + 0.5))
+            for doc_num, tf in live:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B *
+                                  self.lengths[doc_num] / avg_length)
+                score = idf * tf * (BM25_K1 + 1) / (tf + norm)
+                if score > scores.get(doc_num, 0):
+                    scores[doc_num] = score
+        return scores
+
+    def search(self, query_string, limit=20, offset=0, sort=SORT_RELEVANCE,
+               prefix=True):
+        """
+        Return (doc_ids, number_found) for the documents matching every
+        term of query_string.
+        """
+        terms = tokenize(query_string)
+        if not terms:
+            return [], 0
+
+        scores = None
+        for i, term in enumerate(terms):
+            is_last = i == len(terms) - 1
+            if prefix and is_last:
+                tokens = self._tokens_with_prefix(term)
+            else:
+                tokens = [term] if term in self.postings else []
+            term_scores = self._term_scores(tokens)
+
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = dict((doc_num, score + term_scores[doc_num])
+                              for doc_num, score in scores.items()
+                              if doc_num in term_scores)
+            if not scores:
+                return [], 0
+
+        # Only one page is wanted, so don't sort every match.
+        if sort == SORT_RECENT:
+            key = lambda n: self.created_on[n]
+        else:
+            key = lambda n: scores[n]
+        ranked = heapq.nlargest(offset + limit, scores, key=key)
+        page = ranked[offset:offset + limit]
+        return [self.doc_ids[n] for n in page], len(scores)
+
+    def geo_search(self, lat, lng, radius_meters, limit=None):
+        """
+        Return (doc_id, distance in meters) for the documents within
+        radius_meters of (lat, lng), nearest first.
+        """
+        hits = []
+        for doc_id, doc_num in self.doc_nums.items():
+            distance = haversine_meters(lat, lng, self.lats[doc_num],
+                                        self.lngs[doc_num])
+            if distance <= radius_meters:
+                hits.append((distance, doc_id))
+        hits.sort()
+        if limit is not None:
+            hits = hits[:limit]
+        return [(doc_id, distance) for distance, doc_id in hits]
+
+    def to_dict(self):
+        """A JSON-serializable snapshot of the live documents."""
+        live = sorted(self.doc_nums.values())
+        renumber = dict((old, new) for new, old in enumerate(live))
+        postings = {}
+        for token, (doc_nums, tfs) in self.postings.items():
+            kept = [(renumber[n], tf) for n, tf in zip(doc_nums, tfs)
+                    if n in renumber]
+            if kept:
+                postings[token] = [[n for n, tf in kept],
+                                   [tf for n, tf in kept]]
+        return {
+            'doc_ids': [self.doc_ids[n] for n in live],
+            'created_on': [self.created_on[n] for n in live],
+            'lats': [self.lats[n] for n in live],
+            'lngs': [self.lngs[n] for n in live],
+            'lengths': [self.lengths[n] for n in live],
+            'postings': postings,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        index = cls()
+        index.doc_ids = list(data['doc_ids'])
+        index.created_on = list(data['created_on'])
+        index.lats = array('d', data['lats'])
+        index.lngs = array('d', data['lngs'])
+        index.lengths = array('i', data['lengths'])
+        index.total_length = sum(index.lengths)
+        index.doc_nums = dict((doc_id, n)
+                              for n, doc_id in enumerate(index.doc_ids))
+        for token, (doc_nums, tfs) in data['postings'].items():
+            index.postings[token] = (array('i', doc_nums), array('i', tfs))
+        return index
+
+    @classmethod
+    def from_plaque_dicts(cls, plaque_dicts):
+        """
+        Build an index from the full JSON dump of the plaques (the /fulljp
+        format: plaque_key, title, tags, description, location as "lat,lng").
+        """
+        index = cls()
+        for plaque in plaque_dicts:
+            lat, lng = [float(x) for x in plaque['location'].split(',')]
+            index.add(plaque['plaque_key'],
+                      title=plaque.get('title', ''),
+                      tags=plaque.get('tags', []),
+                      description=plaque.get('description', ''),
+                      lat=lat,
+                      lng=lng,
+                      created_on=plaque.get('created_on', 0))
+        return index
+
+class PrefixIndex(object):
+    """
+    Completion of short texts (plaque titles, tag names) from a prefix of
+    any of their words.
+
+    Every word of every text is kept in one sorted list, so the texts with
+    a word starting with some prefix are a contiguous run found by
+    bisection. Short prefixes match too many words to rank on every
+    keystroke, so their top TOP_K texts are precomputed.
+
+    Matches are ranked by: texts that start with the prefix, then higher
+    weight (e.g. the number of plaques with a tag), then shorter texts.
+    """
+    SHORT_PREFIX_LENGTH = 3
+    TOP_K = 20
+    MAX_SCAN = 5000
+
+    def __init__(self):
+        self.texts = []         # entry number -> text
+        self.urls = []          # entry number -> url
+        self.weights = array('i')
+        self.entry_nums = {}    # url -> live entry number
+        self.deleted = set()
+        self.words = []         # sorted
+        self.word_entries = array('i')
+        self.word_not_first = array('b')
+        self.top = {}           # short prefix -> [(not_first, entry), ...]
+
+    def __len__(self):
+        return len(self.entry_nums)
+
+    def _rank(self, not_first, entry):
+        return (not_first, -self.weights[entry], len(self.texts[entry]),
+                entry)
+
+    def _new_entry(self, text, url, weight):
+        if url in self.entry_nums:
+            self.remove(url)
+        entry = len(self.texts)
+        self.texts.append(text)
+        self.urls.append(url)
+        self.weights.append(weight)
+        self.entry_nums[url] = entry
+        return entry
+
+    def _occurrences(self, entry):
+        """(word, not_first) for each distinct word of an entry's text."""
+        seen = set()
+        for position, word in enumerate(tokenize(self.texts[entry])):
+            if word not in seen:
+                seen.add(word)
+                yield word, int(position > 0)
+
+    def add(self, text, url, weight=0):
+        """Add (or replace) one text, keeping everything sorted."""
+        entry = self._new_entry(text, url, weight)
+        for word, not_first in self._occurrences(entry):
+            i = bisect.bisect_right(self.words, word)
+            self.words.insert(i, word)
+            self.word_entries.insert(i, entry)
+            self.word_not_first.insert(i, not_first)
+            for n in range(1, min(len(word), self.SHORT_PREFIX_LENGTH) + 1):
+                top = self.top.setdefault(word[:n], [])
+                top.append((not_first, entry))
+                top.sort(key=lambda item: self._rank(*item))
+                del top[self.TOP_K:]
+
+    def remove(self, url):
+        entry = self.entry_nums.pop(url, None)
+        if entry is not None:
+            self.deleted.add(entry)
+
+    @classmethod
+    def build(cls, items):
+        """Build an index from (text, url, weight) tuples in one go."""
+        index = cls()
+        occurrences = []
+        tops = {}
+        for text, url, weight in items:
+            entry = index._new_entry(text, url, weight)
+            for word, not_first in index._occurrences(entry):
+                occurrences.append((word, entry, not_first))
+                for n in range(1, min(len(word),
+                                      cls.SHORT_PREFIX_LENGTH) + 1):
+                    tops.setdefault(word[:n], []).append((not_first, entry))
+
+        occurrences.sort()
+        index.words = [word for word, entry, not_first in occurrences]
+        index.word_entries = array('i', [o[1] for o in occurrences])
+        index.word_not_first = array('b', [o[2] for o in occurrences])
+        for prefix, candidates in tops.items():
+            index.top[prefix] = heapq.nsmallest(
+                cls.TOP_K, candidates, key=lambda item: index._rank(*item))
+        return index
+
+    def _scan(self, prefix):
+        """(not_first, entry) for the words starting with prefix."""
+        i = bisect.bisect_left(self.words, prefix)
+        end = min(len(self.words), i + self.MAX_SCAN)
+        while i < end and self.words[i].startswith(prefix):
+            yield self.word_not_first[i], self.word_entries[i]
+            i += 1
+
+    def _entries_with_word(self, word):
+        i = bisect.bisect_left(self.words, word)
+        j = bisect.bisect_right(self.words, word)
+        return set(self.word_entries[i:j])
+
+    def _best(self, candidates, allowed, limit):
+        """
+        The ranks of the best limit candidates that aren't deleted and, if
+        allowed isn't None, are in it.
+        """
+        best = {}
+        for not_first, entry in candidates:
+            if entry in self.deleted:
+                continue
+            if allowed is not None and entry not in allowed:
+                continue
+            rank = self._rank(not_first, entry)
+            if entry not in best or rank < best[entry]:
+                best[entry] = rank
+        return heapq.nsmallest(limit, best.values())
+
+    def search(self, query_string, limit=10):
+        """
+        (text, url) for the best limit texts that contain every complete
+        word of query_string and a word starting with its last word.
+        """
+        terms = tokenize(query_string)
+        if not terms:
+            return []
+        prefix = terms[-1]
+
+        # The texts with every complete word, smallest set first.
+        allowed = None
+        for word in sorted(set(terms[:-1]),
+                           key=lambda w: len(self._entries_with_word(w))):
+            entries = self._entries_with_word(word)
+            allowed = entries if allowed is None else allowed & entries
+            if not allowed:
+                return []
+
+        ranked = None
+        if prefix in self.top and limit <= self.TOP_K:
+            ranked = self._best(self.top[prefix], allowed, limit)
+            if len(ranked) < limit and len(self.top[prefix]) == self.TOP_K:
+                ranked = None # too many filtered out; look at them all
+        if ranked is None and allowed is not None and \
+           len(allowed) < self.MAX_SCAN:
+            # Few enough texts have the complete words to check them all.
+            candidates = []
+            for entry in allowed:
+                for word, not_first in self._occurrences(entry):
+                    if word.startswith(prefix):
+                        candidates.append((not_first, entry))
+            ranked = self._best(candidates, None, limit)
+        if ranked is None:
+            ranked = self._best(self._scan(prefix), allowed, limit)
+        return [(self.texts[r[-1]], self.urls[r[-1]]) for r in ranked]
+
+    def to_dict(self):
+        """A JSON-serializable snapshot of the live entries."""
+        live = sorted(self.entry_nums.values())
+        renumber = dict((old, new) for new, old in enumerate(live))
+        words = []
+        word_entries = []
+        word_not_first = []
+        for word, entry, not_first in zip(self.words, self.word_entries,
+                                          self.word_not_first):
+            if entry in renumber:
+                words.append(word)
+                word_entries.append(renumber[entry])
+                word_not_first.append(not_first)
+        top = {}
+        for prefix, items in self.top.items():
+            kept = [[not_first, renumber[entry]] for not_first, entry in items
+                    if entry in renumber]
+            if kept:
+                top[prefix] = kept
+        return {
+            'texts': [self.texts[n] for n in live],
+            'urls': [self.urls[n] for n in live],
+            'weights': [self.weights[n] for n in live],
+            'words': words,
+            'word_entries': word_entries,
+            'word_not_first': word_not_first,
+            'top': top,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        index = cls()
+        index.texts = list(data['texts'])
+        index.urls = list(data['urls'])
+        index.weights = array('i', data['weights'])
+        index.entry_nums = dict((url, n) for n, url in enumerate(index.urls))
+        index.words = list(data['words'])
+        index.word_entries = array('i', data['word_entries'])
+        index.word_not_first = array('b', data['word_not_first'])
+        index.top = dict((prefix, [tuple(item) for item in items])
+                         for prefix, items in data['top'].items())
+        return index
@@ -1,16 +1,30 @@
 
 from collections import defaultdict
+import hashlib
 import logging
 import re
 
 FETCH_LIMIT_PLAQUES = 500
+GEO_CELL_FETCH_LIMIT = 1000
+NEAREST_START_PRECISION = 6
+NUM_NEARBY = 8
+
+# Bump this when to_search_document() changes; documents with an older
+# version are rewritten by Search.check_index().
+SEARCH_DOCUMENT_VERSION = 2
+SEARCH_SUMMARY_LENGTH = 300
+
+NUM_APPROVED_COUNTER = 'num_approved'
+NUM_PENDING_COUNTER = 'num_pending'
 
-from google.appengine.api import memcache
 from google.appengine.ext import ndb
 from google.appengine.api import search
 from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext.db import BadValueError
 
+import Cache as cache
+import Geo
+
 class Comment(ndb.Model):
     """
     A class to model a user comment about a particular plaque.
@@ -32,7 +46,7 @@ class Plaque(ndb.Model):
             - the image's serving URL (much faster to serve from this, so worth
               recording it at instance creation time)
         * Zero or more text tags
-        * Approved flag (default False)
+        * Approved flag (default False), mirrored in the moderation state
         * Created-on date
         * Created-by name
 
@@ -45,6 +59,8 @@ class Plaque(ndb.Model):
     DISPLAY_SIZE_PX = 1024
     BIG_SIZE_PX = 4096
     ALLOWED_ROTATIONS = [90, 180, 270]
+    STATES = ['pending', 'approved']
+    IMG_FETCH_STATUSES = ['queued', 'done', 'failed']
 
     title = ndb.StringProperty(required=True) # StringProperty: 1500 char limit
     title_url = ndb.StringProperty(required=True)
@@ -53,36 +69,84 @@ class Plaque(ndb.Model):
     pic = ndb.StringProperty()
     img_url = ndb.StringProperty()
     img_rot = ndb.IntegerProperty(default=0)
+    # For an image fetched from another site; see ImageFetch.py.
+    img_source_url = ndb.TextProperty()
+    img_fetch_status = ndb.StringProperty(choices=IMG_FETCH_STATUSES)
+    img_fetch_attempts = ndb.IntegerProperty(default=0, indexed=False)
+    img_fetch_error = ndb.StringProperty(indexed=False)
     tags = ndb.StringProperty(repeated=True)
     comments = ndb.KeyProperty(repeated=True, kind=Comment)
     approved = ndb.BooleanProperty(default=False)
+    state = ndb.StringProperty(choices=STATES) # set from approved
     created_on = ndb.DateTimeProperty(auto_now_add=True)
     created_by = ndb.UserProperty()
     updated_on = ndb.DateTimeProperty(auto_now_add=True)
     updated_by = ndb.UserProperty()
     old_site_id = ndb.IntegerProperty()
+    geohash = ndb.StringProperty(repeated=True) # prefixes, see Geo.py
+    nearby = ndb.JsonProperty() # summaries of the nearest plaques
+    nearby_keys = ndb.KeyProperty(repeated=True, kind='Plaque')
+
+    def _pre_put_hook(self):
+        self.state = 'approved' if self.approved else 'pending'
+        if self.location is not None:
+            self.geohash = Geo.prefixes(self.location.lat, self.location.lon)
+
+    @classmethod
+    def in_state(cls, state):
+        """
+        A query filter for the plaques in a moderation state. Plaques saved
+        before there was a state don't have one until the SetGeohash task
+        has been through them all, so until then this uses approved.
+        """
+        if StateBackfill.is_done():
+            return cls.state == state
+        return cls.approved == (state == 'approved')
 
     @classmethod
     def num_approved(cls):
-        count = Plaque.query().filter(Plaque.approved == True).count()
-        return count
+        return Counter.get_count(NUM_APPROVED_COUNTER, cls.count_approved)
 
     @classmethod
-    def page_plaques(cls, num, start_cursor_urlsafe=None):
-        memcache_names = [
-            'page_plaques_%s_%s' % (num, start_cursor_urlsafe),
-            'page_start_cursor_urlsafe_%s_%s' % (num, start_cursor_urlsafe),
-            'page_more_%s_%s' % (num, start_cursor_urlsafe),
-        ]
+    def count_approved(cls):
+        """Count with a query, rather than reading the counter."""
+        return Plaque.query().filter(Plaque.in_state('approved')).count()
 
-        memcache_out =  memcache.get_multi(memcache_names)
-        memcache_worked = len(memcache_out.keys()) == len(memcache_names)
-        if memcache_worked:
-            logging.debug("memcache.get_multi worked for Plaque.page_plaques()")
-            plaques = memcache_out[memcache_names[0]]
-            next_cursor = memcache_out[memcache_names[1]]
-            more = memcache_out[memcache_names[2]]
+    @classmethod
+    def page_plaques(cls, num, start_cursor_urlsafe=None):
+        """
+        Get a page of approved plaques, newest first. Only the page's keys
+        and the cursor for the next page are cached; the plaques themselves
+        come from one batched get, which ndb serves from its context cache
+        and memcache when it can. The following page is prefetched
+        asynchronously so that it is warm when the reader asks for it; the
+        request handler must be @ndb.toplevel, or the prefetch can be
+        abandoned when it returns.
+        """
+        keys, next_cursor_urlsafe, more = cls._page_keys_async(
+            num, start_cursor_urlsafe).get_result()
+        if more and next_cursor_urlsafe:
+            cls._prefetch_page_async(num, next_cursor_urlsafe)
+
+        plaques = [p for p in ndb.get_multi(keys) if p is not None]
+        if next_cursor_urlsafe:
+            next_cursor = Cursor(urlsafe=next_cursor_urlsafe)
         else:
+            next_cursor = None
+
+        logging.info("In Plaque.page_url: %s plaques %s %s" % (len(plaques), next_cursor, more))
+        return plaques, next_cursor, more
+
+    @classmethod
+    @ndb.tasklet
+    def _page_keys_async(cls, num, start_cursor_urlsafe=None):
+        """
+        Get (keys, next_cursor_urlsafe, more) for one page of approved
+        plaques, from the cache if possible.
+        """
+        memcache_name = 'page_keys_%s_%s' % (num, start_cursor_urlsafe)
+        page = cache.get(memcache_name)
+        if page is None:
             query = Plaque.query(
                 ).filter(Plaque.approved == True).order(-Plaque.created_on)
 
@@ -96,22 +160,214 @@ class Plaque(ndb.Model):
             else:
                 start_cursor = None
 
-            if start_cursor:
-                plaques, next_cursor, more = query.fetch_page(num, start_cursor=start_cursor)
-            else:
-                plaques, next_cursor, more = query.fetch_page(num)
+            keys, next_cursor, more = yield query.fetch_page_async(
+                num, start_cursor=start_cursor, keys_only=True)
+            next_cursor_urlsafe = next_cursor.urlsafe() if next_cursor else None
+            page = (keys, next_cursor_urlsafe, more)
 
-            memcache_status = memcache.set_multi({
-                memcache_names[0]: plaques,
-                memcache_names[1]: start_cursor,
-                memcache_names[2]: more,
-            })
-            if memcache_status:
-                logging.debug("""memcache.set in Plaque.plaque_pages() failed: 
-                    %s were not set""" % memcache_status)
+            memcache_status = cache.put(memcache_name, page)
+            if not memcache_status:
+                logging.debug("memcache.set in Plaque._page_keys_async() "
+                              "failed for %s" % memcache_name)
+        else:
+            logging.debug("memcache.get worked for Plaque._page_keys_async()")
+        raise ndb.Return(page)
 
-        logging.info("In Plaque.page_url: %s plaques %s %s" % (len(plaques), next_cursor, more))
-        return plaques, next_cursor, more
+    @classmethod
+    @ndb.tasklet
+    def _prefetch_page_async(cls, num, start_cursor_urlsafe):
+        """Warm the key cache and ndb's entity cache for a page."""
+        keys, next_cursor_urlsafe, more = yield cls._page_keys_async(
+            num, start_cursor_urlsafe)
+        yield ndb.get_multi_async(keys)
+
+    @classmethod
+    def _approved_in_cells(cls, cells):
+        """
+        (key, lat, lng) for the approved plaques in any of the geohash cells.
+        Each cell's list is cached; the ones that aren't are fetched with
+        parallel projection queries, so no entities are loaded.
+        """
+        memcache_names = dict(('geo_cell_%s' % cell, cell) for cell in cells)
+        found = cache.get_multi(memcache_names.keys())
+
+        missing = [cell for name, cell in memcache_names.items()
+                   if name not in found]
+        futures = [cls._fetch_cell_async(cell) for cell in missing]
+
+        new_cells = {}
+        for cell, future in zip(missing, futures):
+            new_cells['geo_cell_%s' % cell] = future.get_result()
+        if new_cells:
+            not_set = cache.put_multi(new_cells)
+            if not_set:
+                logging.debug("memcache.set_multi failed for %s" % not_set)
+            found.update(new_cells)
+
+        candidates = []
+        for cell_points in found.values():
+            candidates.extend(cell_points)
+        return candidates
+
+    @classmethod
+    @ndb.tasklet
+    def _fetch_cell_async(cls, cell):
+        """
+        (key, lat, lng) for every approved plaque in one cell. A cell with
+        more than GEO_CELL_FETCH_LIMIT of them is split into its 32
+        subcells, which are fetched in parallel, and at Geo.MAX_PRECISION
+        the query is paged through instead.
+        """
+        query = Plaque.query(
+            ).filter(Plaque.approved == True
+            ).filter(Plaque.geohash == cell)
+        if len(cell) < Geo.MAX_PRECISION:
+            plaques = yield query.fetch_async(GEO_CELL_FETCH_LIMIT + 1,
+                                              projection=[Plaque.location])
+            if len(plaques) <= GEO_CELL_FETCH_LIMIT:
+                raise ndb.Return([(p.key, p.location.lat, p.location.lon)
+                                  for p in plaques])
+            subcells = yield [cls._fetch_cell_async(cell + c)
+                              for c in Geo.BASE32]
+            raise ndb.Return([point for points in subcells
+                              for point in points])
+
+        points = []
+        cursor = None
+        more = True
+        while more:
+            plaques, cursor, more = yield query.fetch_page_async(
+                GEO_CELL_FETCH_LIMIT, start_cursor=cursor,
+                projection=[Plaque.location])
+            points.extend((p.key, p.location.lat, p.location.lon)
+                          for p in plaques)
+            more = more and cursor is not None
+        raise ndb.Return(points)
+
+    @classmethod
+    def _by_distance(cls, candidates, lat, lng, radius_meters):
+        """(distance, key) of the candidates within the radius, nearest first."""
+        hits = []
+        for key, plat, plng in candidates:
+            distance = Geo.haversine_meters(lat, lng, plat, plng)
+            if distance <= radius_meters:
+                hits.append((distance, key))
+        hits.sort()
+        return hits
+
+    @classmethod
+    def _get_with_distances(cls, hits):
+        plaques = ndb.get_multi([key for distance, key in hits])
+        return [(plaque, distance)
+                for (distance, key), plaque in zip(hits, plaques)
+                if plaque is not None]
+
+    @classmethod
+    def within_radius(cls, lat, lng, radius_meters, num=None):
+        """
+        The approved plaques within radius_meters of (lat, lng), as
+        (plaque, distance in meters) tuples, nearest first.
+        """
+        cells = Geo.cells_for_radius(lat, lng, radius_meters)
+        if cells is None:
+            # Bigger than a precision 1 cell and its neighbours, which
+            # already covers a fifth of the globe.
+            raise ValueError("search radius %s is too big" % radius_meters)
+
+        candidates = cls._approved_in_cells(cells)
+        hits = cls._by_distance(candidates, lat, lng, radius_meters)
+        return cls._get_with_distances(hits[:num])
+
+    @classmethod
+    def nearest(cls, lat, lng, num, max_radius_meters=None):
+        """
+        The num approved plaques nearest to (lat, lng), as (plaque, distance
+        in meters) tuples, nearest first. Searches the cells around the
+        point, getting coarser until the num-th nearest plaque found is
+        within the distance those cells are guaranteed to cover.
+        """
+        hits = []
+        for precision in range(NEAREST_START_PRECISION,
+                               Geo.MIN_PRECISION - 1, -1):
+            covered = Geo.covered_radius_meters(lat, precision)
+            if max_radius_meters is not None:
+                covered = min(covered, max_radius_meters)
+
+            candidates = cls._approved_in_cells(
+                Geo.cells_around(lat, lng, precision))
+            hits = cls._by_distance(candidates, lat, lng, covered)
+            if len(hits) >= num or covered == max_radius_meters:
+                break
+
+        return cls._get_with_distances(hits[:num])
+
+    @classmethod
+    def within_bbox(cls, south, west, north, east, num=None):
+        """
+        The approved plaques inside a bounding box (which crosses the
+        antimeridian if west > east).
+        """
+        cells = Geo.cells_for_bbox(south, west, north, east)
+        keys = [key for key, plat, plng in cls._approved_in_cells(cells)
+                if Geo.in_bbox(plat, plng, south, west, north, east)]
+        return [p for p in ndb.get_multi(keys[:num]) if p is not None]
+
+    def set_nearby(self):
+        """
+        Store summaries of the NUM_NEARBY approved plaques nearest to this
+        one, so that its page can show them without any queries.
+        """
+        hits = Plaque.nearest(self.location.lat, self.location.lon,
+                              NUM_NEARBY + 1)
+        hits = [(p, d) for p, d in hits if p.key != self.key][:NUM_NEARBY]
+
+        self.nearby = []
+        for plaque, distance in hits:
+            summary = plaque.to_dict(summary=True)
+            summary['plaque_key'] = plaque.key.urlsafe()
+            summary['distance_meters'] = int(round(distance))
+            self.nearby.append(summary)
+        self.nearby_keys = [plaque.key for plaque, distance in hits]
+
+    @classmethod
+    def update_nearby(cls, plaques):
+        """
+        set_nearby() for some plaques, and save just their nearby lists.
+        Returns the plaques whose lists changed, which are the ones saved.
+        """
+        for plaque in plaques:
+            plaque.set_nearby()
+        return cls._put_nearby(dict((p.key, (p.nearby, p.nearby_keys))
+                                    for p in plaques))
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def _put_nearby(cls, nearby_by_key):
+        """
+        Re-read the plaques and write only their nearby lists, so that an
+        approval or edit made since they were read isn't overwritten.
+        """
+        keys = nearby_by_key.keys()
+        changed = []
+        for plaque in ndb.get_multi(keys):
+            if plaque is None:
+                continue
+            nearby, nearby_keys = nearby_by_key[plaque.key]
+            if (plaque.nearby, plaque.nearby_keys) != (nearby, nearby_keys):
+                plaque.nearby, plaque.nearby_keys = nearby, nearby_keys
+                changed.append(plaque)
+        ndb.put_multi(changed)
+        return changed
+
+    @property
+    def nearby_radius_meters(self):
+        """
+        How close a newly approved plaque has to be to get onto this one's
+        nearby list.
+        """
+        if not self.nearby or len(self.nearby) < NUM_NEARBY:
+            return float('inf')
+        return self.nearby[-1]['distance_meters']
 
 #    @classmethod
 #    def approved_list(cls, offset=0, limit=FETCH_LIMIT_PLAQUES):
@@ -135,20 +391,36 @@ class Plaque(ndb.Model):
 #        return plaques
 
     @classmethod
-    def num_pending(cls, num=20): # num is the max to return
-        count = Plaque.query().filter(Plaque.approved != True).count(limit=num)
-        return count
+    def num_pending(cls):
+        return Counter.get_count(NUM_PENDING_COUNTER, cls.count_pending)
+
+    @classmethod
+    def count_pending(cls):
+        """Count with a query, rather than reading the counter."""
+        return Plaque.query().filter(Plaque.in_state('pending')).count()
 
     @classmethod
     def pending_list(cls, num=20):
         """A separate method from approved() so that it will
         never be memcached."""
-        plaques = Plaque.query().filter(Plaque.approved != True
-                               ).order(Plaque.approved
+        plaques = Plaque.query().filter(Plaque.in_state('pending')
                                ).order(-Plaque.created_on
                                ).fetch(limit=num)
         return plaques
 
+    @classmethod
+    def pending_queue(cls, num, start_cursor=None):
+        """
+        The keys of the next num plaques in the moderation queue (the
+        pending ones, newest first) after start_cursor, each paired with the
+        cursor just after it.
+        """
+        query = Plaque.query().filter(Plaque.in_state('pending')
+                             ).order(-Plaque.created_on)
+        keys = query.iter(keys_only=True, produce_cursors=True,
+                          start_cursor=start_cursor, limit=num)
+        return [(key, keys.cursor_after()) for key in keys]
+
     # Turning off because this doesn't scale.
     # TODO: add table UniqueTags
     @classmethod
@@ -157,7 +429,7 @@ class Plaque(ndb.Model):
         Return a dict of the tags and their display-layer font sizes. Done
         here to speed rendering and to make the whole thing memcacheable.
         """
-        tag_counts = memcache.get('all_tags_sized')
+        tag_counts = cache.get('all_tags_sized')
         if tag_counts is None:
             tag_counts = defaultdict(int)
 
@@ -180,7 +452,7 @@ class Plaque(ndb.Model):
                     tag_fontsize[tag] = 22
                 else:
                     tag_fontsize[tag] = 25
-            memcache_status = memcache.set('all_tags_sized', tag_fontsize)
+            memcache_status = cache.put('all_tags_sized', tag_fontsize)
             if not memcache_status:
                 logging.debug("memcaching for all_tags_sized failed")
         else:
@@ -231,31 +503,34 @@ class Plaque(ndb.Model):
         url = '/plaque/%s' % self.key.urlsafe()
         return url
 
-    def set_title_url(self, ancestor_key, is_edit=False):
+    def set_title_url(self, ancestor_key, is_edit=False, taken=()):
         """
         Set the title_url. For new plaques, if the title_url already exists on
-        another plaque, add a suffix to make it unique. Keep plaques which are 
-        being edited by an admin the same.
+        another plaque, or is in taken, add a suffix to make it unique. Keep
+        plaques which are being edited by an admin the same.
         """
         if is_edit:
             return
 
-        if self.title:
-            title_url = re.sub('[^\w]+', '-', self.title.strip()).lower()
-        else:
-            title_url = ''
-
+        title_url = Plaque.title_url_base(self.title)
         orig_title_url = title_url
 
         count = 1
         n_matches= Plaque.num_same_title_urls(title_url, ancestor_key)
-        while n_matches > 0:
+        while n_matches > 0 or title_url in taken:
             count += 1
             title_url = "%s%s" % (orig_title_url, count)
             n_matches = Plaque.num_same_title_urls(title_url, ancestor_key)
 
         self.title_url = title_url
 
+    @classmethod
+    def title_url_base(cls, title):
+        """The title_url for a title, before any suffix is added."""
+        if title:
+            return re.sub('[^\w]+', '-', title.strip()).lower()
+        return ''
+
     @classmethod
     def num_same_title_urls(cls, title_url, ancestor_key):
         query = Plaque.query(ancestor=ancestor_key
@@ -264,19 +539,58 @@ class Plaque(ndb.Model):
         return num_plaques
 
     def to_search_document(self):
-        doc = search.Document(
-            doc_id = self.key.urlsafe(),
-            fields=[
-                search.TextField(name='tags', value=" ".join(self.tags)),
-                search.TextField(name='title', value=self.title),
-                search.HtmlField(name='description', value=self.description),
-                search.GeoField(name='location',
-                                value=search.GeoPoint(self.location.lat,
-                                                      self.location.lon)),
-            ],
-        )
+        """
+        The plaque's search document. As well as the searchable fields, it
+        holds everything a search results page shows, so that the page can
+        be made from the results without reading the plaques (see
+        from_search_summary).
+        """
+        summary = re.sub(r'\s+', ' ',
+                         re.sub(r'<[^>]*>', ' ', self.description)).strip()
+        fields = [
+            search.TextField(name='tags', value=" ".join(self.tags)),
+            search.TextField(name='title', value=self.title),
+            search.HtmlField(name='description', value=self.description),
+            search.GeoField(name='location',
+                            value=search.GeoPoint(self.location.lat,
+                                                  self.location.lon)),
+            search.DateField(name='created_on', value=self.created_on),
+            search.AtomField(name='approved',
+                             value='true' if self.approved else 'false'),
+            # Not an atom: it can be longer than an atom's limit.
+            search.TextField(name='title_url', value=self.title_url),
+            search.AtomField(name='img_url', value=self.img_url or ''),
+            search.NumberField(name='img_rot', value=self.img_rot or 0),
+            search.TextField(name='summary',
+                             value=summary[:SEARCH_SUMMARY_LENGTH]),
+            search.NumberField(name='schema_version',
+                               value=SEARCH_DOCUMENT_VERSION),
+        ]
+        # One field per tag, so that tags with spaces come back whole.
+        max_atom = search.MAXIMUM_FIELD_ATOM_LENGTH
+        fields.extend(search.AtomField(name='tag', value=tag[:max_atom])
+                      for tag in self.tags)
+        doc = search.Document(doc_id=self.key.urlsafe(), fields=fields)
         return doc
 
+    @classmethod
+    def from_search_summary(cls, doc_id, summary):
+        """
+        A Plaque with just the fields that a search results page shows,
+        from the summary the search backend made of its document. It is
+        never put().
+        """
+        return cls(key=ndb.Key(urlsafe=doc_id),
+                   title=summary['title'],
+                   title_url=summary['title_url'],
+                   description=summary['summary'],
+                   location=ndb.GeoPt(summary['lat'], summary['lng']),
+                   img_url=summary['img_url'] or None,
+                   img_rot=summary['img_rot'],
+                   tags=summary['tags'],
+                   approved=summary['approved'],
+                   created_on=summary['created_on'])
+
     def to_dict(self, summary=False):
         if summary:
             plaque_dict = {
@@ -311,3 +625,216 @@ class FeaturedPlaque(ndb.Model):
     created_on = ndb.DateTimeProperty(auto_now_add=True)
     plaque = ndb.KeyProperty(repeated=False, kind=Plaque)
 
+class SearchIndexConfig(ndb.Model):
+    """
+    Which versioned Search API index is live, and which one (if any) is
+    being built to replace it. There is one of these, with the id 'config';
+    see Search.get_index_config().
+    """
+    active_name = ndb.StringProperty()
+    building_name = ndb.StringProperty()
+    previous_name = ndb.StringProperty()
+    version = ndb.IntegerProperty(default=1)
+    num_shards = ndb.IntegerProperty(default=0)
+    started_on = ndb.DateTimeProperty()
+    swapped_on = ndb.DateTimeProperty()
+
+class StateBackfill(ndb.Model):
+    """
+    Whether every plaque has its moderation state yet. There is one of
+    these, with the id 'state', made when SetGeohash finishes.
+    """
+    finished_on = ndb.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def is_done(cls):
+        """ndb caches it, so this is usually a memcache read."""
+        return cls.get_by_id('state') is not None
+
+    @classmethod
+    def mark_done(cls):
+        cls(id='state').put()
+
+class PrerenderState(ndb.Model):
+    """
+    Which generation of prerendered pages in GCS is live, and when the
+    plaques last changed. The live pages are only served while they are
+    newer than the last change. There is one of these, with the id 'state'.
+    """
+    generation = ndb.IntegerProperty()
+    published_at = ndb.FloatProperty() # time.time() the generation started
+    changed_at = ndb.FloatProperty()
+
+    @classmethod
+    def current(cls):
+        """ndb caches it, so this is usually a memcache read."""
+        return cls.get_by_id('state') or cls(id='state')
+
+    @property
+    def is_fresh(self):
+        return self.generation is not None and \
+               (self.changed_at is None or
+                self.changed_at < self.published_at)
+
+class ReindexShard(ndb.Model):
+    """
+    The checkpoint for one shard of a reindex: the plaques with keys from
+    start_key (inclusive) to end_key (exclusive), either of which may be
+    None for an open end, and how far through them the reindex has got.
+    """
+    index_name = ndb.StringProperty()
+    start_key = ndb.KeyProperty(kind=Plaque)
+    end_key = ndb.KeyProperty(kind=Plaque)
+    cursor = ndb.StringProperty(indexed=False)
+    num_docs = ndb.IntegerProperty(default=0)
+    num_failed = ndb.IntegerProperty(default=0)
+    done = ndb.BooleanProperty(default=False)
+    updated_on = ndb.DateTimeProperty(auto_now=True)
+
+class Counter(ndb.Model):
+    """
+    A named count, e.g. of the approved or pending plaques, kept up to date
+    as plaques change so that showing it doesn't need a count() query. The
+    id is the name.
+    """
+    count = ndb.IntegerProperty(default=0)
+
+    @classmethod
+    @ndb.transactional
+    def incr(cls, name, delta=1):
+        """
+        Change a count. A count that doesn't exist yet is left alone; it is
+        computed from scratch the first time it is read.
+        """
+        counter = cls.get_by_id(name)
+        if counter is not None:
+            counter.count += delta
+            counter.put()
+
+    @classmethod
+    def get_count(cls, name, compute):
+        """Read a count, storing compute() as its value if it is new."""
+        counter = cls.get_by_id(name)
+        if counter is None:
+            counter = cls.get_or_insert(name, count=compute())
+        return counter.count
+
+    @classmethod
+    def reset(cls, name, count):
+        cls(id=name, count=count).put()
+
+class ModerationJob(ndb.Model):
+    """
+    A bulk approve, disapprove or delete, run in batches by a task. It
+    applies to either a list of plaque keys or the plaques matching a
+    filter ('pending', 'approved' or 'tag:<tag>'). Progress is
+    checkpointed after every batch so the task can resume.
+    """
+    ACTIONS = ['approve', 'disapprove', 'delete']
+
+    action = ndb.StringProperty(choices=ACTIONS)
+    plaque_keys = ndb.KeyProperty(kind=Plaque, repeated=True, indexed=False)
+    filter = ndb.StringProperty()
+    position = ndb.IntegerProperty(default=0) # into plaque_keys
+    last_key = ndb.KeyProperty(kind=Plaque) # for filter jobs
+    num_done = ndb.IntegerProperty(default=0)
+    num_skipped = ndb.IntegerProperty(default=0)
+    num_batches = ndb.IntegerProperty(default=0)
+    timings = ndb.JsonProperty() # stage name -> total seconds
+    done = ndb.BooleanProperty(default=False)
+    created_on = ndb.DateTimeProperty(auto_now_add=True)
+    created_by = ndb.UserProperty()
+    updated_on = ndb.DateTimeProperty(auto_now=True)
+
+    def to_dict(self):
+        return {
+            'job_id': self.key.id(),
+            'action': self.action,
+            'filter': self.filter,
+            'num_keys': len(self.plaque_keys),
+            'num_done': self.num_done,
+            'num_skipped': self.num_skipped,
+            'num_batches': self.num_batches,
+            'timings': self.timings,
+            'done': self.done,
+            'created_on': str(self.created_on),
+            'updated_on': str(self.updated_on),
+        }
+
+class ApiKey(ndb.Model):
+    """
+    A key for the import API. The id is the SHA-256 of the key itself,
+    which is only shown once, when it's made.
+    """
+    name = ndb.StringProperty()
+    active = ndb.BooleanProperty(default=True)
+    created_on = ndb.DateTimeProperty(auto_now_add=True)
+    created_by = ndb.UserProperty()
+
+    @classmethod
+    def id_for(cls, key_string):
+        if isinstance(key_string, unicode):
+            key_string = key_string.encode('utf-8')
+        return hashlib.sha256(key_string).hexdigest()
+
+    @classmethod
+    def check(cls, key_string):
+        """The active ApiKey for a key string, or None."""
+        if not key_string:
+            return None
+        api_key = cls.get_by_id(cls.id_for(key_string))
+        if api_key is None or not api_key.active:
+            return None
+        return api_key
+
+class SourceRecord(ndb.Model):
+    """
+    The plaque an item from a scraped source became, and a hash of the
+    item's content when it was last synced, so that importing the same item
+    again updates the plaque if it has changed and does nothing if it
+    hasn't. The id is the SHA-1 of the source name and the item's id in the
+    source, and the parent is the plaques' parent, so a batch of plaques
+    and their records can be written in one transaction. img_url is the
+    item's image URL, to tell when it changes; the plaque has the image's
+    fetch status.
+    """
+    source = ndb.StringProperty()
+    source_id = ndb.StringProperty()
+    source_url = ndb.TextProperty()
+    content_hash = ndb.StringProperty()
+    plaque = ndb.KeyProperty(kind=Plaque)
+    img_url = ndb.TextProperty()
+    api_key_name = ndb.StringProperty()
+    created_on = ndb.DateTimeProperty(auto_now_add=True)
+    synced_on = ndb.DateTimeProperty() # when its content last changed
+    updated_on = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def _get_kind(cls):
+        # The kind the first version of the import API wrote its records
+        # under, as ImportRecord; keeping it keeps those records in use.
+        return 'ImportRecord'
+
+    @classmethod
+    def id_for(cls, source, source_id):
+        name = u'%s\n%s' % (source, source_id) if source else source_id
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        return hashlib.sha1(name).hexdigest()
+
+class GeocodedAddress(ndb.Model):
+    """
+    What the geocoder made of an address, so that it's only asked once. The
+    id is the SHA-1 of the normalized address (see Geocode.py). location is
+    None if the geocoder found nothing.
+    """
+    address = ndb.TextProperty() # normalized
+    location = ndb.GeoPtProperty(indexed=False)
+    provider = ndb.StringProperty(indexed=False)
+    created_on = ndb.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def id_for(cls, address):
+        if isinstance(address, unicode):
+            address = address.encode('utf-8')
+        return hashlib.sha1(address).hexdigest()
@@ -0,0 +1,615 @@
+"""
+Full-text and geographic search over the plaques.
+
+Queries are normalized to plain lowercase terms (ANDed together), run with
+explicit limits, a cursor, snippets of the description and a choice of
+relevance or recency ordering, and each page of results is cached by
+(normalized query, sort, limit, cursor) so that repeated searches cost one
+cache read.
+
+Searches go through a SearchBackend. The default is the App Engine Search
+API; LocalSearchBackend runs the same queries against the in-process
+inverted index in LocalSearch.py, which is built from the datastore and
+persisted to GCS. It is used when SEARCH_BACKEND is set to 'local' (e.g.
+for offline development) and as a fallback when the Search API fails,
+e.g. because its quota is exhausted.
+
+The Search API index is versioned (plaque_index, plaque_index_v2, ...).
+SearchIndexConfig records which version is live. A reindex builds the next
+version in the background with parallel, checkpointed task shards, while
+searches keep using the live one and new writes go to both; when every
+shard is done the new version is swapped in with one transaction.
+"""
+
+import calendar
+import datetime
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+
+from google.appengine.api import search
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+from google.appengine.runtime import apiproxy_errors
+
+import lib.cloudstorage as gcs
+
+import Cache as cache
+from LocalSearch import InvertedIndex
+from Models import Plaque, ReindexShard, SearchIndexConfig
+from Models import SEARCH_DOCUMENT_VERSION
+
+PLAQUE_SEARCH_INDEX_NAME = 'plaque_index'
+SEARCH_BACKEND = 'appengine' # or 'local'
+DEF_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+SEARCH_CACHE_SECONDS = 600
+SORT_RELEVANCE = 'relevance'
+SORT_RECENT = 'recent'
+SORTS = [SORT_RELEVANCE, SORT_RECENT]
+RETURNED_FIELDS = ['title', 'title_url', 'img_url', 'img_rot', 'tag',
+                   'location', 'created_on', 'approved', 'summary',
+                   'schema_version']
+APPROVED_QUERY = 'approved:true'
+SNIPPETED_FIELDS = ['description']
+
+# The same bucket as Handlers.GCS_BUCKET.
+LOCAL_INDEX_GCS_FILENAME = '/read-the-plaque.appspot.com/search/local_index.json'
+LOCAL_INDEX_RELOAD_SECONDS = 3600
+LOCAL_INDEX_BATCH_SIZE = 500
+
+INDEX_CONFIG_ID = 'config'
+REINDEX_SHARD_URL = '/tasks/reindexshard'
+REINDEX_NUM_SHARDS = 4
+REINDEX_BATCH_SIZE = 200 # the most documents one index.put() takes
+REINDEX_TASK_SECONDS = 60
+REINDEX_SCATTER_OVERSAMPLE = 32
+CHECK_INDEX_PAGE_SIZE = 1000
+
+def normalize_query(search_term):
+    """
+    Reduce a user's search to lowercase word terms, dropping anything the
+    Search API would treat as query syntax.
+    """
+    if not search_term:
+        return ''
+    terms = re.findall(r'\w+', search_term.lower(), re.UNICODE)
+    return ' '.join(terms)
+
+def _empty_page():
+    return {'doc_ids': [], 'snippets': {}, 'summaries': {},
+            'next_cursor': None, 'number_found': 0}
+
+def _summary(result):
+    """
+    The display fields of a search result, or None if its document has an
+    older schema that doesn't have them all.
+    """
+    fields = {}
+    tags = []
+    for field in result.fields:
+        if field.name == 'tag':
+            tags.append(field.value)
+        else:
+            fields[field.name] = field.value
+    if fields.get('schema_version', 0) < SEARCH_DOCUMENT_VERSION:
+        return None
+    return {
+        'title': fields['title'],
+        'title_url': fields['title_url'],
+        'img_url': fields['img_url'],
+        'img_rot': int(fields['img_rot']),
+        'tags': tags,
+        'lat': fields['location'].latitude,
+        'lng': fields['location'].longitude,
+        'created_on': fields['created_on'],
+        'approved': fields['approved'] == 'true',
+        'summary': fields['summary'],
+    }
+
+class SearchBackend(object):
+    """The operations that the search handlers need from a search engine."""
+    def search(self, query_string, cursor=None, limit=DEF_SEARCH_LIMIT,
+               sort=SORT_RELEVANCE):
+        """
+        Run a normalized query and return one page of results as a dict
+        with the keys doc_ids, snippets (doc_id -> HTML snippet of the
+        description), summaries (doc_id -> the fields needed to show the
+        result, see Plaque.from_search_summary), next_cursor (a string, or
+        None on the last page) and number_found.
+        """
+        raise NotImplementedError
+
+    def geo_search(self, lat, lng, radius_meters):
+        """Return the doc_ids of the plaques within radius_meters."""
+        raise NotImplementedError
+
+    def put(self, plaques):
+        raise NotImplementedError
+
+    def delete(self, doc_ids):
+        raise NotImplementedError
+
+class AppEngineSearchBackend(SearchBackend):
+    """
+    Search with the App Engine Search API. By default, search the live
+    index and write to it and to any index that is being built.
+    """
+    def __init__(self, index_name=None):
+        if index_name is None:
+            config = get_index_config()
+            index_name = config.active_name
+            self.write_names = [n for n in (config.active_name,
+                                            config.building_name) if n]
+        else:
+            self.write_names = [index_name]
+        self.index = search.Index(index_name)
+
+    def _sort_options(self, sort):
+        if sort == SORT_RECENT:
+            expression = search.SortExpression(
+                expression='created_on',
+                direction=search.SortExpression.DESCENDING,
+                default_value=datetime.datetime(1970, 1, 1))
+            return search.SortOptions(expressions=[expression])
+        else:
+            expression = search.SortExpression(
+                expression='_score',
+                direction=search.SortExpression.DESCENDING,
+                default_value=0)
+            return search.SortOptions(expressions=[expression],
+                                      match_scorer=search.MatchScorer())
+
+    def search(self, query_string, cursor=None, limit=DEF_SEARCH_LIMIT,
+               sort=SORT_RELEVANCE):
+        if cursor:
+            search_cursor = search.Cursor(web_safe_string=cursor)
+        else:
+            search_cursor = search.Cursor()
+
+        options = search.QueryOptions(
+            limit=limit,
+            cursor=search_cursor,
+            returned_fields=RETURNED_FIELDS,
+            snippeted_fields=SNIPPETED_FIELDS,
+            sort_options=self._sort_options(sort))
+        query = search.Query(
+            query_string='%s %s' % (query_string, APPROVED_QUERY),
+            options=options)
+        results = self.index.search(query)
+
+        doc_ids = []
+        snippets = {}
+        summaries = {}
+        for result in results:
+            doc_ids.append(result.doc_id)
+            for expression in result.expressions:
+                if expression.name == 'description':
+                    snippets[result.doc_id] = expression.value
+            summary = _summary(result)
+            if summary is not None:
+                summaries[result.doc_id] = summary
+
+        if results.cursor is not None:
+            next_cursor = results.cursor.web_safe_string
+        else:
+            next_cursor = None
+
+        return {
+            'doc_ids': doc_ids,
+            'snippets': snippets,
+            'summaries': summaries,
+            'next_cursor': next_cursor,
+            'number_found': results.number_found,
+        }
+
+    def geo_search(self, lat, lng, radius_meters):
+        query_string = 'distance(location, geopoint(%s, %s)) < %s %s' % (
+                        lat, lng, radius_meters, APPROVED_QUERY)
+        results = self.index.search(search.Query(query_string))
+        return [r.doc_id for r in results]
+
+    def put(self, plaques):
+        docs = [p.to_search_document() for p in plaques]
+        for name in self.write_names:
+            search.Index(name).put(docs)
+
+    def delete(self, doc_ids):
+        for name in self.write_names:
+            search.Index(name).delete(doc_ids)
+
+class LocalSearchBackend(SearchBackend):
+    """
+    Search with this instance's copy of the LocalSearch inverted index.
+    put() and delete() only change this instance's copy; the shared copy in
+    GCS is rewritten by build_local_index().
+    """
+    def search(self, query_string, cursor=None, limit=DEF_SEARCH_LIMIT,
+               sort=SORT_RELEVANCE):
+        try:
+            offset = int(cursor) if cursor else 0
+        except ValueError:
+            offset = 0
+        doc_ids, number_found = get_local_index().search(
+            query_string, limit=limit, offset=offset, sort=sort)
+        if offset + limit < number_found:
+            next_cursor = str(offset + limit)
+        else:
+            next_cursor = None
+        return {
+            'doc_ids': doc_ids,
+            'snippets': {},
+            'summaries': {},
+            'next_cursor': next_cursor,
+            'number_found': number_found,
+        }
+
+    def geo_search(self, lat, lng, radius_meters):
+        hits = get_local_index().geo_search(
+            float(lat), float(lng), float(radius_meters))
+        return [doc_id for doc_id, distance in hits]
+
+    def put(self, plaques):
+        index = get_local_index()
+        for plaque in plaques:
+            if plaque.approved:
+                add_to_local_index(index, plaque)
+            else:
+                index.remove(plaque.key.urlsafe())
+
+    def delete(self, doc_ids):
+        index = get_local_index()
+        for doc_id in doc_ids:
+            index.remove(doc_id)
+
+_local_index_lock = threading.Lock()
+_local_index_state = {'index': None, 'loaded_at': 0}
+
+def add_to_local_index(index, plaque):
+    index.add(plaque.key.urlsafe(),
+              title=plaque.title,
+              tags=plaque.tags,
+              description=plaque.description,
+              lat=plaque.location.lat,
+              lng=plaque.location.lon,
+              created_on=calendar.timegm(plaque.created_on.utctimetuple()))
+
+def build_local_index():
+    """
+    Build the local index from the approved plaques in the datastore, save
+    it to GCS, and start using it on this instance.
+    """
+    index = InvertedIndex()
+    query = Plaque.query().filter(Plaque.approved == True)
+    cursor = None
+    more = True
+    while more:
+        plaques, cursor, more = query.fetch_page(LOCAL_INDEX_BATCH_SIZE,
+                                                 start_cursor=cursor)
+        for plaque in plaques:
+            add_to_local_index(index, plaque)
+
+    with gcs.open(LOCAL_INDEX_GCS_FILENAME, 'w',
+                  content_type='application/json') as fh:
+        fh.write(json.dumps(index.to_dict()))
+
+    with _local_index_lock:
+        _local_index_state['index'] = index
+        _local_index_state['loaded_at'] = time.time()
+    logging.info("built local search index of %s plaques" % len(index))
+    return index
+
+def get_local_index():
+    """
+    This instance's copy of the local index, loaded from GCS and reloaded
+    every LOCAL_INDEX_RELOAD_SECONDS. Empty if it has never been built.
+    """
+    with _local_index_lock:
+        index = _local_index_state['index']
+        age = time.time() - _local_index_state['loaded_at']
+    if index is not None and age < LOCAL_INDEX_RELOAD_SECONDS:
+        return index
+
+    try:
+        with gcs.open(LOCAL_INDEX_GCS_FILENAME) as fh:
+            index = InvertedIndex.from_dict(json.loads(fh.read()))
+    except gcs.NotFoundError:
+        logging.error("no local search index in %s" %
+                      LOCAL_INDEX_GCS_FILENAME)
+        if index is None:
+            index = InvertedIndex()
+
+    with _local_index_lock:
+        _local_index_state['index'] = index
+        _local_index_state['loaded_at'] = time.time()
+    return index
+
+def get_backend(name=None):
+    if (name or SEARCH_BACKEND) == 'local':
+        return LocalSearchBackend()
+    else:
+        return AppEngineSearchBackend()
+
+def _with_fallback(operation):
+    """
+    Run operation(backend) on the configured backend, falling back to the
+    local index if the Search API fails.
+    """
+    backend = get_backend()
+    try:
+        return operation(backend)
+    except (search.Error, apiproxy_errors.OverQuotaError) as err:
+        if isinstance(backend, LocalSearchBackend):
+            raise
+        logging.error("Search API failed (%s), using the local index" % err)
+        return operation(LocalSearchBackend())
+
+def search_plaques(search_term, cursor_websafe=None, limit=DEF_SEARCH_LIMIT,
+                   sort=SORT_RELEVANCE):
+    """
+    Run a search and return one page of results as a dict with the keys
+    doc_ids, snippets (doc_id -> HTML snippet of the description),
+    summaries (doc_id -> display fields, for the documents that have them),
+    next_cursor (a web-safe string, or None on the last page) and
+    number_found.
+    """
+    limit = max(1, min(int(limit), MAX_SEARCH_LIMIT))
+    if sort not in SORTS:
+        sort = SORT_RELEVANCE
+
+    query_string = normalize_query(search_term)
+    if not query_string:
+        return _empty_page()
+
+    # Cursors are long, so hash them along with the query to keep the name
+    # under memcache's key length limit.
+    query_hash = hashlib.md5(('%s|%s' % (query_string, cursor_websafe)
+                              ).encode('utf-8')).hexdigest()
+    memcache_name = 'search_%s_%s_%s' % (query_hash, sort, limit)
+    page = cache.get(memcache_name)
+    if page is None:
+        page = _with_fallback(lambda backend: backend.search(
+            query_string, cursor_websafe, limit=limit, sort=sort))
+        memcache_status = cache.put(memcache_name, page,
+                                    ttl=SEARCH_CACHE_SECONDS)
+        if not memcache_status:
+            logging.debug("memcache.set failed for search %s" % memcache_name)
+    else:
+        logging.debug("memcache.get worked for search %s" % memcache_name)
+    return page
+
+def geo_search_plaques(lat, lng, radius_meters):
+    """The doc_ids of the plaques within radius_meters of (lat, lng)."""
+    return _with_fallback(
+        lambda backend: backend.geo_search(lat, lng, radius_meters))
+
+def index_plaques(plaques):
+    """Add or update the plaques' search documents."""
+    AppEngineSearchBackend().put(plaques)
+
+def unindex_plaques(doc_ids):
+    """Remove search documents."""
+    AppEngineSearchBackend().delete(doc_ids)
+
+def get_index_config():
+    """
+    The SearchIndexConfig. ndb caches it, so this is usually a memcache read.
+    """
+    return SearchIndexConfig.get_or_insert(
+        INDEX_CONFIG_ID, active_name=PLAQUE_SEARCH_INDEX_NAME)
+
+@ndb.transactional
+def _begin_build(num_shards):
+    config = get_index_config()
+    if config.building_name:
+        return None
+    config.version += 1
+    config.building_name = '%s_v%s' % (PLAQUE_SEARCH_INDEX_NAME,
+                                       config.version)
+    config.num_shards = num_shards
+    config.started_on = datetime.datetime.now()
+    config.put()
+    return config.building_name
+
+def _shard_key_ranges(num_shards):
+    """
+    Split the plaques into up to num_shards key ranges of about the same
+    size, using the datastore's random __scatter__ sample of keys.
+    """
+    keys = Plaque.query().order(ndb.GenericProperty('__scatter__')).fetch(
+        num_shards * REINDEX_SCATTER_OVERSAMPLE, keys_only=True)
+    keys.sort(key=lambda key: key.pairs())
+
+    splits = []
+    for i in range(1, num_shards):
+        if keys:
+            split = keys[len(keys) * i // num_shards]
+            if split not in splits:
+                splits.append(split)
+    bounds = [None] + splits + [None]
+    return zip(bounds[:-1], bounds[1:])
+
+def _shard_id(index_name, shard_num):
+    return '%s-%s' % (index_name, shard_num)
+
+def start_reindex(num_shards=REINDEX_NUM_SHARDS):
+    """
+    Start building the next version of the index with num_shards parallel
+    tasks. Returns the new index's name, or None if a build is already
+    running.
+    """
+    ranges = _shard_key_ranges(num_shards)
+    index_name = _begin_build(len(ranges))
+    if index_name is None:
+        return None
+
+    shards = []
+    for shard_num, (start_key, end_key) in enumerate(ranges):
+        shards.append(ReindexShard(id=_shard_id(index_name, shard_num),
+                                   index_name=index_name,
+                                   start_key=start_key,
+                                   end_key=end_key))
+    ndb.put_multi(shards)
+    for shard in shards:
+        taskqueue.add(url=REINDEX_SHARD_URL, params={'shard': shard.key.id()})
+    logging.info("started building %s with %s shards" % (
+        index_name, len(shards)))
+    return index_name
+
+def _shard_query(shard):
+    query = Plaque.query()
+    if shard.start_key is not None:
+        query = query.filter(Plaque.key >= shard.start_key)
+    if shard.end_key is not None:
+        query = query.filter(Plaque.key < shard.end_key)
+    return query.order(Plaque.key)
+
+def _put_documents(index, shard, plaques):
+    """Index a batch, counting the documents the Search API rejected."""
+    try:
+        index.put([p.to_search_document() for p in plaques])
+        shard.num_docs += len(plaques)
+    except search.PutError as err:
+        failed = [r for r in err.results
+                  if r.code != search.OperationResult.OK]
+        if any(r.code == search.OperationResult.TRANSIENT_ERROR
+               for r in failed):
+            raise # the task is retried from the last checkpoint
+        logging.error("%s documents failed in %s: %s" % (
+            len(failed), shard.key.id(), err))
+        shard.num_docs += len(plaques) - len(failed)
+        shard.num_failed += len(failed)
+
+def run_reindex_shard(shard_id):
+    """
+    Index a shard's plaques REINDEX_BATCH_SIZE at a time, checkpointing the
+    cursor after every batch, for up to REINDEX_TASK_SECONDS. Then queue
+    this again to carry on, or, if every shard is done, swap in the new
+    index.
+    """
+    shard = ReindexShard.get_by_id(shard_id)
+    if shard is None or shard.done:
+        return
+
+    index = search.Index(shard.index_name)
+    query = _shard_query(shard)
+    start = time.time()
+    while not shard.done and time.time() - start < REINDEX_TASK_SECONDS:
+        cursor = Cursor(urlsafe=shard.cursor) if shard.cursor else None
+        plaques, next_cursor, more = query.fetch_page(
+            REINDEX_BATCH_SIZE, start_cursor=cursor)
+        if plaques:
+            _put_documents(index, shard, plaques)
+        shard.cursor = next_cursor.urlsafe() if next_cursor else None
+        shard.done = not (more and next_cursor)
+        shard.put()
+
+    if not shard.done:
+        taskqueue.add(url=REINDEX_SHARD_URL, params={'shard': shard_id})
+        return
+
+    logging.info("reindex shard %s done: %s docs, %s failed" % (
+        shard_id, shard.num_docs, shard.num_failed))
+    config = get_index_config()
+    shard_keys = [ndb.Key(ReindexShard, _shard_id(shard.index_name, n))
+                  for n in range(config.num_shards)]
+    if all(s is not None and s.done for s in ndb.get_multi(shard_keys)):
+        swap_index(shard.index_name)
+
+@ndb.transactional
+def _swap(index_name):
+    config = get_index_config()
+    if config.building_name != index_name:
+        return False
+    config.previous_name = config.active_name
+    config.active_name = index_name
+    config.building_name = None
+    config.swapped_on = datetime.datetime.now()
+    config.put()
+    return True
+
+def swap_index(index_name):
+    """Make the index that has just been built the live one."""
+    if _swap(index_name):
+        cache.flush_all() # cached search results came from the old index
+        logging.info("%s is now the live search index" % index_name)
+
+def reindex_status():
+    """The SearchIndexConfig and the shards of the latest build."""
+    config = get_index_config()
+    index_name = config.building_name or config.active_name
+    shard_keys = [ndb.Key(ReindexShard, _shard_id(index_name, n))
+                  for n in range(config.num_shards)]
+    shards = [s for s in ndb.get_multi(shard_keys) if s is not None]
+    return config, shards
+
+def _index_doc_ids(index, query_string=None):
+    """Every doc_id in the index, or every one matching query_string."""
+    doc_ids = set()
+    if query_string is None:
+        start_id = None
+        while True:
+            docs = index.get_range(start_id=start_id,
+                                   include_start_object=start_id is None,
+                                   limit=CHECK_INDEX_PAGE_SIZE,
+                                   ids_only=True)
+            if not docs.results:
+                break
+            doc_ids.update(d.doc_id for d in docs)
+            start_id = docs.results[-1].doc_id
+    else:
+        cursor = search.Cursor()
+        while cursor is not None:
+            options = search.QueryOptions(limit=CHECK_INDEX_PAGE_SIZE,
+                                          cursor=cursor, ids_only=True)
+            results = index.search(search.Query(query_string=query_string,
+                                                options=options))
+            doc_ids.update(r.doc_id for r in results)
+            cursor = results.cursor
+    return doc_ids
+
+def check_index(fix=True):
+    """
+    Compare the live index with the datastore: every plaque should have a
+    document, with the right approved field and the current schema
+    version, and there should be no other documents. If fix, re-put or delete the documents that are wrong.
+    Returns the counts of each kind of problem.
+    """
+    index = search.Index(get_index_config().active_name)
+    indexed = _index_doc_ids(index)
+    indexed_approved = _index_doc_ids(index, APPROVED_QUERY)
+    indexed_current = _index_doc_ids(
+        index, 'schema_version >= %s' % SEARCH_DOCUMENT_VERSION)
+
+    stored = {}
+    for plaque in Plaque.query().iter(projection=[Plaque.approved]):
+        stored[plaque.key.urlsafe()] = plaque.approved
+
+    missing = [d for d in stored if d not in indexed]
+    wrong_approved = [d for d, approved in stored.items()
+                      if d in indexed and approved != (d in indexed_approved)]
+    orphaned = [d for d in indexed if d not in stored]
+    wrong_approved_set = set(wrong_approved)
+    outdated = [d for d in stored if d in indexed and
+                d not in indexed_current and d not in wrong_approved_set]
+
+    if fix:
+        to_put = missing + wrong_approved + outdated
+        for i in range(0, len(to_put), REINDEX_BATCH_SIZE):
+            keys = [ndb.Key(urlsafe=d)
+                    for d in to_put[i:i + REINDEX_BATCH_SIZE]]
+            index_plaques([p for p in ndb.get_multi(keys) if p is not None])
+        for i in range(0, len(orphaned), REINDEX_BATCH_SIZE):
+            unindex_plaques(orphaned[i:i + REINDEX_BATCH_SIZE])
+        if to_put or orphaned:
+            cache.flush_all()
+
+    counts = {'plaques': len(stored), 'documents': len(indexed),
+              'missing': len(missing), 'wrong_approved': len(wrong_approved),
+              'outdated': len(outdated), 'orphaned': len(orphaned)}
+    logging.info("search index check: %s" % counts)
+    return counts
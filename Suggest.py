@@ -0,0 +1,221 @@
+"""
+Search-as-you-type suggestions of plaque titles and tags, for /suggest.
+
+Two LocalSearch.PrefixIndex instances, one over the approved plaques'
+titles and one over their tags (weighted by how many plaques have each),
+are built from the datastore by build_suggest_index() and stored in
+memcache, compressed and split into chunks to fit under its value size
+limit. Each instance keeps a copy in memory.
+
+Approvals and removals are applied incrementally: they are appended to a
+log in memcache, which every instance replays onto its copy, checking for
+new entries at most every DELTA_CHECK_SECONDS. Rebuilding starts a new
+log.
+
+These memcache entries are kept outside Cache.py's generations, so that
+the cache flush that comes with every approval doesn't throw them away.
+"""
+
+import json
+import logging
+import threading
+import time
+import zlib
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+
+from LocalSearch import PrefixIndex
+from Models import Plaque
+
+SUGGEST_BUILD_URL = '/tasks/buildsuggest'
+HEADER_KEY = 'suggest_index'
+CHUNK_KEY = 'suggest_index_%s_%s' # version, chunk number
+DELTA_KEY = 'suggest_delta'
+CHUNK_BYTES = 900000
+DELTA_CHECK_SECONDS = 5
+DELTA_CAS_RETRIES = 10
+MAX_DELTA_OPS = 500
+REBUILD_BATCH_SECONDS = 600
+DEF_NUM_SUGGESTIONS = 8
+MAX_NUM_SUGGESTIONS = PrefixIndex.TOP_K
+
+_lock = threading.Lock()
+_state = {'version': None, 'titles': None, 'tags': None, 'applied': 0,
+          'checked_at': 0}
+
+def _tag_url(tag):
+    return '/tag/%s' % tag
+
+def build_suggest_index():
+    """Build both indexes from the approved plaques, and store them."""
+    titles = []
+    query = Plaque.query().filter(Plaque.approved == True)
+    for plaque in query.iter(projection=[Plaque.title, Plaque.title_url]):
+        titles.append((plaque.title, plaque.title_page_url, 0))
+
+    tag_counts = {}
+    for plaque in query.iter(projection=[Plaque.tags]):
+        tag = plaque.tags[0]
+        tag_counts[tag] = tag_counts.get(tag, 0) + 1
+    tags = [(tag, _tag_url(tag), count) for tag, count in tag_counts.items()]
+
+    return store(PrefixIndex.build(titles), PrefixIndex.build(tags))
+
+def store(title_index, tag_index):
+    """
+    Store both indexes in memcache under a new version, with an empty log,
+    and start using them on this instance.
+    """
+    version = int(time.time() * 1000)
+    data = zlib.compress(json.dumps({'titles': title_index.to_dict(),
+                                     'tags': tag_index.to_dict()}))
+    chunks = {}
+    for i in range(0, len(data), CHUNK_BYTES):
+        chunks[CHUNK_KEY % (version, i // CHUNK_BYTES)] = \
+            data[i:i + CHUNK_BYTES]
+    not_set = memcache.set_multi(chunks)
+    if not_set:
+        logging.error("memcache.set_multi failed for %s" % not_set)
+    else:
+        memcache.set(DELTA_KEY, {'version': version, 'ops': []})
+        memcache.set(HEADER_KEY, {'version': version,
+                                  'num_chunks': len(chunks)})
+
+    with _lock:
+        _state.update(version=version, titles=title_index, tags=tag_index,
+                      applied=0, checked_at=time.time())
+    logging.info("stored suggest index of %s titles, %s tags, %s bytes" % (
+        len(title_index), len(tag_index), len(data)))
+    return title_index, tag_index
+
+def queue_rebuild():
+    """Rebuild soon; requests within REBUILD_BATCH_SECONDS share a task."""
+    batch = int(time.time() // REBUILD_BATCH_SECONDS)
+    try:
+        taskqueue.add(url=SUGGEST_BUILD_URL, name='suggest-build-%s' % batch)
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        pass
+
+def _load(header):
+    names = [CHUNK_KEY % (header['version'], n)
+             for n in range(header['num_chunks'])]
+    chunks = memcache.get_multi(names)
+    if len(chunks) != len(names):
+        return None
+    data = json.loads(zlib.decompress(''.join(chunks[n] for n in names)))
+    return (PrefixIndex.from_dict(data['titles']),
+            PrefixIndex.from_dict(data['tags']))
+
+def _add_tag(tag_index, tag, change):
+    url = _tag_url(tag)
+    entry = tag_index.entry_nums.get(url)
+    count = (tag_index.weights[entry] if entry is not None else 0) + change
+    if count > 0:
+        tag_index.add(tag, url, count)
+    else:
+        tag_index.remove(url)
+
+def _apply(title_index, tag_index, op):
+    if op['op'] == 'add':
+        if op['url'] in title_index.entry_nums:
+            return
+        title_index.add(op['title'], op['url'])
+        change = 1
+    else:
+        if op['url'] not in title_index.entry_nums:
+            return
+        title_index.remove(op['url'])
+        change = -1
+    for tag in op['tags']:
+        _add_tag(tag_index, tag, change)
+
+def _get_indexes():
+    """
+    This instance's (title index, tag index), brought up to date with
+    memcache at most every DELTA_CHECK_SECONDS. (None, None) if the index
+    hasn't been built.
+    """
+    now = time.time()
+    with _lock:
+        if now - _state['checked_at'] < DELTA_CHECK_SECONDS:
+            return _state['titles'], _state['tags']
+        _state['checked_at'] = now
+        version = _state['version']
+
+    found = memcache.get_multi([HEADER_KEY, DELTA_KEY])
+    header = found.get(HEADER_KEY)
+    if header is None:
+        logging.error("no suggest index in memcache, rebuilding")
+        queue_rebuild()
+        return _state['titles'], _state['tags']
+
+    if header['version'] != version:
+        indexes = _load(header)
+        if indexes is None:
+            queue_rebuild()
+            return _state['titles'], _state['tags']
+        with _lock:
+            _state.update(version=header['version'], titles=indexes[0],
+                          tags=indexes[1], applied=0)
+
+    delta = found.get(DELTA_KEY)
+    with _lock:
+        if delta is not None and delta['version'] == _state['version']:
+            for op in delta['ops'][_state['applied']:]:
+                _apply(_state['titles'], _state['tags'], op)
+            _state['applied'] = len(delta['ops'])
+        return _state['titles'], _state['tags']
+
+def _log(ops):
+    """Append ops to the shared log, for every instance to apply."""
+    if not ops:
+        return
+    client = memcache.Client()
+    for _ in range(DELTA_CAS_RETRIES):
+        delta = client.gets(DELTA_KEY)
+        if delta is None:
+            # No index yet, or it was evicted; a rebuild will include this.
+            queue_rebuild()
+            return
+        delta['ops'].extend(ops)
+        if client.cas(DELTA_KEY, delta):
+            if len(delta['ops']) > MAX_DELTA_OPS:
+                queue_rebuild()
+            return
+    logging.error("couldn't log %s suggest index changes" % len(ops))
+    queue_rebuild()
+
+def plaques_approved(plaques):
+    _log([{'op': 'add', 'title': p.title, 'url': p.title_page_url,
+           'tags': p.tags} for p in plaques])
+
+def plaques_removed(plaques):
+    """Call when plaques are unpublished or deleted."""
+    _log([{'op': 'remove', 'url': p.title_page_url, 'tags': p.tags}
+          for p in plaques])
+
+def plaque_approved(plaque):
+    plaques_approved([plaque])
+
+def plaque_removed(plaque):
+    plaques_removed([plaque])
+
+def suggest(query_string, num=DEF_NUM_SUGGESTIONS):
+    """
+    Up to num tags and num plaque titles completing query_string, as
+    {'tags': [...], 'plaques': [...]} lists of {'title', 'url'} dicts.
+    """
+    num = max(1, min(int(num), MAX_NUM_SUGGESTIONS))
+    title_index, tag_index = _get_indexes()
+    suggestions = {'tags': [], 'plaques': []}
+    if title_index is None:
+        return suggestions
+    # Hold the lock so that no other thread applies a change mid-search.
+    with _lock:
+        for name, index in [('tags', tag_index), ('plaques', title_index)]:
+            suggestions[name] = [
+                {'title': text, 'url': url}
+                for text, url in index.search(query_string, num)]
+    return suggestions
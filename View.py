@@ -39,19 +39,26 @@ def main():
         ('/tag/(.+?)', h.ViewTag),
         #('/tags/?', h.ViewAllTags),
         ('/about', h.About),
-        ('/rss', h.RssFeed),
+        ('/rss/?', h.RssFeed),
+        ('/rss/(.+?)/?', h.RssFeed),
         ('/flush', h.FlushMemcache),
         ('/counts', h.Counts),
-        #('/reindex', h.RedoIndex),
+        ('/reindex', h.ReindexSearch),
         #('/deleteall', h.DeleteEverything),
         ('/delete', h.DeleteOnePlaque),
         ('/pending/?', h.ViewPending),
         ('/pending/(.*?)/?', h.ViewPending),
         ('/nextpending/?', h.ViewNextPending),
+        ('/pendingcount/?', h.PendingCount),
+        ('/api/import', h.ImportPlaques),
+        ('/api/newkey', h.NewApiKey),
+        ('/api/sources/(.+?)/?', h.SourceManifest),
         ('/disapprove', h.DisapprovePlaque),
         ('/approve', h.ApprovePending),
         ('/approveall', h.ApproveAllPending),
-        ('/addsearchall', h.AddSearchIndexAll),
+        ('/moderate/?', h.BulkModerate),
+        ('/moderate/(.+?)/?', h.BulkModerate),
+        ('/addsearchall', h.ReindexSearch),
         ('/deletesearch/(.+?)', h.DeleteOneSearchIndex),
         ('/addtitleurlall', h.AddTitleUrlAll),
         ('/search/(.+?)', h.SearchPlaques),
@@ -59,11 +66,27 @@ def main():
         ('/geo/(.*?)/(.*?)/(.*?)/?', h.SearchPlaquesGeo),
         ('/geo/.+?', h.SearchPlaquesGeo),
         ('/geo/?', h.SearchPlaquesGeo),
+        ('/nearby/(.+?)/(.+?)/(.+?)/?', h.NearbyPlaques),
+        ('/nearby/(.+?)/(.+?)/?', h.NearbyPlaques),
+        ('/bboxjp/(.+?)/(.+?)/(.+?)/(.+?)/?', h.JsonBboxPlaques),
+        ('/suggest/?', h.SuggestPlaques),
         ('/s/(.+?)', h.SearchPlaques),
         ('/s/?', h.SearchPlaques),
         ('/setupdated', h.SetUpdatedOn),
         ('/setfeatured/(.*?)', h.SetFeatured),
         ('/map/?', h.BigMap),
+        ('/_ah/warmup', h.Warmup),
+        ('/tasks/prerender', h.Prerender),
+        ('/tasks/buildlocalindex', h.BuildLocalSearchIndex),
+        ('/tasks/buildsuggest', h.BuildSuggestIndex),
+        ('/tasks/setgeohash', h.SetGeohash),
+        ('/tasks/setnearby', h.SetNearby),
+        ('/tasks/reindexshard', h.ReindexShardTask),
+        ('/tasks/checksearchindex', h.CheckSearchIndex),
+        ('/tasks/recount', h.RecountPlaques),
+        ('/tasks/fetchimages', h.FetchImages),
+        ('/tasks/moderate', h.ModerationTask),
+        ('/tasks/updatenearby', h.UpdateNearby),
 
         ('/', h.ViewPlaquesPage),
         ('/(.+?)/(.+?)', h.ViewOnePlaque), # supports the old_site_id
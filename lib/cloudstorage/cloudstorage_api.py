@@ -49,7 +49,9 @@ def open(filename,
          read_buffer_size=storage_api.ReadBuffer.DEFAULT_BUFFER_SIZE,
          retry_params=None,
          _account_id=None,
-         offset=0):
+         offset=0,
+         read_ahead=storage_api.ReadBuffer.DEFAULT_READ_AHEAD,
+         stat=None):
   """Opens a Google Cloud Storage file and returns it as a File-like object.
 
   Args:
@@ -66,14 +68,19 @@ def open(filename,
       See https://developers.google.com/storage/docs/reference-headers
       for details.
     read_buffer_size: The buffer size for read. Read keeps a buffer
-      and prefetches another one. To minimize blocking for large files,
-      always read by buffer size. To minimize number of RPC requests for
-      small files, set a large buffer size. Max is 30MB.
+      and prefetches up to read_ahead more. To minimize blocking for large
+      files, always read by buffer size. To minimize number of RPC requests
+      for small files, set a large buffer size. Max is 30MB.
     retry_params: An instance of api_utils.RetryParams for subsequent calls
       to GCS from this file handle. If None, the default one is used.
     _account_id: Internal-use only.
     offset: Number of bytes to skip at the start of the file. If None, 0 is
       used.
+    read_ahead: The number of segments that read fetches concurrently, both
+      ahead of the caller and for large reads. See storage_api.ReadBuffer.
+    stat: The file's GCSFileStat, e.g. from listbucket, if the caller has it,
+      so that opening the file doesn't need to get its size and etag. Only
+      valid in reading mode.
 
   Returns:
     A reading or writing buffer that supports File-like interface. Buffer
@@ -83,7 +90,7 @@ def open(filename,
     errors.AuthorizationError: if authorization failed.
     errors.NotFoundError: if an object that's expected to exist doesn't.
     ValueError: invalid open mode or if content_type or options are specified
-      in reading mode.
+      in reading mode, or stat in writing mode.
   """
   common.validate_file_path(filename)
   api = storage_api._get_storage_api(retry_params=retry_params,
@@ -91,6 +98,8 @@ def open(filename,
   filename = api_utils._quote_filename(filename)
 
   if mode == 'w':
+    if stat:
+      raise ValueError('stat can only be specified for reading mode.')
     common.validate_options(options)
     return storage_api.StreamingBuffer(api, filename, content_type, options)
   elif mode == 'r':
@@ -100,7 +109,9 @@ def open(filename,
     return storage_api.ReadBuffer(api,
                                   filename,
                                   buffer_size=read_buffer_size,
-                                  offset=offset)
+                                  offset=offset,
+                                  read_ahead=read_ahead,
+                                  stat=stat)
   else:
     raise ValueError('Invalid mode %s.' % mode)
 
@@ -23,7 +23,9 @@ __all__ = ['ReadBuffer',
           ]
 
 import collections
+import logging
 import os
+import time
 import urlparse
 
 from . import api_utils
@@ -207,28 +209,56 @@ _StorageApi = rest_api.add_sync_methods(_StorageApi)
 
 
 class ReadBuffer(object):
-  """A class for reading Google storage files."""
+  """A class for reading Google storage files.
+
+  Reads ahead of the caller with a window of up to read_ahead concurrent
+  ranged GETs, which are consumed in file order whatever order they complete
+  in. Read-ahead segments start at buffer_size and are resized as they
+  arrive: doubled while they come back faster than TARGET_SEGMENT_SECONDS
+  (so per-request latency dominates) and halved when they are slower, so
+  that the window keeps up with the connection's throughput. The window
+  never holds more than MAX_READ_AHEAD_BYTES, or read_ahead buffers,
+  whichever is larger.
+
+  Opening a file costs one request: the file's size and etag come from the
+  first ranged GET's Content-Range and ETag headers, or from a GCSFileStat
+  the caller already has, and a HEAD is only made if neither says. A file
+  no bigger than one read-ahead segment, whose size is known from a
+  GCSFileStat, is read in that one request. rpc_counts has the number of
+  GETs and HEADs made so far.
+  """
 
   DEFAULT_BUFFER_SIZE = 1024 * 1024
   MAX_REQUEST_SIZE = 30 * DEFAULT_BUFFER_SIZE
+  DEFAULT_READ_AHEAD = 4
+  MAX_READ_AHEAD_BYTES = 8 * DEFAULT_BUFFER_SIZE
+  TARGET_SEGMENT_SECONDS = 0.5
 
   def __init__(self,
                api,
                path,
                buffer_size=DEFAULT_BUFFER_SIZE,
                max_request_size=MAX_REQUEST_SIZE,
-               offset=0):
+               offset=0,
+               read_ahead=DEFAULT_READ_AHEAD,
+               stat=None):
     """Constructor.
 
     Args:
       api: A StorageApi instance.
       path: Quoted/escaped path to the object, e.g. /mybucket/myfile
-      buffer_size: buffer size. The ReadBuffer keeps
-        one buffer. But there may be a pending future that contains
-        a second buffer. This size must be less than max_request_size.
+      buffer_size: buffer size, and the initial size of read-ahead segments.
+        The ReadBuffer keeps one buffer, plus up to read_ahead pending
+        futures that contain the next segments. This size must be less than
+        max_request_size.
       max_request_size: Max bytes to request in one urlfetch.
       offset: Number of bytes to skip at the start of the file. If None, 0 is
         used.
+      read_ahead: Max number of segments to request concurrently, both when
+        reading ahead and for large reads. 1 reads ahead one segment at a
+        time.
+      stat: Optional GCSFileStat of the file, e.g. from listbucket, to take
+        its size and etag from instead of asking GCS.
     """
     self._api = api
     self._path = path
@@ -236,27 +266,83 @@ class ReadBuffer(object):
     self.closed = False
 
     assert buffer_size <= max_request_size
+    assert read_ahead >= 1
     self._buffer_size = buffer_size
     self._max_request_size = max_request_size
     self._offset = offset
+    self._read_ahead = read_ahead
+    self._segment_size = buffer_size
 
     self._buffer = _Buffer()
+    self._pending = collections.deque()
     self._etag = None
+    self.rpc_counts = collections.defaultdict(int)
+
+    if stat is not None:
+      self._file_size = long(stat.st_size)
+      self._check_etag(stat.etag)
+      content = ''
+      remaining = self._file_size - offset
+      if remaining > 0:
+        if remaining <= self._max_segment_size():
+          request_size = remaining
+        else:
+          request_size = self._buffer_size
+        content = self._get_segment(offset, request_size).get_result()
+    else:
+      content = self._get_first_segment(offset)
+    # Like seek(), an offset past the end is taken as the end.
+    self._offset = min(self._offset, self._file_size)
 
-    get_future = self._get_segment(offset, self._buffer_size, check_response=False)
+    if content:
+      self._buffer.reset(content)
+      self._request_next_buffer()
 
-    status, headers, content = self._api.head_object(path)
-    errors.check_status(status, [200], path, resp_headers=headers, body=content)
-    self._file_size = long(common.get_stored_content_length(headers))
-    self._check_etag(headers.get('etag'))
+  def _get_first_segment(self, offset):
+    """Get the segment at offset, and the file's size and etag with it.
 
-    self._buffer_future = None
+    A ranged response's Content-Range header ends with the file's total size,
+    so this usually takes one request. GCS answers a range that starts at or
+    past the end, e.g. any range of an empty file, with a 416.
 
-    if self._file_size != 0:
-      content, check_response_closure = get_future.get_result()
-      check_response_closure()
-      self._buffer.reset(content)
-      self._request_next_buffer()
+    Args:
+      offset: start offset of the segment.
+
+    Returns:
+      The segment of up to self._buffer_size bytes at offset, as str.
+    """
+    end = offset + self._buffer_size - 1
+    headers = {'Range': 'bytes=%d-%d' % (offset, end)}
+    status, resp_headers, content = self._api.get_object(self._path,
+                                                         headers=headers)
+    self.rpc_counts['get'] += 1
+    errors.check_status(status, [200, 206, 416], self._path, headers,
+                        resp_headers, body=content)
+
+    content_range = resp_headers.get('content-range', '')
+    total = content_range.rpartition('/')[2]
+    if status == 200:
+      # The whole file, despite the Range header.
+      self._file_size = long(len(content))
+      content = content[offset:offset + self._buffer_size]
+    elif total.isdigit():
+      self._file_size = long(total)
+    else:
+      self._head()
+
+    if status == 416:
+      return ''
+    self._check_etag(resp_headers.get('etag'))
+    return content
+
+  def _head(self):
+    """Get the file's size and etag with a HEAD request."""
+    status, headers, content = self._api.head_object(self._path)
+    self.rpc_counts['head'] += 1
+    errors.check_status(status, [200], self._path, resp_headers=headers,
+                        body=content)
+    self._file_size = long(common.get_stored_content_length(headers))
+    self._check_etag(headers.get('etag'))
 
   def __getstate__(self):
     """Store state as part of serialization/pickling.
@@ -273,6 +359,8 @@ class ReadBuffer(object):
             'path': self._path,
             'buffer_size': self._buffer_size,
             'request_size': self._max_request_size,
+            'read_ahead': self._read_ahead,
+            'segment_size': self._segment_size,
             'etag': self._etag,
             'size': self._file_size,
             'offset': self._offset,
@@ -291,12 +379,15 @@ class ReadBuffer(object):
     self.name = api_utils._unquote_filename(self._path)
     self._buffer_size = state['buffer_size']
     self._max_request_size = state['request_size']
+    self._read_ahead = state.get('read_ahead', self.DEFAULT_READ_AHEAD)
+    self._segment_size = state.get('segment_size', self._buffer_size)
     self._etag = state['etag']
     self._file_size = state['size']
     self._offset = state['offset']
     self._buffer = _Buffer()
     self.closed = state['closed']
-    self._buffer_future = None
+    self._pending = collections.deque()
+    self.rpc_counts = collections.defaultdict(int)
     if self._remaining() and not self.closed:
       self._request_next_buffer()
 
@@ -352,7 +443,7 @@ class ReadBuffer(object):
       data_list.append(data)
       if size == 0 or not self._remaining():
         return ''.join(data_list)
-      self._buffer.reset(self._buffer_future.get_result())
+      self._buffer.reset(self._next_segment())
       self._request_next_buffer()
       newline_offset = self._buffer.find_newline(size)
 
@@ -391,8 +482,10 @@ class ReadBuffer(object):
         size -= remaining
         self._offset += remaining
         data_list.append(self._buffer.read())
+        if size == 0 or not self._remaining():
+          break
 
-        if self._buffer_future is None:
+        if not self._pending:
           if size < 0 or size >= self._remaining():
             needs = self._remaining()
           else:
@@ -401,33 +494,71 @@ class ReadBuffer(object):
           self._offset += needs
           break
 
-        if self._buffer_future:
-          self._buffer.reset(self._buffer_future.get_result())
-          self._buffer_future = None
+        self._buffer.reset(self._next_segment())
 
-    if self._buffer_future is None:
-      self._request_next_buffer()
+    self._request_next_buffer()
     return ''.join(data_list)
 
   def _remaining(self):
     return self._file_size - self._offset
 
+  def _next_segment(self):
+    """Wait for the next read-ahead segment, in file order.
+
+    Requires self._buffer to have been consumed.
+
+    Returns:
+      The segment of the file that starts at self._offset.
+    """
+    if not self._pending:
+      self._request_next_buffer()
+    _, future = self._pending.popleft()
+    return future.get_result()
+
+  def _max_segment_size(self):
+    return max(self._buffer_size,
+               min(self._max_request_size,
+                   self.MAX_READ_AHEAD_BYTES // self._read_ahead))
+
   def _request_next_buffer(self):
-    """Request next buffer.
+    """Fill the read-ahead window with requests for the next segments.
 
-    Requires self._offset and self._buffer are in consistent state.
+    Requires self._offset, self._buffer and self._pending are in consistent
+    state.
     """
-    self._buffer_future = None
-    next_offset = self._offset + self._buffer.remaining()
-    if next_offset != self._file_size:
-      self._buffer_future = self._get_segment(next_offset,
-                                              self._buffer_size)
+    next_offset = (self._offset + self._buffer.remaining() +
+                   sum(size for size, _ in self._pending))
+    while (len(self._pending) < self._read_ahead and
+           next_offset < self._file_size):
+      size = min(self._segment_size, self._file_size - next_offset)
+      self._pending.append((size, self._get_read_ahead_segment(next_offset,
+                                                               size)))
+      next_offset += size
+
+  @ndb.tasklet
+  def _get_read_ahead_segment(self, start, request_size):
+    """_get_segment, timed to adjust the size of the following segments."""
+    started = time.time()
+    content = yield self._get_segment(start, request_size)
+    if request_size >= self._segment_size:
+      self._adjust_segment_size(time.time() - started)
+    raise ndb.Return(content)
+
+  def _adjust_segment_size(self, seconds):
+    """Resize read-ahead segments after one took this many seconds."""
+    if seconds < self.TARGET_SEGMENT_SECONDS / 2:
+      self._segment_size = min(self._segment_size * 2,
+                               self._max_segment_size())
+    elif seconds > self.TARGET_SEGMENT_SECONDS * 2:
+      self._segment_size = max(self._segment_size // 2, self._buffer_size)
 
   def _get_segments(self, start, request_size):
     """Get segments of the file from Google Storage as a list.
 
     A large request is broken into segments to avoid hitting urlfetch
-    response size limit. Each segment is returned from a separate urlfetch.
+    response size limit, and so that up to read_ahead of them are fetched at
+    once. Each segment is returned from a separate urlfetch. Segments are
+    collected in order; as each one arrives, the next is requested.
 
     Args:
       start: start offset to request. Inclusive. Have to be within the
@@ -441,15 +572,19 @@ class ReadBuffer(object):
       return []
 
     end = start + request_size
-    futures = []
-
-    while request_size > self._max_request_size:
-      futures.append(self._get_segment(start, self._max_request_size))
-      request_size -= self._max_request_size
-      start += self._max_request_size
-    if start < end:
-      futures.append(self._get_segment(start, end - start))
-    return [fut.get_result() for fut in futures]
+    segment_size = -(-request_size // self._read_ahead)  # Rounded up.
+    segment_size = min(max(segment_size, self._buffer_size),
+                       self._max_request_size)
+    futures = collections.deque()
+    segments = []
+
+    while start < end or futures:
+      while start < end and len(futures) < self._read_ahead:
+        size = min(segment_size, end - start)
+        futures.append(self._get_segment(start, size))
+        start += size
+      segments.append(futures.popleft().get_result())
+    return segments
 
   @ndb.tasklet
   def _get_segment(self, start, request_size, check_response=True):
@@ -472,17 +607,20 @@ class ReadBuffer(object):
       first invoke the closure before consuing the file segment.
 
     Raises:
-      ValueError: if the file has changed while reading.
+      ValueError: if the file has changed while reading, or isn't the size
+        that the GCSFileStat given to __init__ said.
     """
     end = start + request_size - 1
     content_range = '%d-%d' % (start, end)
     headers = {'Range': 'bytes=' + content_range}
+    self.rpc_counts['get'] += 1
     status, resp_headers, content = yield self._api.get_object_async(
         self._path, headers=headers)
     def _checker():
       errors.check_status(status, [200, 206], self._path, headers,
                           resp_headers, body=content)
       self._check_etag(resp_headers.get('etag'))
+      self._check_size(resp_headers.get('content-range', ''))
     if check_response:
       _checker()
       raise ndb.Return(content)
@@ -494,8 +632,8 @@ class ReadBuffer(object):
     If self._etag is None, set it. If etag is set, check that the new
     etag equals the old one.
 
-    In the __init__ method, we fire one HEAD and one GET request using
-    ndb tasklet. One of them would return first and set the first value.
+    The first value comes from the GCSFileStat given to __init__, or from
+    the first GET of the file, or its HEAD.
 
     Args:
       etag: etag from a GCS HTTP response. None if etag is not part of the
@@ -509,13 +647,31 @@ class ReadBuffer(object):
       return
     elif self._etag is None:
       self._etag = etag
-    elif self._etag != etag:
+    elif self._etag.strip('"') != etag.strip('"'):
+      # GCSFileStat etags have no quotes, and ETag headers do.
       raise ValueError('File on GCS has changed while reading.')
 
+  def _check_size(self, content_range):
+    """Check that a ranged response's total size is the one read so far.
+
+    Args:
+      content_range: the Content-Range header of a GCS response, e.g.
+        'bytes 0-99/1234', or '' if it had none.
+
+    Raises:
+      ValueError: if the sizes are not equal.
+    """
+    total = content_range.rpartition('/')[2]
+    if total.isdigit() and long(total) != self._file_size:
+      raise ValueError('File on GCS is %s bytes, not the %s expected.' %
+                       (total, self._file_size))
+
   def close(self):
+    if not self.closed:
+      logging.debug('Read %s with %s', self.name, dict(self.rpc_counts))
     self.closed = True
     self._buffer = None
-    self._buffer_future = None
+    self._pending = collections.deque()
 
   def __enter__(self):
     return self
@@ -542,7 +698,7 @@ class ReadBuffer(object):
     self._check_open()
 
     self._buffer.reset()
-    self._buffer_future = None
+    self._pending.clear()
 
     if whence == os.SEEK_SET:
       self._offset = offset
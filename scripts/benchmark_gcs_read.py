@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+"""
+Time reading a large object through lib/cloudstorage's ReadBuffer, for
+several read-ahead window sizes, against a fake GCS server on localhost
+that adds a fixed latency to each request and serves each one at a
+limited rate, as a real connection to GCS would. Prints MB/s for reading
+the object whole and in buffer-sized chunks, and the time and requests it
+takes to open and read a small object, with and without a GCSFileStat.
+
+Needs the App Engine SDK, for the urlfetch and ndb stubs:
+
+    PYTHONPATH=<path to the SDK> python benchmark_gcs_read.py [size in MB]
+"""
+
+import BaseHTTPServer
+import os
+import SocketServer
+import sys
+import threading
+import time
+
+import dev_appserver
+dev_appserver.fix_sys_path()
+
+from google.appengine.ext import testbed
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import lib.cloudstorage as gcs
+
+WINDOW_SIZES = [1, 2, 4, 8]
+DEFAULT_SIZE_MB = 16
+LATENCY_SECONDS = 0.05
+BYTES_PER_SECOND = 4 * 1024 * 1024 # for each request
+OBJECT_PATH = '/bucket/snapshot.json'
+SMALL_OBJECT_PATH = '/bucket/prerendered/index.html'
+SMALL_OBJECT_BYTES = 20 * 1024
+NUM_SMALL_READS = 20
+MB = 1024.0 * 1024.0
+
+class FakeGcsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """HEADs and ranged GETs of some objects, slowly."""
+    objects = {} # path -> content
+
+    @property
+    def content(self):
+        return self.objects[self.path[len('/_ah/gcs'):]]
+
+    def log_message(self, format, *args):
+        pass
+
+    def _headers(self, status, length, content_range=None):
+        self.send_response(status)
+        self.send_header('Content-Length', str(length))
+        self.send_header('ETag', '"fake"')
+        if content_range:
+            self.send_header('Content-Range', content_range)
+        self.end_headers()
+
+    def do_HEAD(self):
+        time.sleep(LATENCY_SECONDS)
+        self._headers(200, len(self.content))
+
+    def do_GET(self):
+        time.sleep(LATENCY_SECONDS)
+        content = self.content
+        start, end = 0, len(content) - 1
+        range_header = self.headers.get('Range')
+        if range_header:
+            start, end = [int(n) for n in range_header[6:].split('-')]
+            end = min(end, len(content) - 1)
+        body = content[start:end + 1]
+        self._headers(206, len(body), 'bytes %s-%s/%s' % (
+            start, end, len(content)))
+        time.sleep(len(body) / float(BYTES_PER_SECOND))
+        self.wfile.write(body)
+
+class FakeGcsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def start_server(objects):
+    FakeGcsHandler.objects = objects
+    server = FakeGcsServer(('localhost', 0), FakeGcsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def timed_read(read_ahead, chunk_size=None):
+    start = time.time()
+    with gcs.open(OBJECT_PATH, read_ahead=read_ahead) as fh:
+        if chunk_size is None:
+            num_bytes = len(fh.read())
+        else:
+            num_bytes = 0
+            chunk = fh.read(chunk_size)
+            while chunk:
+                num_bytes += len(chunk)
+                chunk = fh.read(chunk_size)
+    return num_bytes / MB / (time.time() - start)
+
+def timed_small_reads(stat=None):
+    """Mean milliseconds per open and read, and the requests made."""
+    rpc_counts = {}
+    start = time.time()
+    for _ in range(NUM_SMALL_READS):
+        with gcs.open(SMALL_OBJECT_PATH, stat=stat) as fh:
+            fh.read()
+            rpc_counts = dict(fh.rpc_counts)
+    return 1000 * (time.time() - start) / NUM_SMALL_READS, rpc_counts
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_SIZE_MB
+    small_content = os.urandom(SMALL_OBJECT_BYTES)
+    server = start_server({
+        OBJECT_PATH: os.urandom(int(size_mb * MB)),
+        SMALL_OBJECT_PATH: small_content,
+    })
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_app_identity_stub()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_urlfetch_stub()
+    # lib/cloudstorage talks to http://$HTTP_HOST/_ah/gcs on a dev server.
+    os.environ['SERVER_SOFTWARE'] = 'Development/benchmark'
+    os.environ['HTTP_HOST'] = 'localhost:%s' % server.server_address[1]
+
+    print("%s MB object, %sms latency, %.1f MB/s per request" % (
+        size_mb, int(LATENCY_SECONDS * 1000), BYTES_PER_SECOND / MB))
+    for read_ahead in WINDOW_SIZES:
+        whole = timed_read(read_ahead)
+        chunked = timed_read(read_ahead,
+                             gcs.ReadBuffer.DEFAULT_BUFFER_SIZE)
+        print("read_ahead=%s whole=%.2f MB/s chunked=%.2f MB/s" % (
+            read_ahead, whole, chunked))
+
+    stat = gcs.GCSFileStat(SMALL_OBJECT_PATH, len(small_content), 'fake',
+                           time.time())
+    for name, small_stat in [('no stat', None), ('stat', stat)]:
+        millis, rpc_counts = timed_small_reads(small_stat)
+        print("%s KB object, %s: %.1fms per open and read, requests %s" % (
+            SMALL_OBJECT_BYTES // 1024, name, millis, rpc_counts))
+
+    bed.deactivate()
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compare geographic search latencies: the geohash datastore index against
+the old Search API distance query (/geo/...?engine=searchapi), for several
+radii around a set of places, plus the nearest-plaques page.
+
+Each URL is fetched twice; the second fetch shows the warm-cache time.
+
+    python benchmark_geo.py
+"""
+
+import requests
+import time
+
+#site_url = 'http://localhost:8080'
+site_url = 'http://readtheplaque.com'
+
+PLACES = [
+    ('london', 51.5074, -0.1278),
+    ('new york', 40.7128, -74.0059),
+    ('san francisco', 37.7749, -122.4194),
+    ('sydney', -33.8688, 151.2093),
+]
+RADII_METERS = [500, 5000, 50000]
+NEAREST_NUMS = [10, 50]
+
+def timed_get(session, url):
+    start = time.time()
+    resp = session.get(url)
+    elapsed = time.time() - start
+    return resp, elapsed
+
+def cold_warm(session, url):
+    resp, cold = timed_get(session, url)
+    resp, warm = timed_get(session, url)
+    return resp.status_code, cold, warm
+
+def main():
+    session = requests.Session()
+    for name, lat, lng in PLACES:
+        for radius in RADII_METERS:
+            url = '%s/geo/%s/%s/%s' % (site_url, lat, lng, radius)
+            for engine in ['geohash', 'searchapi']:
+                engine_url = url
+                if engine == 'searchapi':
+                    engine_url += '?engine=searchapi'
+                status, cold, warm = cold_warm(session, engine_url)
+                print("%-14s r=%6sm %-9s status=%s cold=%.3fs warm=%.3fs" % (
+                    name, radius, engine, status, cold, warm))
+
+        for num in NEAREST_NUMS:
+            url = '%s/nearby/%s/%s/%s' % (site_url, lat, lng, num)
+            status, cold, warm = cold_warm(session, url)
+            print("%-14s nearest %3s         status=%s cold=%.3fs warm=%.3fs" % (
+                name, num, status, cold, warm))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+"""
+Time the paginated plaque listing: walk the /page/<cursor> chain to a given
+depth for several page sizes, fetching each page twice (the second fetch
+should be a warm cache hit), and print the timings.
+
+    python benchmark_pages.py [depth]
+"""
+
+import re
+import requests
+import sys
+import time
+
+#site_url = 'http://localhost:8080'
+site_url = 'http://readtheplaque.com'
+flush_url = site_url + '/flush'
+
+PAGE_SIZES = [10, 20, 50, 100]
+DEFAULT_DEPTH = 10
+NEXT_PAGE_RE = re.compile(r'href="/page/([^"]+)"')
+
+def timed_get(session, url):
+    start = time.time()
+    resp = session.get(url)
+    elapsed = time.time() - start
+    return resp, elapsed
+
+def walk_pages(session, per_page, depth):
+    """Return a list of (page number, cold seconds, warm seconds)."""
+    timings = []
+    cursor = ''
+    for page_num in range(depth):
+        url = '%s/page/%s?per_page=%s' % (site_url, cursor, per_page)
+        resp, cold = timed_get(session, url)
+        resp, warm = timed_get(session, url)
+        timings.append((page_num, cold, warm))
+
+        match = NEXT_PAGE_RE.search(resp.text)
+        if match is None:
+            break
+        cursor = match.group(1)
+    return timings
+
+def main():
+    depth = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_DEPTH
+    session = requests.Session()
+    session.get(flush_url)
+
+    for per_page in PAGE_SIZES:
+        timings = walk_pages(session, per_page, depth)
+        for page_num, cold, warm in timings:
+            print("per_page=%3s page=%3s cold=%.3fs warm=%.3fs" % (
+                per_page, page_num, cold, warm))
+        if timings:
+            mean_cold = sum(t[1] for t in timings) / len(timings)
+            mean_warm = sum(t[2] for t in timings) / len(timings)
+            print("per_page=%3s mean cold=%.3fs warm=%.3fs" % (
+                per_page, mean_cold, mean_warm))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+"""
+Time parsing a source's pages, using the pages already in the scrape cache
+as fixtures (scrape the source once first): a whole BeautifulSoup with
+html.parser (how the scrapers used to parse), a whole soup with lxml, the
+source's own parse, and the source's parse on a pool of processes.
+
+    python benchmark_parsing.py geograph [num_pages] [num_processes]
+"""
+
+import multiprocessing
+import sys
+import time
+
+from bs4 import BeautifulSoup
+
+import scrape
+
+DEFAULT_NUM_PAGES = 200
+
+def cached_pages(source, num_pages):
+    """(url, text) for up to num_pages of the source's cached pages."""
+    fetcher = scrape.Fetcher(offline=True)
+    pages = []
+    for url in source.list_urls(fetcher):
+        try:
+            pages.append((url, fetcher.get(url).text))
+        except IOError:
+            continue
+        if len(pages) >= num_pages:
+            break
+    return pages
+
+def timed(parse, pages):
+    start = time.time()
+    for url, text in pages:
+        parse(url, text)
+    return time.time() - start
+
+def timed_pool(source_name, pages, num_processes):
+    pool = multiprocessing.Pool(num_processes)
+    pool.map(scrape._parse_in_process, [(source_name, u, t)
+                                        for u, t in pages[:num_processes]])
+    start = time.time()
+    pool.map(scrape._parse_in_process, [(source_name, u, t)
+                                        for u, t in pages])
+    elapsed = time.time() - start
+    pool.close()
+    return elapsed
+
+def main():
+    source_name = sys.argv[1]
+    num_pages = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_NUM_PAGES
+    num_processes = int(sys.argv[3]) if len(sys.argv) > 3 else \
+                    multiprocessing.cpu_count()
+    source = scrape.load_source(source_name)
+    pages = cached_pages(source, num_pages)
+    if not pages:
+        sys.exit("none of %s's pages are in the cache" % source_name)
+    # For the sources whose parse fetches more pages, from the cache.
+    fetcher = scrape.Fetcher(offline=True)
+
+    timings = [
+        ('html.parser soup', timed(
+            lambda u, t: BeautifulSoup(t, 'html.parser'), pages)),
+        ('source.parse', timed(
+            lambda u, t: scrape.parse_page(source, u, t, fetcher), pages)),
+    ]
+    if scrape.lxml is not None:
+        timings.insert(1, ('lxml soup', timed(
+            lambda u, t: BeautifulSoup(t, 'lxml'), pages)))
+    if not source.parse_uses_fetcher:
+        timings.append(('source.parse x%s processes' % num_processes,
+                        timed_pool(source_name, pages, num_processes)))
+
+    for name, elapsed in timings:
+        print("%-30s %3s pages %.3fs %.1fms/page" % (
+            name, len(pages), elapsed, 1000.0 * elapsed / len(pages)))
+
+if __name__ == '__main__':
+    main()
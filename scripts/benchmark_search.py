@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+"""
+Time queries against the local inverted index and the /suggest prefix
+index (LocalSearch.py).
+
+With no arguments, index NUM_PLAQUES synthetic plaques. Given the path of a
+full JSON dump of the plaques (from /fulljp), index those instead.
+
+    python benchmark_search.py [fulljp.json]
+"""
+
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from LocalSearch import InvertedIndex, PrefixIndex
+
+NUM_PLAQUES = 100000
+VOCABULARY_SIZE = 20000
+WORDS_PER_DESCRIPTION = 80
+NUM_RUNS = 20
+QUERIES = [
+    'w1',
+    'w10 w200',
+    'w5 w50 w500',
+    'w12',   # prefix: w12, w120, w1200, ...
+    'nosuchword',
+]
+SUGGEST_QUERIES = ['w', 'w1', 'w12', 'w123', 'w5 w1', 'nosuchword']
+
+def synthetic_plaques(num, seed=1):
+    rng = random.Random(seed)
+    # Zipf-ish: low-numbered words are much more common.
+    def word():
+        return 'w%s' % int(VOCABULARY_SIZE ** rng.random())
+    for i in range(num):
+        yield {
+            'plaque_key': 'key%s' % i,
+            'title': ' '.join(word() for _ in range(5)),
+            'tags': [word() for _ in range(3)],
+            'description': ' '.join(
+                word() for _ in range(WORDS_PER_DESCRIPTION)),
+            'location': '%s,%s' % (rng.uniform(-60, 60),
+                                   rng.uniform(-180, 180)),
+            'created_on': i,
+        }
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - start
+
+def time_suggest(plaques):
+    titles = [(p['title'], '/plaque/%s' % p['plaque_key'], 0)
+              for p in plaques]
+    index, elapsed = timed(PrefixIndex.build, titles)
+    print("suggest: indexed %s titles in %.2fs" % (len(index), elapsed))
+
+    for query in SUGGEST_QUERIES:
+        times = []
+        for _ in range(NUM_RUNS):
+            results, elapsed = timed(index.search, query, 8)
+            times.append(elapsed)
+        times.sort()
+        print("suggest %-12s found=%2s p50=%6.2fms max=%6.2fms" % (
+            query, len(results), 1000 * times[len(times) // 2],
+            1000 * times[-1]))
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as fh:
+            plaques = json.load(fh)
+    else:
+        plaques = list(synthetic_plaques(NUM_PLAQUES))
+
+    index, elapsed = timed(InvertedIndex.from_plaque_dicts, plaques)
+    print("indexed %s plaques in %.2fs" % (len(index), elapsed))
+
+    data, elapsed = timed(index.to_dict)
+    text = json.dumps(data)
+    print("serialized to %.1f MB in %.2fs" % (len(text) / 1e6, elapsed))
+    index, elapsed = timed(InvertedIndex.from_dict, json.loads(text))
+    print("reloaded in %.2fs" % elapsed)
+
+    for query in QUERIES:
+        for sort in ['relevance', 'recent']:
+            times = []
+            for _ in range(NUM_RUNS):
+                (doc_ids, number_found), elapsed = timed(
+                    index.search, query, limit=20, sort=sort)
+                times.append(elapsed)
+            times.sort()
+            print("%-15s %-9s found=%6s p50=%6.1fms p90=%6.1fms" % (
+                query, sort, number_found, 1000 * times[len(times) // 2],
+                1000 * times[int(len(times) * 0.9)]))
+
+    times = []
+    for _ in range(NUM_RUNS):
+        hits, elapsed = timed(index.geo_search, 51.5, -0.1, 500000)
+        times.append(elapsed)
+    times.sort()
+    print("geo 500km        found=%6s p50=%6.1fms" % (
+        len(hits), 1000 * times[len(times) // 2]))
+
+    time_suggest(plaques)
+
+if __name__ == '__main__':
+    main()
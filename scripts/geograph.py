@@ -1,135 +1,128 @@
 # -*- coding: utf-8 -*-
 
-from bs4 import BeautifulSoup
-import re
-import requests
-import urllib
-import tempfile
+"""
+Plaque photos from Geograph (geograph.org.uk, or geograph.org.gg), by the
+photo ids listed in geograph_ids.txt (geograph_gg_ids.txt). See scrape.py.
+
+    RTP_API_KEY=<key> python geograph.py
+"""
+
 import os
-import logging
-import time
-import sys
-
-
-IS_GG = False
-
-#site_url = 'http://readtheplaque.com'
-#site_url = 'http://localhost:8080'
-site_url = 'http://10.10.40.65:8080'
-post_url = site_url + '/add'
-flush_url = site_url + '/flush'
-
-if IS_GG:
-    BASE_URL = 'http://www.geograph.org.gg'
-else:
-    BASE_URL = 'http://www.geograph.org.uk'
-
-def get_copyright_text(soup):
-    cc_msg = soup.find('div', {'class': 'ccmessage'})
-    copyright_text = " ".join(
-        [c.encode('utf-8').strip() for c in cc_msg.contents])
-    copyright_text = copyright_text.replace('="/', '="%s/' % BASE_URL)
-    copyright_text = copyright_text.decode('utf-8')
-    return copyright_text
-
-def get_plaque_data(plaque_url):
-    get_resp = requests.get(plaque_url)
-    soup = BeautifulSoup(get_resp.text, 'html.parser')
-
-    # Check that there is a result:
-    #
-    maincontent = soup.find('div', {'id': 'maincontent'})
-    if "is not available" in maincontent.text:
-        return None
-
-    img_url = soup.find('div', {'id': 'mainphoto'}).find('img').get('src')
-
-    if IS_GG:
-        captions = soup.find_all('div', {'class': 'caption'})
-        try:
-            title = captions[0].text
-        except:
-            title = 'Geograph.org.gg Plaque'
-
-        try:
-            description = captions[1].text
-        except:
-            description = ''
-    else:
-        try:
-            title = soup.find('div', {'itemprop': 'name'}).text
-        except:
-            title = 'Geograph Plaque'
-        try:
-            description = soup.find('div', {'itemprop': 'description'}).text
-        except:
-            description = ''
-
-    copyright_text = get_copyright_text(soup)
-
-    description = u'''<p>{0}</p> <p>{1}</p> <p>Submitted via <a href="{2}">Geograph</a></p>'''.format(description, copyright_text, unicode(plaque_url))
-
-    lat = soup.find('abbr', {'class': 'latitude'}).get('title')
-    lng = soup.find('abbr', {'class': 'longitude'}).get('title')
-
-    tags = {t.text.lower() for t in soup.find_all('a', {'class': 'taglink'})}
-    tags.add('geograph')
-    if 'plaque' in tags:
-        tags.remove('plaque')
-    tags_str = ", ".join(list(tags))
-
-    plaque_data = {
-        'lat': lat,
-        'lng': lng,
-        'plaque_image_url': img_url,
-        'plaque_image_file': '',
-        'title': title,
-        'tags': tags_str,
-        'description': description,
-    }
-    return plaque_data
-
-
-def main():
-    log = logging.getLogger()
-    log.addHandler(logging.StreamHandler())
-    log.setLevel(logging.INFO)
-    ch = logging.StreamHandler(sys.stdout)
-    fh = logging.FileHandler('geograph.log')
-    log.addHandler(ch)
-    log.addHandler(fh)
-    logging.getLogger('requests').setLevel(logging.WARNING)
-    logging.getLogger('urllib3').setLevel(logging.WARNING)
-
-    if IS_GG:
-        filename = 'geograph_gg_ids.txt'
-    else:
-        filename = 'geograph_ids.txt'
-
-    with open(filename) as fh:
-        plaque_ids = [l.strip() for l in fh.readlines()]
-    plaque_ids.reverse()
-
-    #plaque_ids = [3090938, 2817642, 2825358]
-    for i, plaque_id in enumerate(plaque_ids[200:240]):
-        plaque_url = "%s/photo/%s" % (BASE_URL, plaque_id)
-        plaque_data = get_plaque_data(plaque_url)
-        if plaque_data is None:
-            logging.info("skipping %s -- data is None" % plaque_url)
-            continue
-
-        try:
-            post_resp = requests.post(post_url, data=plaque_data)
-            if post_resp.status_code != 200 or 'resubmit.' in post_resp.text:
-                logging.info("FAILED %s" % plaque_url)
-            else:
-                logging.info("successfully copied %s %s to %s" % (i, plaque_url, post_resp))
-        except Exception as err:
-            import ipdb; ipdb.set_trace()
-            logging.info("error (unexpected) %s: cant get %s" % (err, plaque_url))
-
-
-        time.sleep(1)
+
+try:
+    from lxml import etree
+    import lxml.html
+except ImportError:
+    etree = None
+
+import scrape
+from scrape import has_class
+
+class _XPath(object):
+    """
+    An XPath expression, compiled the first time it's used, so that this
+    module loads without lxml.
+    """
+    def __init__(self, expression):
+        self.expression = expression
+        self._compiled = None
+
+    def __call__(self, doc):
+        if self._compiled is None:
+            self._compiled = etree.XPath(self.expression)
+        return self._compiled(doc)
+
+def _text(elements):
+    return elements[0].text_content() if elements else None
+
+class GeographSource(scrape.Source):
+    """
+    The photo pages are big, so the few things needed from them are picked
+    out with XPath expressions compiled once, rather than from a whole soup.
+    """
+    name = 'geograph'
+    base_url = 'http://www.geograph.org.uk'
+    ids_filename = 'geograph_ids.txt'
+
+    maincontent_xpath = _XPath('//div[@id="maincontent"]')
+    img_url_xpath = _XPath('//div[@id="mainphoto"]//img/@src')
+    title_xpath = _XPath('//div[@itemprop="name"]')
+    description_xpath = _XPath('//div[@itemprop="description"]')
+    cc_msg_xpath = _XPath('//div[%s]' % has_class('ccmessage'))
+    lat_xpath = _XPath('//abbr[%s]/@title' % has_class('latitude'))
+    lng_xpath = _XPath('//abbr[%s]/@title' % has_class('longitude'))
+    tags_xpath = _XPath('//a[%s]' % has_class('taglink'))
+
+    def __init__(self):
+        if etree is None:
+            raise ImportError("the %s source needs lxml (pip install lxml)" %
+                              self.name)
+
+    def list_urls(self, fetcher):
+        with open(os.path.join(scrape.SCRIPTS_DIR, self.ids_filename)) as fh:
+            plaque_ids = [l.strip() for l in fh.readlines() if l.strip()]
+        plaque_ids.reverse()
+        return ["%s/photo/%s" % (self.base_url, plaque_id)
+                for plaque_id in plaque_ids]
+
+    def get_copyright_text(self, doc):
+        cc_msg = self.cc_msg_xpath(doc)[0]
+        parts = [cc_msg.text or '']
+        parts.extend(etree.tostring(child, encoding=unicode)
+                     for child in cc_msg)
+        copyright_text = " ".join(p.strip() for p in parts)
+        return copyright_text.replace('="/', '="%s/' % self.base_url)
+
+    def get_title_description(self, doc):
+        title = _text(self.title_xpath(doc)) or 'Geograph Plaque'
+        description = _text(self.description_xpath(doc)) or ''
+        return title, description
+
+    def parse(self, plaque_url, text, fetcher):
+        doc = lxml.html.fromstring(text)
+
+        # Check that there is a result:
+        #
+        if "is not available" in _text(self.maincontent_xpath(doc)):
+            raise scrape.SkipPage("not available")
+
+        img_url = self.img_url_xpath(doc)[0]
+        title, description = self.get_title_description(doc)
+        copyright_text = self.get_copyright_text(doc)
+
+        description = u'''<p>{0}</p> <p>{1}</p> <p>Submitted via <a href="{2}">Geograph</a></p>'''.format(description, copyright_text, unicode(plaque_url))
+
+        lat = self.lat_xpath(doc)[0]
+        lng = self.lng_xpath(doc)[0]
+
+        tags = {t.text_content().lower() for t in self.tags_xpath(doc)}
+        tags.add('geograph')
+        if 'plaque' in tags:
+            tags.remove('plaque')
+
+        plaque_data = {
+            'source_url': plaque_url,
+            'lat': lat,
+            'lng': lng,
+            'img_url': img_url,
+            'title': title,
+            'tags': list(tags),
+            'description': description,
+        }
+        return plaque_data
+
+class GeographGgSource(GeographSource):
+    name = 'geograph_gg'
+    base_url = 'http://www.geograph.org.gg'
+    ids_filename = 'geograph_gg_ids.txt'
+
+    captions_xpath = _XPath('//div[%s]' % has_class('caption'))
+
+    def get_title_description(self, doc):
+        captions = [c.text_content() for c in self.captions_xpath(doc)]
+        title = captions[0] if captions else 'Geograph.org.gg Plaque'
+        description = captions[1] if len(captions) > 1 else ''
+        return title, description
 
 if __name__ == '__main__':
-    main()
+    scrape.main('geograph')
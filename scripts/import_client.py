@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+"""
+Send plaques to the site's /api/import endpoint in NDJSON batches, for the
+scrapers. Get an API key from /api/newkey?name=<scraper> as an admin.
+
+    client = ImportClient(site_url, api_key)
+    for plaque in plaques:
+        client.add(source_url=..., title=..., description=..., lat=...,
+                   lng=..., tags=[...], img_url=...)
+    client.flush()
+
+source_url (or source_id, if given) identifies each plaque, so a scraper
+can be rerun without duplicating the plaques it has already sent; a
+plaque sent again with different content is updated. manifest() gets the
+content_hash() of everything already sent from a source, so that a sync
+only needs to send what's new or changed.
+"""
+
+import hashlib
+import json
+import logging
+import time
+
+import requests
+
+BATCH_SIZE = 200 # the server's Importer.MAX_BATCH_ITEMS
+NUM_RETRIES = 3
+RETRY_SECONDS = 5
+KEY_FIELDS = ['source', 'source_id', 'source_url']
+
+def content_hash(item):
+    """The same hash as the site's Importer.content_hash()."""
+    content = dict((k, v) for k, v in item.items() if k not in KEY_FIELDS)
+    text = json.dumps(content, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(text).hexdigest()
+
+class ImportClient(object):
+    def __init__(self, site_url, api_key, batch_size=BATCH_SIZE):
+        self.url = site_url + '/api/import'
+        self.sources_url = site_url + '/api/sources/'
+        self.batch_size = batch_size
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = 'Bearer %s' % api_key
+        self.session.headers['Content-Type'] = 'application/x-ndjson'
+        self.items = []
+        self.counts = {}
+
+    def manifest(self, source):
+        """{source_id: content_hash} for everything sent from a source."""
+        manifest = {}
+        cursor = None
+        while True:
+            resp = self.session.get(self.sources_url + source,
+                                    params={'cursor': cursor or ''})
+            resp.raise_for_status()
+            page = resp.json()
+            manifest.update(page['records'])
+            cursor = page['cursor']
+            if not cursor:
+                return manifest
+
+    def add(self, **item):
+        """
+        Queue a plaque, sending a batch once there are enough. Returns the
+        batch's results if it sent one, otherwise [].
+        """
+        self.items.append(item)
+        if len(self.items) >= self.batch_size:
+            return self.flush()
+        return []
+
+    def flush(self):
+        """Send the queued plaques. Returns the server's per-line results."""
+        if not self.items:
+            return []
+        body = "\n".join(json.dumps(item) for item in self.items)
+        for attempt in range(NUM_RETRIES):
+            resp = self.session.post(self.url, data=body)
+            if resp.status_code < 500:
+                break
+            logging.info("import got %s, retrying" % resp.status_code)
+            time.sleep(RETRY_SECONDS)
+        resp.raise_for_status()
+
+        results = resp.json()['results']
+        for result in results:
+            status = result['status']
+            self.counts[status] = self.counts.get(status, 0) + 1
+            if status in ('invalid', 'duplicate'):
+                logging.info("FAILED %s: %s" % (
+                    result.get('source_url', result['line']),
+                    result['error']))
+        logging.info("import totals: %s" % self.counts)
+        self.items = []
+        return results
@@ -10,6 +10,8 @@ import os
 import time
 import sys
 
+from import_client import ImportClient
+
 # TODO: Is there a way to discover this list from the page itself?
 
 plaque_ids_500 = [936, 1064, 735, 783, 663]
@@ -47,8 +49,7 @@ plaque_ids.sort()
 #site_url = 'http://10.10.15.40:8080'
 #site_url = 'http://127.0.0.1:8080'
 site_url = 'http://readtheplaque.com'
-post_url = site_url + '/submit-your-own'
-flush_url = site_url + '/flush'
+api_key = os.environ.get('RTP_API_KEY')
 
 def body_p_filter(tag):
     """
@@ -135,10 +136,7 @@ def get_page_contents(soup):
 #
 #    return img_filename
 
-print 'Flushing', flush_url
-response = requests.get(flush_url)
-print 'Flush:', response
-
+client = ImportClient(site_url, api_key)
 for iplaque, plaque_id in enumerate(plaque_ids):
     url = 'http://readtheplaque.com/%s' % plaque_id
     print url
@@ -149,22 +147,14 @@ for iplaque, plaque_id in enumerate(plaque_ids):
     title, body, img_url, tags = get_page_contents(soup)
     #img_filename = get_image(img_url)
 
-    values = {
-        'lat': gps_loc[0],
-        'lng': gps_loc[1],
-        'plaque_image_url': img_url,
-        'plaque_image_file': '',
-        'title': title,
-        'tags': tags,
-        'description': body,
-        'old_site_id': plaque_id,
-    }
-    post_resp = requests.post(post_url, data=values)
-    if post_resp.status_code != 200:
-        print "FAIL FAIL FAIL",
-        print 1+iplaque, '/', len(plaque_ids), url,
-        print 'post:', post_url, post_resp
-        print title
-
-flush_resp = requests.get(flush_url)
-print 'Flush:', flush_resp
+    client.add(source_url=url,
+               lat=gps_loc[0],
+               lng=gps_loc[1],
+               img_url=img_url,
+               title=title.decode('utf-8'),
+               tags=tags.decode('utf-8'),
+               description=body.decode('utf-8'),
+               old_site_id=plaque_id)
+    print 1+iplaque, '/', len(plaque_ids), url
+
+client.flush()
@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+
+"""
+The shared scraper framework. Each site is a Source plugin, which lists
+its plaque page URLs and parses a page into a plaque for /api/import; this
+does the rest:
+
+    * fetches pages on a thread pool through one connection-pooled
+      requests Session, retrying server errors with backoff
+    * keeps to a rate limit for each host
+    * caches responses on disk and revalidates them with their ETag or
+      Last-Modified, so a rerun mostly gets 304s (or, with --offline, makes
+      no requests at all)
+    * syncs incrementally: the site's manifest of what it already has from
+      the source (source ids and content hashes) means that only new
+      pages are fetched, and with --refresh, that pages are revalidated
+      and only the plaques whose content has changed are sent
+    * parses with lxml when it's installed; sources parse only the elements
+      they need (with a SoupStrainer or compiled XPath), and with
+      --processes, big crawls parse on a process pool
+    * checkpoints the pages with no plaque, or that the site rejected, so
+      they aren't tried again
+    * sends the plaques in batches with import_client.ImportClient
+
+    RTP_API_KEY=<key> python scrape.py geograph --workers 8
+"""
+
+import argparse
+import hashlib
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+from bs4 import BeautifulSoup
+import requests
+from requests.adapters import HTTPAdapter
+try:
+    from urllib3.util.retry import Retry
+except ImportError:
+    from requests.packages.urllib3.util.retry import Retry
+
+try:
+    import lxml.html
+    HTML_PARSER = 'lxml'
+except ImportError:
+    lxml = None
+    HTML_PARSER = 'html.parser'
+
+from import_client import ImportClient, content_hash
+
+#site_url = 'http://localhost:8080'
+site_url = 'http://readtheplaque.com'
+
+SOURCES = {
+    'geograph': 'geograph.GeographSource',
+    'geograph_gg': 'geograph.GeographGgSource',
+    'toronto': 'torontoplaques_scraper.TorontoSource',
+    'ontario': 'torontoplaques_scraper.OntarioSource',
+    'dedicated_nyc': 'dedicated_nyc.DedicatedNycSource',
+}
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+DEF_CACHE_DIR = os.path.join(SCRIPTS_DIR, 'scrape_cache')
+DEF_NUM_WORKERS = 4
+DEF_TIMEOUT_SECONDS = 30
+NUM_RETRIES = 3
+CHECKPOINT_EVERY = 50 # pages
+
+def make_soup(text, parse_only=None):
+    """
+    A BeautifulSoup of a page, with the fastest parser there is, and only
+    the elements parse_only (a SoupStrainer) picks out, if it's given.
+    """
+    return BeautifulSoup(text, HTML_PARSER, parse_only=parse_only)
+
+def has_class(name):
+    """An XPath test for an element having a class among its classes."""
+    return "contains(concat(' ', normalize-space(@class), ' '), ' %s ')" % (
+        name)
+
+class Page(object):
+    """A fetched page, from the network or the disk cache."""
+    def __init__(self, url, status_code, content, encoding=None,
+                 from_cache=False):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.encoding = encoding or 'utf-8'
+        self.from_cache = from_cache
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, 'replace')
+
+class RateLimiter(object):
+    """Spaces out requests to each host, across all the threads."""
+    def __init__(self, per_second, host_per_second=None):
+        self.per_second = per_second
+        self.host_per_second = host_per_second or {}
+        self.next_times = {}
+        self.lock = threading.Lock()
+
+    def wait(self, host):
+        interval = 1.0 / self.host_per_second.get(host, self.per_second)
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_times.get(host, 0))
+            self.next_times[host] = start + interval
+        if start > now:
+            time.sleep(start - now)
+
+class DiskCache(object):
+    """
+    Response bodies on disk by URL, with the validators (ETag and
+    Last-Modified) needed to revalidate them.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def _paths(self, url):
+        name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        base = os.path.join(self.path, name[:2], name)
+        return base + '.json', base + '.body'
+
+    def get(self, url):
+        """The cached (meta dict, body), or None."""
+        meta_path, body_path = self._paths(url)
+        try:
+            with open(meta_path) as fh:
+                meta = json.load(fh)
+            with open(body_path, 'rb') as fh:
+                return meta, fh.read()
+        except (IOError, ValueError):
+            return None
+
+    def put(self, url, resp):
+        meta_path, body_path = self._paths(url)
+        directory = os.path.dirname(meta_path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass # made by another thread
+        meta = {
+            'url': url,
+            'etag': resp.headers.get('ETag'),
+            'last_modified': resp.headers.get('Last-Modified'),
+            'encoding': resp.encoding,
+            'fetched_on': time.time(),
+        }
+        # The body first, so that a meta file always has its body.
+        with open(body_path + '.tmp', 'wb') as fh:
+            fh.write(resp.content)
+        os.rename(body_path + '.tmp', body_path)
+        with open(meta_path + '.tmp', 'w') as fh:
+            json.dump(meta, fh)
+        os.rename(meta_path + '.tmp', meta_path)
+
+class Fetcher(object):
+    """Gets pages for the sources: pooled, retried, rate-limited, cached."""
+    def __init__(self, per_second=1.0, host_per_second=None,
+                 num_workers=DEF_NUM_WORKERS, cache_dir=DEF_CACHE_DIR,
+                 offline=False, timeout=DEF_TIMEOUT_SECONDS):
+        self.session = requests.Session()
+        retries = Retry(total=NUM_RETRIES, backoff_factor=1,
+                        status_forcelist=[500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=num_workers,
+                              max_retries=retries)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.limiter = RateLimiter(per_second, host_per_second)
+        self.cache = DiskCache(cache_dir) if cache_dir else None
+        self.offline = offline
+        self.timeout = timeout
+        self.counts = {'fetched': 0, 'revalidated': 0, 'cached': 0}
+        self.counts_lock = threading.Lock()
+
+    def _count(self, name):
+        with self.counts_lock:
+            self.counts[name] += 1
+
+    def get(self, url, params=None):
+        if params:
+            url = requests.Request('GET', url, params=params).prepare().url
+        cached = self.cache.get(url) if self.cache else None
+        if cached is not None and self.offline:
+            self._count('cached')
+            meta, body = cached
+            return Page(url, 200, body, meta['encoding'], from_cache=True)
+        if self.offline:
+            raise IOError("%s is not in the cache" % url)
+
+        headers = {}
+        if cached is not None:
+            meta, body = cached
+            if meta['etag']:
+                headers['If-None-Match'] = meta['etag']
+            if meta['last_modified']:
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        self.limiter.wait(urlparse.urlparse(url).netloc)
+        resp = self.session.get(url, headers=headers, timeout=self.timeout)
+        if resp.status_code == 304 and cached is not None:
+            self._count('revalidated')
+            return Page(url, 200, body, meta['encoding'], from_cache=True)
+        resp.raise_for_status()
+        self._count('fetched')
+        if self.cache:
+            self.cache.put(url, resp)
+        return Page(url, resp.status_code, resp.content, resp.encoding)
+
+class Checkpoint(object):
+    """The URLs a scrape has finished with, kept in a JSON file."""
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as fh:
+                self.done = set(json.load(fh))
+        except (IOError, ValueError):
+            self.done = set()
+
+    def __contains__(self, url):
+        return url in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def add(self, url):
+        self.done.add(url)
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as fh:
+            json.dump(sorted(self.done), fh)
+        os.rename(self.path + '.tmp', self.path)
+
+class SkipPage(Exception):
+    """Raised by Source.parse for a page that has no plaque on it."""
+
+class Source(object):
+    """
+    A site to scrape. Subclasses set name, and may set per_second for a
+    gentler or faster rate, and provide list_urls() and parse(). A source
+    whose parse() fetches more pages sets parse_uses_fetcher, which keeps
+    it off the process pool.
+    """
+    name = None
+    per_second = 1.0
+    parse_uses_fetcher = False
+
+    def list_urls(self, fetcher):
+        """The URLs of the site's plaque pages."""
+        raise NotImplementedError
+
+    def source_id(self, url):
+        """A plaque's id in the source; its page's URL unless overridden."""
+        return url
+
+    def parse(self, url, text, fetcher):
+        """
+        The plaque on a page, as a dict of /api/import fields (see
+        Importer.py on the site). source_url defaults to the page URL.
+        Raises SkipPage if there isn't one.
+        """
+        raise NotImplementedError
+
+def load_source(name):
+    module_name, class_name = SOURCES[name].rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)()
+
+def parse_page(source, url, text, fetcher=None):
+    """(url, the plaque or None, an error message or None)"""
+    try:
+        return url, source.parse(url, text, fetcher), None
+    except SkipPage:
+        return url, None, None
+    except Exception as err:
+        # As a string, since it may have to come back from another process.
+        return url, None, "%s: %s" % (type(err).__name__, err)
+
+_process_sources = {}
+
+def _parse_in_process(args):
+    source_name, url, text = args
+    if source_name not in _process_sources:
+        _process_sources[source_name] = load_source(source_name)
+    return parse_page(_process_sources[source_name], url, text)
+
+def scrape(source, fetcher, client, checkpoint, num_workers=DEF_NUM_WORKERS,
+           limit=None, refresh=False, num_processes=0):
+    """
+    Sync a source with the site: scrape the pages it doesn't have yet, or
+    with refresh, every page, sending only what has changed. With
+    num_processes, the threads fetch and hand the pages to that many
+    processes to parse. Returns counts.
+    """
+    manifest = client.manifest(source.name)
+    urls = source.list_urls(fetcher)
+    if not refresh:
+        urls = [url for url in urls
+                if source.source_id(url) not in manifest and
+                   url not in checkpoint]
+    if limit is not None:
+        urls = urls[:limit]
+    logging.info("%s: %s pages to do, the site has %s" % (
+        source.name, len(urls), len(manifest)))
+
+    process_pool = None
+    if num_processes and not source.parse_uses_fetcher:
+        process_pool = multiprocessing.Pool(num_processes)
+
+    def work(url):
+        source_id = source.source_id(url)
+        try:
+            page = fetcher.get(url)
+        except Exception as err:
+            return url, None, err
+        if page.from_cache and source_id in manifest and not fetcher.offline:
+            return url, None, None # not modified since it was sent
+
+        if process_pool is not None:
+            url, item, err = process_pool.apply(
+                _parse_in_process, ((source.name, url, page.text),))
+        else:
+            url, item, err = parse_page(source, url, page.text, fetcher)
+        if item is None:
+            return url, None, err
+        item['source'] = source.name
+        item.setdefault('source_url', url)
+        if source_id != item['source_url']:
+            item['source_id'] = source_id
+        if manifest.get(source_id) == content_hash(item):
+            return url, None, None
+        return url, item, None
+
+    def sent(results):
+        # Lines the server rejected won't do better next time either.
+        for result in results:
+            if result.get('source_url'):
+                checkpoint.add(result['source_url'])
+        if results:
+            checkpoint.save()
+
+    counts = {'parsed': 0, 'skipped': 0, 'failed': 0}
+    pool = ThreadPool(num_workers)
+    try:
+        for i, (url, item, err) in enumerate(
+                pool.imap_unordered(work, urls), 1):
+            if err is not None:
+                # Not checkpointed, so it's tried again next time.
+                logging.error("%s: %s" % (url, err))
+                counts['failed'] += 1
+            elif item is None:
+                counts['skipped'] += 1
+                checkpoint.add(url)
+            else:
+                counts['parsed'] += 1
+                sent(client.add(**item))
+            if i % CHECKPOINT_EVERY == 0:
+                checkpoint.save()
+                logging.info("%s/%s pages, %s, %s" % (
+                    i, len(urls), counts, fetcher.counts))
+        sent(client.flush())
+    finally:
+        pool.close()
+        if process_pool is not None:
+            process_pool.close()
+        checkpoint.save()
+    counts.update(fetcher.counts)
+    counts.update(client.counts)
+    return counts
+
+def main(source_name=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    if source_name is None:
+        parser.add_argument('source', choices=sorted(SOURCES))
+    parser.add_argument('--workers', type=int, default=DEF_NUM_WORKERS)
+    parser.add_argument('--processes', type=int, default=0,
+                        help="parse on this many processes")
+    parser.add_argument('--limit', type=int, default=None,
+                        help="only do this many pages")
+    parser.add_argument('--site', default=site_url)
+    parser.add_argument('--cache-dir', default=DEF_CACHE_DIR)
+    parser.add_argument('--offline', action='store_true',
+                        help="only use cached pages")
+    parser.add_argument('--refresh', action='store_true',
+                        help="check every page for changes, not just new ones")
+    args = parser.parse_args()
+    source_name = source_name or args.source
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    logging.getLogger('requests').setLevel(logging.WARNING)
+    logging.getLogger('urllib3').setLevel(logging.WARNING)
+
+    source = load_source(source_name)
+    fetcher = Fetcher(per_second=source.per_second,
+                      num_workers=args.workers, cache_dir=args.cache_dir,
+                      offline=args.offline)
+    client = ImportClient(args.site, os.environ.get('RTP_API_KEY'))
+    checkpoint = Checkpoint(os.path.join(
+        SCRIPTS_DIR, '%s.checkpoint.json' % source_name))
+    counts = scrape(source, fetcher, client, checkpoint, args.workers,
+                    args.limit, args.refresh, args.processes)
+    logging.info("%s done: %s" % (source_name, counts))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+"""
+The scraper framework (scrape.py): revalidating the disk cache, against a
+server on localhost, and resuming a scrape from its checkpoint. From
+scripts/:
+
+    python -m unittest discover tests
+"""
+
+import BaseHTTPServer
+import logging
+import os
+import shutil
+import SocketServer
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import scrape
+
+from test_sources import cache_page
+
+class PageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves pages with an ETag or a Last-Modified, and 304s for them."""
+    pages = {}      # path -> (body, validator header, its value)
+    requests = []   # (path, If-None-Match, If-Modified-Since)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if_none_match = self.headers.get('If-None-Match')
+        if_modified_since = self.headers.get('If-Modified-Since')
+        self.requests.append((self.path, if_none_match, if_modified_since))
+        if self.path not in self.pages:
+            self.send_error(404)
+            return
+        body, header, value = self.pages[self.path]
+        if value in (if_none_match, if_modified_since):
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+class PageServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class FetcherCacheTest(unittest.TestCase):
+    def setUp(self):
+        PageHandler.pages = {
+            '/etag': ('<p>one</p>', 'ETag', '"v1"'),
+            '/dated': ('<p>dated</p>', 'Last-Modified',
+                       'Mon, 05 Jan 2015 10:00:00 GMT'),
+        }
+        PageHandler.requests = []
+        self.server = PageServer(('localhost', 0), PageHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.base_url = 'http://localhost:%s' % self.server.server_address[1]
+        self.cache_dir = tempfile.mkdtemp()
+        self.fetcher = scrape.Fetcher(per_second=1000,
+                                      cache_dir=self.cache_dir)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def test_revalidates_with_the_etag(self):
+        url = self.base_url + '/etag'
+        page = self.fetcher.get(url)
+        self.assertEqual((page.text, page.from_cache), (u'<p>one</p>', False))
+        meta, body = self.fetcher.cache.get(url)
+        self.assertEqual((meta['etag'], body), ('"v1"', '<p>one</p>'))
+
+        page = self.fetcher.get(url)
+        self.assertEqual((page.text, page.from_cache), (u'<p>one</p>', True))
+        self.assertEqual(PageHandler.requests[-1], ('/etag', '"v1"', None))
+        self.assertEqual(self.fetcher.counts,
+                         {'fetched': 1, 'revalidated': 1, 'cached': 0})
+
+    def test_changed_page_replaces_the_cached_one(self):
+        url = self.base_url + '/etag'
+        self.fetcher.get(url)
+        PageHandler.pages['/etag'] = ('<p>two</p>', 'ETag', '"v2"')
+
+        page = self.fetcher.get(url)
+        self.assertEqual((page.text, page.from_cache), (u'<p>two</p>', False))
+        meta, body = self.fetcher.cache.get(url)
+        self.assertEqual((meta['etag'], body), ('"v2"', '<p>two</p>'))
+        self.assertEqual(self.fetcher.counts['fetched'], 2)
+
+    def test_revalidates_with_last_modified(self):
+        url = self.base_url + '/dated'
+        self.fetcher.get(url)
+        page = self.fetcher.get(url)
+        self.assertTrue(page.from_cache)
+        self.assertEqual(PageHandler.requests[-1],
+                         ('/dated', None, 'Mon, 05 Jan 2015 10:00:00 GMT'))
+
+    def test_offline_uses_only_the_cache(self):
+        url = self.base_url + '/etag'
+        self.fetcher.get(url)
+        offline = scrape.Fetcher(cache_dir=self.cache_dir, offline=True)
+
+        page = offline.get(url)
+        self.assertEqual((page.text, page.from_cache), (u'<p>one</p>', True))
+        self.assertRaises(IOError, offline.get, self.base_url + '/dated')
+        self.assertEqual(len(PageHandler.requests), 1)
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'test.checkpoint.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_saved_urls_are_there_next_time(self):
+        checkpoint = scrape.Checkpoint(self.path)
+        checkpoint.add('http://example.com/a')
+        checkpoint.add('http://example.com/b')
+        checkpoint.save()
+
+        resumed = scrape.Checkpoint(self.path)
+        self.assertEqual(len(resumed), 2)
+        self.assertIn('http://example.com/a', resumed)
+        self.assertNotIn('http://example.com/c', resumed)
+
+    def test_missing_or_corrupt_file_starts_afresh(self):
+        self.assertEqual(len(scrape.Checkpoint(self.path)), 0)
+        with open(self.path, 'w') as fh:
+            fh.write('["http://example.com/a"')
+        self.assertEqual(len(scrape.Checkpoint(self.path)), 0)
+
+class PagesSource(scrape.Source):
+    """A source whose pages say what to do with them."""
+    name = 'test'
+    urls = ['http://example.com/%s' % n for n in
+            ['plaque', 'no-plaque', 'broken', 'rejected']]
+
+    def list_urls(self, fetcher):
+        return self.urls
+
+    def parse(self, url, text, fetcher):
+        if text == 'no plaque':
+            raise scrape.SkipPage()
+        if text == 'broken':
+            raise ValueError("can't parse it")
+        return {'title': text, 'lat': 1, 'lng': 2, 'description': ''}
+
+class RecordingClient(object):
+    """Takes the place of ImportClient; rejects titles starting with 'x'."""
+    def __init__(self, manifest=None):
+        self.sent = []
+        self.counts = {}
+        self._manifest = manifest or {}
+
+    def manifest(self, source):
+        return self._manifest
+
+    def add(self, **item):
+        self.sent.append(item)
+        status = 'invalid' if item['title'].startswith('x') else 'created'
+        return [{'source_url': item['source_url'], 'status': status}]
+
+    def flush(self):
+        return []
+
+class ScrapeResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fetcher = scrape.Fetcher(cache_dir=self.dir, offline=True)
+        for url, text in zip(PagesSource.urls, ['a plaque', 'no plaque',
+                                                'broken', 'x marks']):
+            cache_page(self.fetcher.cache, url, text)
+        self.checkpoint_path = os.path.join(self.dir, 'checkpoint.json')
+        self.source = PagesSource()
+        logging.disable(logging.ERROR) # the broken page's
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self.dir)
+
+    def run_scrape(self, client, refresh=False):
+        checkpoint = scrape.Checkpoint(self.checkpoint_path)
+        return scrape.scrape(self.source, self.fetcher, client, checkpoint,
+                             num_workers=2, refresh=refresh)
+
+    def test_rerun_only_retries_the_failed_page(self):
+        client = RecordingClient()
+        counts = self.run_scrape(client)
+        self.assertEqual((counts['parsed'], counts['skipped'],
+                          counts['failed']), (2, 1, 1))
+        self.assertEqual(sorted(i['title'] for i in client.sent),
+                         ['a plaque', 'x marks'])
+        # Sent, skipped and rejected pages are done with; the broken one
+        # isn't.
+        self.assertEqual(sorted(scrape.Checkpoint(self.checkpoint_path).done),
+                         ['http://example.com/no-plaque',
+                          'http://example.com/plaque',
+                          'http://example.com/rejected'])
+
+        cache_page(self.fetcher.cache, 'http://example.com/broken', 'fixed')
+        client = RecordingClient()
+        counts = self.run_scrape(client)
+        self.assertEqual((counts['parsed'], counts['failed']), (1, 0))
+        self.assertEqual([i['title'] for i in client.sent], ['fixed'])
+        self.assertEqual(len(scrape.Checkpoint(self.checkpoint_path)), 4)
+
+    def test_pages_the_site_has_are_not_scraped(self):
+        plaque_url = 'http://example.com/plaque'
+        client = RecordingClient(manifest={plaque_url: 'oldhash'})
+        self.run_scrape(client)
+        self.assertNotIn('a plaque', [i['title'] for i in client.sent])
+
+    def test_refresh_sends_only_changed_plaques(self):
+        item = {'title': 'a plaque', 'lat': 1, 'lng': 2, 'description': '',
+                'source': 'test', 'source_url': 'http://example.com/plaque'}
+        client = RecordingClient(manifest={
+            'http://example.com/plaque': scrape.content_hash(item),
+            'http://example.com/rejected': 'oldhash',
+        })
+        counts = self.run_scrape(client, refresh=True)
+        self.assertEqual([i['title'] for i in client.sent], ['x marks'])
+        self.assertEqual(counts['skipped'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+"""
+Each Source's parse, against pages in fixtures/, with no requests made.
+From scripts/:
+
+    python -m unittest discover tests
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import requests
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..'))
+import scrape
+
+FIXTURES_DIR = os.path.join(TESTS_DIR, 'fixtures')
+
+def fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name)) as fh:
+        return fh.read()
+
+def cache_page(cache, url, content, etag=None, last_modified=None):
+    """Put a page into a DiskCache, as if it had been fetched."""
+    resp = requests.Response()
+    resp.url = url
+    resp.status_code = 200
+    resp._content = content
+    resp.encoding = 'utf-8'
+    if etag:
+        resp.headers['ETag'] = etag
+    if last_modified:
+        resp.headers['Last-Modified'] = last_modified
+    cache.put(url, resp)
+
+class SourceTest(unittest.TestCase):
+    source_name = None
+
+    def setUp(self):
+        self.source = scrape.load_source(self.source_name)
+
+    def parse(self, name, url=None):
+        url = url or 'http://example.com/%s' % name
+        return self.source.parse(url, fixture(name).decode('utf-8'), None)
+
+    def assertSkips(self, name):
+        url, item, err = scrape.parse_page(
+            self.source, 'http://example.com/%s' % name,
+            fixture(name).decode('utf-8'))
+        self.assertEqual((item, err), (None, None))
+
+@unittest.skipIf(scrape.lxml is None, "the Geograph sources need lxml")
+class GeographTest(SourceTest):
+    source_name = 'geograph'
+
+    def test_parse(self):
+        url = 'http://www.geograph.org.uk/photo/1234567'
+        item = self.parse('geograph_photo.html', url)
+        self.assertEqual(item['source_url'], url)
+        self.assertEqual(item['title'],
+                         'Blue plaque to Isambard Kingdom Brunel')
+        self.assertEqual(item['img_url'], 'https://s0.geograph.org.uk/'
+                         'geophotos/01/23/45/1234567_0a1b2c3d.jpg')
+        self.assertEqual((item['lat'], item['lng']), ('51.4490', '-2.5813'))
+        self.assertEqual(sorted(item['tags']),
+                         ['blue plaque', 'geograph', 'railway'])
+        description = item['description']
+        self.assertTrue(description.startswith(
+            u'<p>On the wall of Temple Meads station.</p>'))
+        # The copyright's relative links are made absolute.
+        self.assertIn(u'<a href="http://www.geograph.org.uk/profile/42">'
+                      u'Jane Smith</a>', description)
+        self.assertIn(u'Submitted via <a href="%s">Geograph</a>' % url,
+                      description)
+
+    def test_unavailable_photo_is_skipped(self):
+        self.assertSkips('geograph_unavailable.html')
+
+@unittest.skipIf(scrape.lxml is None, "the Geograph sources need lxml")
+class GeographGgTest(SourceTest):
+    source_name = 'geograph_gg'
+
+    def test_title_and_description_from_captions(self):
+        item = self.parse('geograph_gg_photo.html')
+        self.assertEqual(item['title'], 'Victor Hugo plaque')
+        self.assertTrue(item['description'].startswith(
+            u'<p>Hauteville House, where he lived in exile.</p>'))
+        self.assertIn(u'http://www.geograph.org.gg/profile/7',
+                      item['description'])
+        self.assertEqual((item['lat'], item['lng']), ('49.4530', '-2.5371'))
+        self.assertEqual(item['tags'], ['geograph'])
+
+class TorontoTest(SourceTest):
+    source_name = 'toronto'
+
+    def setUp(self):
+        super(TorontoTest, self).setUp()
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_list_urls_from_the_index_pages(self):
+        fetcher = scrape.Fetcher(cache_dir=self.cache_dir, offline=True)
+        index_url = 'http://www.torontoplaques.com/Index_Small/'
+        for url, name in [('', 'toronto_index.html'),
+                          ('Index_A.html', 'toronto_index_a.html'),
+                          ('Index_B.html', 'toronto_index_b.html')]:
+            cache_page(fetcher.cache, index_url + url, fixture(name))
+
+        self.assertEqual(self.source.list_urls(fetcher), [
+            'http://www.torontoplaques.com/Pages/Allan_Gardens.html',
+            'http://www.torontoplaques.com/Pages/Arts_and_Letters_Club.html',
+            'http://www.torontoplaques.com/Pages/Bank_of_Upper_Canada.html',
+        ])
+        self.assertEqual(fetcher.counts['cached'], 3)
+
+    def test_parse(self):
+        url = 'http://www.torontoplaques.com/Pages/Allan_Gardens.html'
+        item = self.parse('toronto_plaque.html', url)
+        self.assertEqual(item['title'], 'Allan Gardens')
+        self.assertEqual((item['lat'], item['lng']), (43.6617, -79.3748))
+        self.assertEqual(item['img_url'], 'http://www.torontoplaques.com/'
+                         'Photos/Allan_Gardens_plaque.jpg')
+        self.assertEqual(item['tags'], ['toronto', 'ontario', 'alan brown'])
+        self.assertTrue(item['description'].startswith(
+            u'<p class="plaquetext">In 1858 George William Allan'))
+        self.assertIn(u'Full page <a href="%s">here</a>' % url,
+                      item['description'])
+
+    def test_page_without_coordinates_is_skipped(self):
+        self.assertSkips('toronto_no_coords.html')
+
+class OntarioTest(SourceTest):
+    source_name = 'ontario'
+
+    def test_degrees_and_minutes(self):
+        item = self.parse('ontario_plaque.html')
+        self.assertEqual(item['title'], 'Fort Frontenac')
+        self.assertAlmostEqual(item['lat'], 44 + 13.794 / 60)
+        self.assertAlmostEqual(item['lng'], -(76 + 29.211 / 60))
+        self.assertEqual(item['img_url'], 'http://www.ontarioplaques.com/'
+                         'Photos/Fort_Frontenac_photo.jpg')
+        self.assertTrue(item['description'].startswith(
+            u'<p class="text_navy1_16a">Built by the French'))
+
+class DedicatedNycTest(SourceTest):
+    source_name = 'dedicated_nyc'
+
+    def test_parse(self):
+        item = self.parse('dedicated_nyc_plaque.html')
+        self.assertEqual(item['title'], 'Engine 54 Ladder 4')
+        self.assertEqual(item['address'], '8th Ave and W 48th St, NYC')
+        self.assertNotIn('lat', item)
+        self.assertEqual(item['img_url'],
+                         'https://www.dedicatednyc.com/images/engine-54.jpg')
+        self.assertEqual(item['tags'], ['nyc', 'jack curry', 'firefighters',
+                                        'september-11'])
+
+    def test_alt_text_without_a_title(self):
+        item = self.parse('dedicated_nyc_untitled.html')
+        self.assertEqual(item['title'], 'Dedicated NYC Plaque')
+        self.assertEqual(item['address'], 'Union Square Park, NYC')
+        self.assertEqual(item['tags'], ['nyc', 'jack curry'])
+
+class ParsePageTest(unittest.TestCase):
+    def test_errors_come_back_as_strings(self):
+        source = scrape.load_source('toronto')
+        url, item, err = scrape.parse_page(source, 'http://example.com/x',
+                                           u'<h1>No image</h1><p class='
+                                           u'"plaquecoordinates">at 1, 2</p>')
+        self.assertEqual(item, None)
+        self.assertTrue(err.startswith('IndexError: '))
+        json.dumps(err) # can come back from another process
+
+if __name__ == '__main__':
+    unittest.main()
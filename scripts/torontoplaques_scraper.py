@@ -1,96 +1,104 @@
 # -*- coding: utf-8 -*-
 
-from bs4 import BeautifulSoup
+"""
+Plaques from Alan L. Brown's torontoplaques.com and ontarioplaques.com,
+found through their alphabetical index pages. See scrape.py.
+
+    RTP_API_KEY=<key> python torontoplaques_scraper.py [toronto|ontario]
+"""
+
+from bs4 import SoupStrainer
 import re
-import requests
-import urllib
-import tempfile
 import os
-import time
 import sys
 
-site_url = 'http://readtheplaque.com'
-post_url = site_url + '/add'
-flush_url = site_url + '/flush'
-
-
-name = {
-    'ontario': 'Ontario Plaques',
-    'toronto': 'Toronto Plaques',
-}
-description_tag = {
-    'ontario': 'text_navy1_16a',
-    'toronto': 'plaquetext',
-}
-tags = {
-    'ontario': 'ontario, alan brown',
-    'toronto': 'toronto, ontario, alan brown',
-}
-img_plaque_re = {
-    'ontario': re.compile('photo'),
-    'toronto': re.compile('plaque'),
-}
-
-def get_plaque_data(plaque_url):
-
-    location = 'ontario' if plaque_url.startswith(
-                   'http://www.ontarioplaques') else 'toronto'
-    base_url = plaque_url[:30]
-
-    get_resp = requests.get(plaque_url)
-    soup = BeautifulSoup(get_resp.text, 'html.parser')
-
-    coords_tag = soup.find('p', {'class': 'plaquecoordinates'})
-    if coords_tag is None:
-        raise ValueError('no coords for %s' % plaque_url)
-
-    text_tag = soup.find('p', {'class': description_tag[location]})
-
-    title = soup.find('h1').get_text()
-    coords_text = coords_tag.get_text().split()
-    if location == 'ontario':
-        lat = float(coords_text[2]) + float(coords_text[3]) / 60.0
-        lng = -1.0 * (float(coords_text[5]) + float(coords_text[6]) / 60.0)
-    else:
+import scrape
+
+class TorontoSource(scrape.Source):
+    name = 'toronto'
+    site_name = 'Toronto Plaques'
+    base_url = 'http://www.torontoplaques.com/'
+    description_class = 'plaquetext'
+    img_plaque_re = re.compile('plaque')
+    tags = ['toronto', 'ontario', 'alan brown']
+
+    # Only the elements each kind of page needs are parsed.
+    index_only = SoupStrainer('a')
+    index_page_only = SoupStrainer('table')
+    plaque_only = SoupStrainer(['h1', 'p', 'img'])
+
+    def get_index_pages(self, fetcher):
+        """
+        Get the URLS to the A, B, C, etc. pages that list the plaques
+        alphabetically.
+        """
+        index_url = "{0}Index_Small/".format(self.base_url)
+        soup = scrape.make_soup(fetcher.get(index_url).text, self.index_only)
+        page_urls_rel = [link.get('href') for link in soup.find_all('a')][5:]
+        return ["%sIndex_Small/%s" % (self.base_url, url)
+                for url in page_urls_rel]
+
+    def list_urls(self, fetcher):
+        plaque_urls = set()
+        for index_page_url in self.get_index_pages(fetcher):
+            soup = scrape.make_soup(fetcher.get(index_page_url).text,
+                                    self.index_page_only)
+            links = soup.find('table').find_all('a')
+            plaque_urls.update("{0}{1}".format(self.base_url,
+                                               link.get('href')[3:])
+                               for link in links)
+        return sorted(plaque_urls)
+
+    def get_lat_lng(self, coords_text):
         lat = float(coords_text[1].replace(',', ''))
         lng = float(coords_text[2].replace(',', ''))
-
-    description = '''{0}<br>Plaque via Alan L. Brown's site 
-        <a href="{1}">{3}</a>.  Full page <a href="{2}">here</a>.'''.format(
-            text_tag, base_url, plaque_url, name[location])
-
-    img_tags = soup.find_all('img', {'class': img_plaque_re[location]})
-    img_tag = img_tags[0]
-    img_url = os.path.join(base_url, img_tag.get('src')[3:])
-
-    plaque_data = {
-        'lat': lat,
-        'lng': lng,
-        'plaque_image_url': img_url,
-        'plaque_image_file': '',
-        'title': title,
-        'tags': 'toronto, ontario, alan brown',
-        'description': description,
-    }
-    return plaque_data
-
-def main():
-    with open('alan_brown_urls.txt') as fh:
-        plaque_urls = [p.strip() for p in fh.readlines()]
-
-    for ip, plaque_url in enumerate(plaque_urls):
-        try:
-            plaque_data = get_plaque_data(plaque_url)
-            post_resp = requests.post(post_url, data=plaque_data)
-            if post_resp.status_code != 200:
-                print "FAIL FAIL FAIL %s %s" % (ip, plaque_url)
-            else:
-                print ip, plaque_url
-        except ValueError as ve: 
-            print "error %s: cant get %s" % (ve, plaque_url)
-        except Exception as err:
-            print "error (unexpected) %s: cant get %s" % (err, plaque_url)
-        time.sleep(120)
+        return lat, lng
+
+    def parse(self, plaque_url, text, fetcher):
+        soup = scrape.make_soup(text, self.plaque_only)
+
+        coords_tag = soup.find('p', {'class': 'plaquecoordinates'})
+        if coords_tag is None:
+            raise scrape.SkipPage('no coords for %s' % plaque_url)
+
+        text_tag = soup.find('p', {'class': self.description_class})
+
+        title = soup.find('h1').get_text()
+        lat, lng = self.get_lat_lng(coords_tag.get_text().split())
+
+        description = u'''{0}<br>Plaque via Alan L. Brown's site
+            <a href="{1}">{3}</a>.  Full page <a href="{2}">here</a>.'''.format(
+                text_tag, self.base_url, plaque_url, self.site_name)
+
+        img_tags = soup.find_all('img', {'class': self.img_plaque_re})
+        img_tag = img_tags[0]
+        img_url = os.path.join(self.base_url, img_tag.get('src')[3:])
+
+        plaque_data = {
+            'source_url': plaque_url,
+            'lat': lat,
+            'lng': lng,
+            'img_url': img_url,
+            'title': title,
+            'tags': self.tags,
+            'description': description,
+        }
+        return plaque_data
+
+class OntarioSource(TorontoSource):
+    name = 'ontario'
+    site_name = 'Ontario Plaques'
+    base_url = 'http://www.ontarioplaques.com/'
+    description_class = 'text_navy1_16a'
+    img_plaque_re = re.compile('photo')
+    tags = ['ontario', 'alan brown']
+
+    def get_lat_lng(self, coords_text):
+        # Degrees and decimal minutes, north and west.
+        lat = float(coords_text[2]) + float(coords_text[3]) / 60.0
+        lng = -1.0 * (float(coords_text[5]) + float(coords_text[6]) / 60.0)
+        return lat, lng
 
 if __name__ == '__main__':
-    main()
+    scrape.main(sys.argv.pop(1) if len(sys.argv) > 1 and
+                not sys.argv[1].startswith('-') else 'toronto')
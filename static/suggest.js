@@ -0,0 +1,50 @@
+// Search-as-you-type for the navbar search box, from /suggest?q=.
+$(function () {
+    var input = $('input[name="search_term"]');
+    if (input.length == 0) {
+        return;
+    }
+    var menu = $('<ul class="dropdown-menu"></ul>');
+    input.parent().css('position', 'relative').append(menu);
+
+    var timer = null;
+    var last_query = null;
+
+    function show(suggestions) {
+        menu.empty();
+        $.each(suggestions['tags'], function (i, tag) {
+            menu.append($('<li></li>').append(
+                $('<a></a>').attr('href', tag['url']).text('#' + tag['title'])));
+        });
+        if (suggestions['tags'].length && suggestions['plaques'].length) {
+            menu.append('<li role="separator" class="divider"></li>');
+        }
+        $.each(suggestions['plaques'], function (i, plaque) {
+            menu.append($('<li></li>').append(
+                $('<a></a>').attr('href', plaque['url']).text(plaque['title'])));
+        });
+        menu.toggle(menu.children().length > 0);
+    }
+
+    input.attr('autocomplete', 'off').on('input', function () {
+        var query = $.trim(input.val());
+        clearTimeout(timer);
+        if (query == '') {
+            menu.hide();
+            return;
+        }
+        timer = setTimeout(function () {
+            last_query = query;
+            $.getJSON('/suggest', {q: query}, function (suggestions) {
+                if (query == last_query) {
+                    show(suggestions);
+                }
+            });
+        }, 100);
+    });
+
+    input.on('blur', function () {
+        // Let a click on a suggestion land first.
+        setTimeout(function () { menu.hide(); }, 200);
+    });
+});
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for Cache.py, against the SDK's memcache stub, including a flush
+while many threads ask for the same value. Needs the App Engine SDK:
+
+    PYTHONPATH=<path to the SDK> python -m unittest discover tests
+"""
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+import dev_appserver
+dev_appserver.fix_sys_path()
+
+from google.appengine.ext import testbed
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import Cache
+
+NUM_THREADS = 20
+COMPUTE_SECONDS = 0.2
+
+class SlowCompute(object):
+    """A compute() that takes a while, and counts how often it's called."""
+    def __init__(self, value, seconds=COMPUTE_SECONDS):
+        self.value = value
+        self.seconds = seconds
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.seconds)
+        return self.value
+
+def get_concurrently(name, compute, num_threads=NUM_THREADS):
+    """Call get_or_compute from many threads at once; returns the values."""
+    values = []
+    lock = threading.Lock()
+    start = threading.Event()
+    def get():
+        start.wait()
+        value = Cache.get_or_compute(name, compute)
+        with lock:
+            values.append(value)
+    threads = [threading.Thread(target=get) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+    return values
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        Cache._local.clear()
+        Cache._generation_state.update(value=None, checked_at=0)
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_flush_orphans_both_tiers(self):
+        Cache.put('page', 'old')
+        self.assertEqual(Cache.get('page'), 'old')
+        Cache.flush_all()
+        self.assertEqual(Cache.get('page'), None)
+
+    def test_get_multi(self):
+        Cache.put_multi({'a': 1, 'b': 2})
+        Cache._local.clear() # so that b comes from memcache
+        self.assertEqual(Cache.get_multi(['a', 'b', 'c']), {'a': 1, 'b': 2})
+
+    def test_only_one_request_computes(self):
+        compute = SlowCompute('new')
+        values = get_concurrently('page', compute)
+        self.assertEqual(compute.calls, 1)
+        self.assertEqual(values, ['new'] * NUM_THREADS)
+        self.assertEqual(Cache.get('page'), 'new')
+
+    def test_flush_under_load_serves_the_stale_copy(self):
+        Cache.get_or_compute('page', lambda: 'old')
+        Cache.flush_all()
+
+        compute = SlowCompute('new')
+        values = get_concurrently('page', compute)
+        self.assertEqual(compute.calls, 1)
+        self.assertEqual(len(values), NUM_THREADS)
+        self.assertEqual(set(values), set(['old', 'new']))
+        self.assertEqual(Cache.get_or_compute('page', lambda: 'other'),
+                         'new')
+
+    def test_computes_after_waiting_too_long(self):
+        old_wait = Cache.LEASE_WAIT_SECONDS
+        Cache.LEASE_WAIT_SECONDS = 0.1
+        try:
+            compute = SlowCompute('new', seconds=0.5)
+            values = get_concurrently('page', compute, num_threads=3)
+        finally:
+            Cache.LEASE_WAIT_SECONDS = old_wait
+        self.assertEqual(compute.calls, 3)
+        self.assertEqual(values, ['new'] * 3)
+
+    def test_none_is_not_cached(self):
+        compute = SlowCompute(None, seconds=0)
+        self.assertEqual(Cache.get_or_compute('page', compute), None)
+        self.assertEqual(Cache.get_or_compute('page', compute), None)
+        self.assertEqual(compute.calls, 2)
+
+if __name__ == '__main__':
+    unittest.main()
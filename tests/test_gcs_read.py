@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for lib/cloudstorage's ReadBuffer, against a stub of the storage API
+that serves an object from memory and records the requests made for it.
+Needs the App Engine SDK, for ndb's futures:
+
+    PYTHONPATH=<path to the SDK> python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+import dev_appserver
+dev_appserver.fix_sys_path()
+
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import lib.cloudstorage as gcs
+from lib.cloudstorage.storage_api import ReadBuffer
+
+PATH = '/bucket/object'
+ETAG = 'abc123'
+BUFFER_SIZE = 100
+
+def make_content(size):
+    """Bytes that differ from one offset to the next, with some newlines."""
+    return ''.join('\n' if n % 37 == 36 else chr(ord('a') + n % 26)
+                   for n in range(size))
+
+def future(result):
+    fut = ndb.Future()
+    fut.set_result(result)
+    return fut
+
+class StubStorageApi(object):
+    """
+    Ranged GETs and HEADs of one object, as GCS answers them. requests has
+    ('get', start, end) or ('head',) for each request.
+    """
+    def __init__(self, content, content_range=True):
+        self.content = content
+        self.content_range = content_range
+        self.requests = []
+
+    def head_object(self, path):
+        self.requests.append(('head',))
+        return 200, {'content-length': str(len(self.content)),
+                     'etag': '"%s"' % ETAG}, ''
+
+    def get_object(self, path, headers=None):
+        return self.get_object_async(path, headers).get_result()
+
+    def get_object_async(self, path, headers=None):
+        start, end = [int(n) for n in headers['Range'][6:].split('-')]
+        self.requests.append(('get', start, end))
+        size = len(self.content)
+        if start >= size:
+            return future((416, {'content-range': 'bytes */%s' % size}, ''))
+        end = min(end, size - 1)
+        resp_headers = {'etag': '"%s"' % ETAG}
+        if self.content_range:
+            resp_headers['content-range'] = 'bytes %s-%s/%s' % (start, end,
+                                                                size)
+        return future((206, resp_headers, self.content[start:end + 1]))
+
+    def gets(self):
+        return [r for r in self.requests if r[0] == 'get']
+
+def stat(size):
+    return gcs.GCSFileStat(PATH, size, ETAG, 0)
+
+class ReadBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        ndb.get_context().clear_cache()
+        self.content = make_content(10 * BUFFER_SIZE + 7)
+        self.api = StubStorageApi(self.content)
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def open(self, **kwargs):
+        kwargs.setdefault('buffer_size', BUFFER_SIZE)
+        kwargs.setdefault('max_request_size', 4 * BUFFER_SIZE)
+        kwargs.setdefault('read_ahead', 3)
+        return ReadBuffer(self.api, PATH, **kwargs)
+
+    def test_reads_across_segment_boundaries(self):
+        buf = self.open()
+        chunks = []
+        for size in [1, 99, 150, 37, 401, 1, 1000]:
+            chunks.append(buf.read(size))
+            self.assertEqual(buf.tell(), sum(len(c) for c in chunks))
+        self.assertEqual(''.join(chunks), self.content)
+        self.assertEqual(buf.read(), '')
+
+    def test_readlines_across_segment_boundaries(self):
+        self.assertEqual(list(self.open()),
+                         self.content.splitlines(True))
+
+    def test_seek_then_read_across_a_boundary(self):
+        buf = self.open()
+        buf.seek(BUFFER_SIZE - 10)
+        self.assertEqual(buf.read(20), self.content[90:110])
+        buf.seek(5, os.SEEK_CUR)
+        self.assertEqual(buf.read(BUFFER_SIZE * 3),
+                         self.content[115:115 + BUFFER_SIZE * 3])
+        buf.seek(-3, os.SEEK_END)
+        self.assertEqual(buf.read(), self.content[-3:])
+
+    def test_eof_in_the_middle_of_the_read_ahead(self):
+        buf = self.open()
+        buf.seek(len(self.content) - BUFFER_SIZE - 50)
+        # The window holds the 50 bytes after one segment, and no more.
+        self.assertEqual(sum(size for size, _ in buf._pending), 150)
+        self.assertEqual(buf.read(1000), self.content[-150:])
+        self.assertEqual(buf.read(1), '')
+        self.assertEqual(buf.tell(), len(self.content))
+        for _, start, end in self.api.gets():
+            self.assertTrue(start < len(self.content))
+
+    def test_seek_backwards_after_read_ahead(self):
+        buf = self.open()
+        self.assertEqual(buf.read(450), self.content[:450])
+        self.assertTrue(buf._pending)
+        buf.seek(30)
+        self.assertEqual(buf.read(200), self.content[30:230])
+        buf.seek(0)
+        self.assertEqual(buf.read(), self.content)
+
+    def test_size_comes_from_the_first_get(self):
+        buf = self.open()
+        self.assertEqual(buf._file_size, len(self.content))
+        self.assertEqual(self.api.requests[0], ('get', 0, BUFFER_SIZE - 1))
+        self.assertEqual(buf.rpc_counts['head'], 0)
+
+    def test_heads_without_a_content_range(self):
+        self.api.content_range = False
+        buf = self.open()
+        self.assertEqual(buf.rpc_counts['head'], 1)
+        self.assertEqual(buf.read(), self.content)
+
+    def test_empty_object(self):
+        self.api.content = ''
+        buf = self.open()
+        self.assertEqual(buf.read(), '')
+        self.assertEqual(dict(buf.rpc_counts), {'get': 1})
+
+    def test_offset_past_the_end(self):
+        buf = self.open(offset=len(self.content) + 10)
+        self.assertEqual(buf.tell(), len(self.content))
+        self.assertEqual(buf.read(), '')
+
+    def test_small_object_with_a_stat_takes_one_get(self):
+        self.api.content = make_content(350)
+        buf = self.open(stat=stat(350))
+        self.assertEqual(buf.read(), self.api.content)
+        self.assertEqual(self.api.requests, [('get', 0, 349)])
+
+    def test_large_object_with_a_stat(self):
+        buf = self.open(stat=stat(len(self.content)))
+        self.assertEqual(buf.read(), self.content)
+        self.assertEqual(buf.rpc_counts['head'], 0)
+        self.assertEqual(self.api.requests[0], ('get', 0, BUFFER_SIZE - 1))
+
+    def test_stat_with_the_wrong_size(self):
+        for size in [len(self.content) - 1, len(self.content) + 1, 50]:
+            self.api.requests = []
+            self.assertRaises(ValueError, self.open, stat=stat(size))
+
+    def test_stat_with_another_etag(self):
+        other = gcs.GCSFileStat(PATH, len(self.content), 'other', 0)
+        self.assertRaises(ValueError, self.open, stat=other)
+
+    def test_segments_grow_while_they_are_fast(self):
+        self.api.content = make_content(40 * BUFFER_SIZE)
+        buf = self.open()
+        while buf.read(BUFFER_SIZE):
+            pass
+        self.assertEqual(buf._segment_size, 4 * BUFFER_SIZE)
+        sizes = [end + 1 - start for _, start, end in self.api.gets()]
+        self.assertEqual(max(sizes), 4 * BUFFER_SIZE)
+
+    def test_segments_shrink_when_they_are_slow(self):
+        buf = self.open()
+        buf._segment_size = 4 * BUFFER_SIZE
+        buf._adjust_segment_size(ReadBuffer.TARGET_SEGMENT_SECONDS * 3)
+        self.assertEqual(buf._segment_size, 2 * BUFFER_SIZE)
+        buf._adjust_segment_size(ReadBuffer.TARGET_SEGMENT_SECONDS)
+        self.assertEqual(buf._segment_size, 2 * BUFFER_SIZE)
+        for _ in range(3):
+            buf._adjust_segment_size(ReadBuffer.TARGET_SEGMENT_SECONDS * 3)
+        self.assertEqual(buf._segment_size, BUFFER_SIZE)
+
+    def test_window_is_bounded(self):
+        buf = self.open(read_ahead=2, max_request_size=100 * BUFFER_SIZE)
+        old_max = ReadBuffer.MAX_READ_AHEAD_BYTES
+        ReadBuffer.MAX_READ_AHEAD_BYTES = 6 * BUFFER_SIZE
+        try:
+            buf._segment_size = BUFFER_SIZE
+            for _ in range(5):
+                buf._adjust_segment_size(0)
+        finally:
+            ReadBuffer.MAX_READ_AHEAD_BYTES = old_max
+        self.assertEqual(buf._segment_size, 3 * BUFFER_SIZE)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the local inverted and prefix indexes (LocalSearch.py), which
+need nothing from App Engine. From the top of the repo:
+
+    python -m unittest discover tests
+"""
+
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from LocalSearch import InvertedIndex, PrefixIndex, SORT_RECENT, tokenize
+
+def round_trip(index):
+    return InvertedIndex.from_dict(json.loads(json.dumps(index.to_dict())))
+
+class TokenizeTest(unittest.TestCase):
+    def test_lowercases_and_drops_tags(self):
+        self.assertEqual(tokenize(u'<b>Old</b> Town Hall'),
+                         [u'old', u'town', u'hall'])
+
+    def test_empty(self):
+        self.assertEqual(tokenize(None), [])
+        self.assertEqual(tokenize(''), [])
+
+class InvertedIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = InvertedIndex()
+        self.index.add('hall', title='Old Town Hall', tags=['civic'],
+                       description='Built in 1850.', lat=43.65, lng=-79.38,
+                       created_on=100)
+        self.index.add('mill', title='Town Mill', tags=['industry'],
+                       description='A mill by the river.', lat=43.66,
+                       lng=-79.40, created_on=200)
+        self.index.add('bridge', title='River Bridge', tags=['civic'],
+                       description='Crosses the river.', lat=51.5,
+                       lng=-0.12, created_on=300)
+
+    def test_terms_are_anded(self):
+        self.assertEqual(self.index.search('town mill'), (['mill'], 1))
+        self.assertEqual(self.index.search('town bridge'), ([], 0))
+
+    def test_last_term_is_a_prefix(self):
+        self.assertEqual(self.index.search('brid'), (['bridge'], 1))
+        self.assertEqual(self.index.search('brid', prefix=False), ([], 0))
+
+    def test_title_outranks_description(self):
+        doc_ids, num_found = self.index.search('river')
+        self.assertEqual(num_found, 2)
+        self.assertEqual(doc_ids[0], 'bridge')
+
+    def test_recent_first(self):
+        doc_ids, _ = self.index.search('civic', sort=SORT_RECENT)
+        self.assertEqual(doc_ids, ['bridge', 'hall'])
+
+    def test_limit_and_offset(self):
+        doc_ids, num_found = self.index.search('town', limit=1, offset=1,
+                                               sort=SORT_RECENT)
+        self.assertEqual((doc_ids, num_found), (['hall'], 2))
+
+    def test_removed_documents_dont_match(self):
+        self.index.remove('mill')
+        self.assertEqual(self.index.search('mill'), ([], 0))
+        self.assertEqual(len(self.index), 2)
+
+    def test_removed_documents_dont_skew_scores(self):
+        index = InvertedIndex()
+        index.add('a', title='town')
+        index.add('b', title='town')
+        index.remove('a')
+        self.assertEqual(index.search('town'), (['b'], 1))
+        self.assertEqual(round_trip(index).search('town'), (['b'], 1))
+
+    def test_same_scores_after_round_trip(self):
+        self.index.add('mill', title='Town Mill', description='Rebuilt.')
+        self.index.remove('bridge')
+        copy = round_trip(self.index)
+        for query in ['town', 'civic', 'r', 'mill rebuilt']:
+            self.assertEqual(copy.search(query), self.index.search(query))
+
+    def test_replacing_a_document(self):
+        self.index.add('mill', title='Grist Mill')
+        self.assertEqual(self.index.search('town'), (['hall'], 1))
+        self.assertEqual(self.index.search('grist'), (['mill'], 1))
+        self.assertEqual(len(self.index), 3)
+
+    def test_geo_search(self):
+        hits = self.index.geo_search(43.65, -79.38, 5000)
+        self.assertEqual([doc_id for doc_id, _ in hits], ['hall', 'mill'])
+        self.assertEqual(hits[0][1], 0)
+        self.assertEqual(self.index.geo_search(43.65, -79.38, 5000,
+                                               limit=1)[0][0], 'hall')
+
+class PrefixIndexTest(unittest.TestCase):
+    items = [(u'Old Town Hall', '/plaque/hall', 0),
+             (u'Town Mill', '/plaque/mill', 0),
+             (u'Townsend House', '/plaque/townsend', 0),
+             (u'River Bridge', '/plaque/bridge', 5)]
+
+    def setUp(self):
+        self.index = PrefixIndex.build(self.items)
+
+    def urls(self, query, limit=10):
+        return [url for text, url in self.index.search(query, limit)]
+
+    def test_starting_with_the_prefix_ranks_first(self):
+        # Then shorter texts; 'Old Town Hall' only has it as its second word.
+        self.assertEqual(self.urls('town'), ['/plaque/mill',
+                                             '/plaque/townsend',
+                                             '/plaque/hall'])
+
+    def test_weight_outranks_length(self):
+        index = PrefixIndex.build([(u'river', '/tag/river', 1),
+                                   (u'riverside walks', '/tag/walks', 9)])
+        self.assertEqual([url for _, url in index.search('riv')],
+                         ['/tag/walks', '/tag/river'])
+
+    def test_complete_words_must_all_match(self):
+        self.assertEqual(self.urls('town h'), ['/plaque/hall'])
+        self.assertEqual(self.urls('mill town'), ['/plaque/mill'])
+        self.assertEqual(self.urls('bridge t'), [])
+
+    def test_limit(self):
+        self.assertEqual(self.urls('t', limit=2), ['/plaque/mill',
+                                                   '/plaque/townsend'])
+        self.assertEqual(self.urls('townsend', limit=1), ['/plaque/townsend'])
+
+    def test_limit_past_the_precomputed_top(self):
+        items = [(u'Plaque %s' % n, '/plaque/%s' % n, 0)
+                 for n in range(PrefixIndex.TOP_K + 5)]
+        index = PrefixIndex.build(items)
+        self.assertEqual(len(index.search('pla', PrefixIndex.TOP_K + 5)),
+                         PrefixIndex.TOP_K + 5)
+
+    def test_removed_texts_dont_match(self):
+        self.index.remove('/plaque/mill')
+        self.assertEqual(self.urls('town'), ['/plaque/townsend',
+                                             '/plaque/hall'])
+        self.assertEqual(self.urls('mill'), [])
+        self.assertEqual(len(self.index), 3)
+
+    def test_add_matches_build(self):
+        index = PrefixIndex()
+        for text, url, weight in self.items:
+            index.add(text, url, weight)
+        for query in ['t', 'town', 'r', 'old town h', 'x']:
+            self.assertEqual(index.search(query), self.index.search(query))
+
+    def test_replacing_a_text(self):
+        self.index.add(u'Grist Mill', '/plaque/mill')
+        self.assertEqual(self.urls('grist'), ['/plaque/mill'])
+        self.assertEqual(self.urls('town'), ['/plaque/townsend',
+                                             '/plaque/hall'])
+
+    def test_same_results_after_round_trip(self):
+        self.index.remove('/plaque/bridge')
+        data = json.loads(json.dumps(self.index.to_dict()))
+        copy = PrefixIndex.from_dict(data)
+        for query in ['t', 'town', 'riv', 'old town h']:
+            self.assertEqual(copy.search(query), self.index.search(query))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for Suggest.py's copies of the indexes: the snapshot split into
+memcache chunks, and the log of changes appended with compare-and-set and
+replayed by every instance. Against the SDK's stubs, so it needs the App
+Engine SDK:
+
+    PYTHONPATH=<path to the SDK> python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+import dev_appserver
+dev_appserver.fix_sys_path()
+
+from google.appengine.api import memcache
+from google.appengine.ext import testbed
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT_DIR)
+from LocalSearch import PrefixIndex
+from Models import Plaque
+import Suggest
+
+MemcacheClient = memcache.Client
+
+def plaque(title, tags):
+    title_url = title.lower().replace(' ', '-')
+    return Plaque(title=title, title_url=title_url, tags=tags)
+
+def urls(suggestions, name):
+    return [s['url'] for s in suggestions[name]]
+
+def forget_indexes():
+    """As if this were another instance, which hasn't loaded them yet."""
+    Suggest._state.update(version=None, titles=None, tags=None, applied=0,
+                          checked_at=0)
+
+def check_log_now():
+    Suggest._state['checked_at'] = 0
+
+class RacingClient(object):
+    """
+    A memcache client that, the first time it reads the log, has another
+    instance append to it before it can write.
+    """
+    def __init__(self, other_op):
+        self.client = MemcacheClient()
+        self.other_op = other_op
+        self.cas_calls = 0
+
+    def gets(self, key):
+        value = self.client.gets(key)
+        if self.other_op is not None:
+            other = MemcacheClient()
+            delta = other.gets(key)
+            delta['ops'].append(self.other_op)
+            other.cas(key, delta)
+            self.other_op = None
+        return value
+
+    def cas(self, key, value):
+        self.cas_calls += 1
+        return self.client.cas(key, value)
+
+class SuggestTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT_DIR)
+        self.taskqueue = self.testbed.get_stub(
+            testbed.TASKQUEUE_SERVICE_NAME)
+        forget_indexes()
+
+        self.old_chunk_bytes = Suggest.CHUNK_BYTES
+        Suggest.CHUNK_BYTES = 100 # so that the snapshot needs a few
+        titles = [(u'Old Town Hall', '/plaque/old-town-hall', 0),
+                  (u'Town Mill', '/plaque/town-mill', 0)]
+        tags = [(u'civic', '/tag/civic', 1), (u'industry', '/tag/industry', 1)]
+        Suggest.store(PrefixIndex.build(titles), PrefixIndex.build(tags))
+
+    def tearDown(self):
+        Suggest.CHUNK_BYTES = self.old_chunk_bytes
+        self.testbed.deactivate()
+
+    def rebuilds_queued(self):
+        return len(self.taskqueue.get_filtered_tasks(
+            url=Suggest.SUGGEST_BUILD_URL))
+
+    def test_snapshot_is_chunked(self):
+        header = memcache.get(Suggest.HEADER_KEY)
+        self.assertTrue(header['num_chunks'] > 1)
+        forget_indexes()
+        self.assertEqual(urls(Suggest.suggest('town'), 'plaques'),
+                         ['/plaque/town-mill', '/plaque/old-town-hall'])
+
+    def test_another_instance_replays_the_log_onto_the_snapshot(self):
+        Suggest.plaque_approved(plaque(u'Town Bridge', [u'civic', u'river']))
+        Suggest.plaque_removed(plaque(u'Town Mill', [u'industry']))
+        forget_indexes()
+
+        suggestions = Suggest.suggest('t')
+        self.assertEqual(urls(suggestions, 'plaques'),
+                         ['/plaque/town-bridge', '/plaque/old-town-hall'])
+        # civic's count went up to 2; industry's last plaque went.
+        self.assertEqual(urls(Suggest.suggest('c'), 'tags'), ['/tag/civic'])
+        self.assertEqual(Suggest._state['tags'].weights[
+            Suggest._state['tags'].entry_nums['/tag/civic']], 2)
+        self.assertEqual(Suggest.suggest('ind')['tags'], [])
+        self.assertEqual(Suggest._state['applied'], 2)
+
+    def test_only_new_entries_are_replayed(self):
+        Suggest.plaque_approved(plaque(u'Town Bridge', [u'civic']))
+        check_log_now()
+        Suggest.suggest('t')
+        Suggest.plaque_approved(plaque(u'Stone Bridge', [u'civic']))
+        check_log_now()
+        Suggest.suggest('t')
+
+        tags = Suggest._state['tags']
+        self.assertEqual(tags.weights[tags.entry_nums['/tag/civic']], 3)
+        self.assertEqual(Suggest._state['applied'], 2)
+
+    def test_log_waits_for_the_check_interval(self):
+        Suggest.suggest('t')
+        Suggest.plaque_approved(plaque(u'Town Bridge', []))
+        self.assertNotIn('/plaque/town-bridge',
+                         urls(Suggest.suggest('t'), 'plaques'))
+        check_log_now()
+        self.assertIn('/plaque/town-bridge',
+                      urls(Suggest.suggest('t'), 'plaques'))
+
+    def test_cas_conflict_is_retried(self):
+        other_op = {'op': 'add', 'title': u'Stone Bridge',
+                    'url': '/plaque/stone-bridge', 'tags': []}
+        client = RacingClient(other_op)
+        Suggest.memcache.Client = lambda: client
+        try:
+            Suggest.plaque_approved(plaque(u'Town Bridge', []))
+        finally:
+            Suggest.memcache.Client = MemcacheClient
+
+        self.assertEqual(client.cas_calls, 2)
+        delta = memcache.get(Suggest.DELTA_KEY)
+        self.assertEqual([op['url'] for op in delta['ops']],
+                         ['/plaque/stone-bridge', '/plaque/town-bridge'])
+        self.assertEqual(self.rebuilds_queued(), 0)
+
+    def test_missing_chunk_queues_a_rebuild(self):
+        header = memcache.get(Suggest.HEADER_KEY)
+        memcache.delete(Suggest.CHUNK_KEY % (header['version'], 0))
+        forget_indexes()
+        self.assertEqual(Suggest.suggest('town'), {'tags': [], 'plaques': []})
+        self.assertEqual(self.rebuilds_queued(), 1)
+
+    def test_evicted_log_queues_a_rebuild(self):
+        memcache.delete(Suggest.DELTA_KEY)
+        Suggest.plaque_approved(plaque(u'Town Bridge', []))
+        self.assertEqual(self.rebuilds_queued(), 1)
+
+if __name__ == '__main__':
+    unittest.main()